@@ -0,0 +1,81 @@
+"""
+Merges listings from several routes of a wide directory, with and
+without routes on the listed items, and of a deep tree, the deep tree
+is deeper than the recursion limit.
+
+Run with: python -m benchmarks.bench_merge
+"""
+import sys
+import time
+
+from thomas.filesystem import Item
+
+WIDE_ITEM_COUNT = 100000
+WIDE_ROUTE_COUNT = 3
+DEEP_LEVEL_COUNT = sys.getrecursionlimit() * 2
+
+
+def create_wide_listing(route_number, with_routes=False):
+    listing = Item('directory')
+    listing.nested_items = [Item('file%06i.mkv' % (i, ), attributes={'size': i, 'route%i' % (route_number, ): True})
+                            for i in range(route_number, WIDE_ITEM_COUNT + route_number)]
+    if with_routes:
+        # like listings from list handlers, every item has the route of its handler
+        for item in listing.nested_items:
+            item.readable = True
+            item.add_route('handler%i' % (route_number, ), True, False, False)
+
+    return listing
+
+
+def create_routed_listing(route_number):
+    return create_wide_listing(route_number, with_routes=True)
+
+
+def create_deep_listing(route_number):
+    listing = item = Item('directory')
+    for i in range(DEEP_LEVEL_COUNT):
+        nested_item = Item('level%i' % (i, ))
+        item.nested_items = [nested_item]
+        nested_item.parent_item = item
+        item = nested_item
+
+    item.nested_items = [Item('file%i.mkv' % (route_number, ))]
+    return listing
+
+
+def merge_one_by_one(listings):
+    directory = Item('directory')
+    for listing in listings:
+        directory.merge(listing)
+
+    return directory
+
+
+def merge_batch(listings):
+    directory = Item('directory')
+    directory.merge(*listings)
+    return directory
+
+
+def timed(name, f, *args):
+    start_time = time.time()
+    result = f(*args)
+    print('%-40s %8.3fs' % (name, time.time() - start_time))
+    return result
+
+
+def main():
+    for name, create_listing in [('wide', create_wide_listing), ('routed', create_routed_listing), ('deep', create_deep_listing)]:
+        listings = [create_listing(i) for i in range(WIDE_ROUTE_COUNT)]
+        timed('Merge %s listings one by one' % (name, ), merge_one_by_one, listings)
+
+        listings = [create_listing(i) for i in range(WIDE_ROUTE_COUNT)]
+        directory = timed('Merge %s listings in one batch' % (name, ), merge_batch, listings)
+
+        if name != 'deep':
+            assert len(directory.nested_items) == WIDE_ITEM_COUNT + WIDE_ROUTE_COUNT - 1
+
+
+if __name__ == '__main__':
+    main()
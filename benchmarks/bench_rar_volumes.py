@@ -0,0 +1,70 @@
+"""
+Resolves the volumes of a RAR set in a directory of 5,000 volumes,
+compares with scanning the listing for every lookup.
+
+Run with: python -m benchmarks.bench_rar_volumes
+"""
+import time
+
+from rarfile import _next_newvol
+
+from thomas.filesystem import Item
+from thomas.processors.rar import _get_item_from_filename
+from thomas.streamers.rar import RarStreamer
+
+VOLUME_COUNT = 5000
+
+
+def create_directory():
+    directory = Item('directory')
+    for i in range(VOLUME_COUNT):
+        item = Item('Some.Archive.part%04i.rar' % (i + 1, ), attributes={'size': 50 * 1024 * 1024})
+        item.readable = True
+        directory.add_item(item)
+
+    return directory
+
+
+def scan_item_from_filename(filesystem, filename):
+    items = [item for item in filesystem.list() if item.id.lower() == filename.lower()]
+    if not items:
+        return None
+
+    return items[0]
+
+
+def resolve_volumes(directory, get_item):
+    filename = directory.nested_items[0].id
+    volumes = [get_item(directory, filename)]
+    while True:
+        filename = _next_newvol(filename)
+        item = get_item(directory, filename)
+        if not item:
+            break
+        volumes.append(item)
+
+    return volumes
+
+
+def timed(name, f, *args):
+    start_time = time.time()
+    result = f(*args)
+    print('%-40s %8.3fs' % (name, time.time() - start_time))
+    return result
+
+
+def main():
+    directory = create_directory()
+
+    volumes = timed('Volume resolution with name index', resolve_volumes, directory, _get_item_from_filename)
+    assert len(volumes) == VOLUME_COUNT
+
+    volumes = timed('Volume resolution with listing scan', resolve_volumes, directory, scan_item_from_filename)
+    assert len(volumes) == VOLUME_COUNT
+
+    filesets = timed('RarStreamer fileset discovery', RarStreamer(directory)._find_all_filesets, directory)
+    assert len(filesets) == 1 and len(filesets[0]) == VOLUME_COUNT
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Adds many routes to items and opens and lists them, the time spent
+is mostly deduplicating routes and finding the handlers to use.
+
+Run with: python -m benchmarks.bench_routes
+"""
+import time
+
+from io import BytesIO
+
+from thomas.filesystem import Item, Router
+
+ITEM_COUNT = 2000
+ROUTE_COUNT = 50
+DISPATCH_COUNT = 20
+
+
+def open_bytes(item, data):
+    return BytesIO(data)
+
+
+def list_nothing(item, path):
+    return item
+
+
+def create_router():
+    router = Router()
+    router.register_handler('bytes', open_bytes, True, False, False)
+    router.register_handler('nothing', list_nothing, False, True, False)
+    return router
+
+
+def add_routes(router):
+    items = []
+    for i in range(ITEM_COUNT):
+        item = Item('file%06i.mkv' % (i, ), router=router, attributes={'size': 100})
+        item.readable = True
+        item.expandable = True
+        for j in range(ROUTE_COUNT):
+            item.add_route('bytes', True, False, False, kwargs={'data': b'%i' % (j, )}, priority=j % 7)
+            item.add_route('nothing', False, True, False, kwargs={'path': '/%i' % (j % 5, )})
+        items.append(item)
+
+    return items
+
+
+def open_items(items):
+    for _ in range(DISPATCH_COUNT):
+        for item in items:
+            item.open()
+
+
+def list_items(router, items):
+    for item in items[:ITEM_COUNT // 10]:
+        router._create_list_calls(item, item.duplicate(), {})
+
+
+def timed(name, f, *args):
+    start_time = time.time()
+    result = f(*args)
+    print('%-40s %8.3fs' % (name, time.time() - start_time))
+    return result
+
+
+def main():
+    router = create_router()
+    items = timed('Add %i routes to %i items' % (ROUTE_COUNT * 2, ITEM_COUNT), add_routes, router)
+    assert len(items[0].routes) == ROUTE_COUNT + 5
+
+    timed('Open %i items %i times' % (ITEM_COUNT, DISPATCH_COUNT), open_items, items)
+    timed('Create list calls for %i items' % (ITEM_COUNT // 10, ), list_items, router, items)
+
+
+if __name__ == '__main__':
+    main()
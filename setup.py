@@ -28,7 +28,8 @@ setup(
         'progressbar2',
         'rfc6266',
         'requests',
-        'rarfile',
+        'rarfile>=3.0,<4.0',
+        'futures; python_version < "3.0"',
     ],
     license='MIT',
     classifiers=[
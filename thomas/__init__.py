@@ -4,8 +4,16 @@ from .plugin import InputBase, StreamerBase, OutputBase, ProcessorBase
 
 from .txiobuffer import TwistedIOBuffer
 
+from .inputs.rclone import rclone_lister
+from .processors.rar import list_rar_members
+from .processors.virtualfile import open_virtualfile
+
 for plugin in InputBase.get_all_plugins():
     router.register_handler(plugin.plugin_name, plugin, True, False, False)
 
 for plugin in StreamerBase.get_all_plugins():
-    router.register_handler(plugin.plugin_name, plugin, False, False, True)
\ No newline at end of file
+    router.register_handler(plugin.plugin_name, plugin, False, False, True)
+
+router.register_handler('rclone_list', rclone_lister, False, True, False)
+router.register_handler('rar_list', list_rar_members, False, True, False)
+router.register_handler('virtualfile', open_virtualfile, True, False, False)
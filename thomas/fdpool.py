@@ -0,0 +1,142 @@
+"""
+A process-wide pool of read-only file descriptors.
+
+Readers share a single descriptor per path and use positional reads,
+so there is no seek state to fight over. Descriptors not in use are
+kept open and evicted in least recently used order when the pool is full.
+"""
+import logging
+import os
+
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'FileDescriptorPool',
+    'fd_pool',
+    'pread',
+]
+
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+class PoolEntry(object):
+    def __init__(self, path, fd, stat):
+        self.path = path
+        self.fd = fd
+        self.stat = stat
+        self.refcount = 0
+        self.lock = Lock()
+
+
+class FileDescriptorPool(object):
+    def __init__(self, max_open=128):
+        """
+        max_open is the number of descriptors that can be kept
+        open while unused. Descriptors in use are never closed, so the
+        pool can temporarily grow beyond this.
+        """
+        self.max_open = max_open
+        self._entries = OrderedDict()
+        self._retired = []
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, path):
+        """
+        Returns an entry with an open descriptor for path,
+        the entry must be given back with release.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and not _same_file(entry.stat, stat):
+                logger.debug('File %r changed on disk, reopening' % (path, ))
+                self._retire(entry)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                entry = PoolEntry(path, os.open(path, os.O_RDONLY | O_BINARY), stat)
+            else:
+                self.hits += 1
+
+            entry.refcount += 1
+            self._entries[path] = entry
+            self._evict()
+
+        return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.refcount -= 1
+            if entry.refcount <= 0 and entry in self._retired:
+                self._retired.remove(entry)
+                os.close(entry.fd)
+            else:
+                self._evict()
+
+    def _retire(self, entry):
+        if entry.refcount > 0:
+            self._retired.append(entry)
+        else:
+            os.close(entry.fd)
+
+    def _evict(self):
+        if len(self._entries) <= self.max_open:
+            return
+
+        for path, entry in list(self._entries.items()):
+            if len(self._entries) <= self.max_open:
+                break
+
+            if entry.refcount > 0:
+                continue
+
+            logger.debug('Evicting %r from descriptor pool' % (path, ))
+            del self._entries[path]
+            os.close(entry.fd)
+            self.evictions += 1
+
+    def clear(self):
+        """Close all descriptors not in use"""
+        with self._lock:
+            for path, entry in list(self._entries.items()):
+                del self._entries[path]
+                self._retire(entry)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'max_open': self.max_open,
+                'open': len(self._entries) + len(self._retired),
+                'in_use': sum(1 for entry in self._entries.values() if entry.refcount > 0) + len(self._retired),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def _same_file(a, b):
+    return (a.st_dev, a.st_ino, a.st_size, a.st_mtime) == (b.st_dev, b.st_ino, b.st_size, b.st_mtime)
+
+
+def pread(entry, num_bytes, pos):
+    """Read from a pool entry at a position without moving any shared state"""
+    if hasattr(os, 'pread'):
+        return os.pread(entry.fd, num_bytes, pos)
+
+    with entry.lock:
+        os.lseek(entry.fd, pos, os.SEEK_SET)
+        return os.read(entry.fd, num_bytes)
+
+
+fd_pool = FileDescriptorPool()
@@ -1,11 +1,17 @@
 import logging
-from six.moves import queue
+import time
+import types
+import weakref
+from six.moves import intern, queue
 
 import pytz
 
+from concurrent.futures import wait
 from datetime import datetime
 
-from threading import Thread
+from threading import Event, Lock, local
+
+from .threadpool import DaemonThreadPool
 
 __all__ = [
     'Item',
@@ -16,31 +22,93 @@ logger = logging.getLogger(__name__)
 
 
 class Router(object):
-    def __init__(self):
+    def __init__(self, evaluate_workers=8, evaluate_timeout=None, list_workers=16, list_timeout=None):
+        """
+        Streamers are evaluated at the same time with at most evaluate_workers
+        threads. Streamers that are not done within evaluate_timeout seconds
+        are skipped.
+
+        List handlers run with at most list_workers threads shared by all listings,
+        the results of handlers not done within list_timeout seconds are left out.
+
+        Streamers and list handlers that are skipped are left running in daemon
+        threads, they do not hold up the pools or keep the interpreter from exiting.
+
+        Handlers registered with a list_cache_ttl have their listings cached
+        per item path and route kwargs, and concurrent listings of the same
+        path share a single call to the handler.
+
+        The routes of an item are ordered for dispatch once per registry change
+        and shared by all items with the same routes, handlers must be changed
+        with register_handler and unregister_handler.
+        """
         self.registry = {}
+        self._registry_version = 0
         self.list_decorator = None
-
-    def register_handler(self, handler_id, handler, can_open, can_list, can_stream):
+        self.evaluate_workers = evaluate_workers
+        self.evaluate_timeout = evaluate_timeout
+        self.list_workers = list_workers
+        self.list_timeout = list_timeout
+        self._evaluate_executor = None
+        self._list_executor = None
+        self._list_queued = 0
+        self._list_running = 0
+        self._list_peak_queued = 0
+        self._list_cache = {}
+        self._list_flights = {}
+        self._list_cache_stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+        self._stats = {'evaluate': {}, 'list': {}}
+        self._lock = Lock()
+
+    def register_handler(self, handler_id, handler, can_open, can_list, can_stream, list_cache_ttl=None):
         self.registry[handler_id] = {
             'handler': handler,
             'can_open': can_open,
             'can_list': can_list,
             'can_stream': can_stream,
+            'list_cache_ttl': list_cache_ttl,
         }
+        self._registry_version += 1
 
     def unregister_handler(self, handler_id):
         if handler_id in self.registry:
             del self.registry[handler_id]
+            self._registry_version += 1
+
+    def _get_dispatch_routes(self, item, capability):
+        """
+        Returns (route, handler) for the routes of item with a handler that has capability,
+        highest priority first except for listing where all routes are used.
+        """
+        routes = item._get_route_set()
+        dispatch = routes.dispatch.get(self)
+        if dispatch is None or dispatch[0] != self._registry_version:
+            dispatch = (self._registry_version, self._create_dispatch(routes))
+            routes.dispatch[self] = dispatch
+
+        return dispatch[1][capability]
+
+    def _create_dispatch(self, routes):
+        dispatch = {'can_open': [], 'can_list': [], 'can_stream': []}
+        for route in routes:
+            handler = self.registry.get(route['handler'])
+            if not handler:
+                continue
+
+            for capability, dispatch_routes in dispatch.items():
+                if handler[capability]:
+                    dispatch_routes.append((route, handler))
+
+        for capability in ['can_open', 'can_stream']:
+            dispatch[capability].sort(key=lambda x:x[0].get('priority', 0), reverse=True)
+
+        return dispatch
 
     def open(self, item, **kwargs):
-        if not item.routes:
+        if not item._routes:
             return None
 
-        for route in sorted(item.routes, key=lambda x:x.get('priority', 0), reverse=True):
-            handler = self.registry.get(route['handler'])
-            if not handler or not handler['can_open']:
-                continue
-
+        for route, handler in self._get_dispatch_routes(item, 'can_open'):
             logger.debug('Opening with handler %s args %r' % (route['handler'], route['kwargs']))
             kwargs.update(route['kwargs'])
             return handler['handler'](item, **kwargs)
@@ -48,7 +116,7 @@ class Router(object):
         return None
 
     def list(self, item, **kwargs):
-        if not item.routes:
+        if not item._routes:
             return item
 
         orig_item = item
@@ -57,67 +125,328 @@ class Router(object):
         item = orig_item.duplicate(clear_routes=True, clear_nested=True)
 
         item_copies = []
-        thread_queue = queue.Queue()
-        threads = []
-        for route in orig_item.routes:
-            handler = self.registry.get(route['handler'])
-            if not handler or not handler['can_list']:
-                continue
+        for item_copy in self._run_list_calls(self._create_list_calls(orig_item, item, kwargs)):
+            if isinstance(item_copy, Item):
+                item_copy.id = item.id # otherwise merge will fail
+                item_copies.append(item_copy)
+
+        item.merge(*item_copies)
+
+        return item
 
+    def iter_list(self, item, **kwargs):
+        """
+        Like list, but yields the nested items as soon as a handler has listed them.
+        Handlers can be generators yielding pages, i.e. lists of nested items,
+        to make the first items available before the whole listing is done.
+
+        Items with the same id from several handlers are only yielded once,
+        the later ones are merged into the yielded item. The yielded items
+        have item as parent.
+        """
+        if not item._routes:
+            return
+
+        calls = self._create_list_calls(item, item.duplicate(clear_routes=True, clear_nested=True), kwargs)
+        seen_items = {}
+        for page in self._iter_list_calls(calls):
+            for nested_item in page:
+                seen_item = seen_items.get(nested_item.id)
+                if seen_item is None:
+                    seen_items[nested_item.id] = nested_item
+                    nested_item.parent_item = item
+                    yield nested_item
+                else:
+                    seen_item.merge(nested_item)
+
+    def _create_list_calls(self, orig_item, item, kwargs):
+        calls = []
+        for route, handler in self._get_dispatch_routes(orig_item, 'can_list'):
             logger.debug('Listing with handler %s args %r' % (route['handler'], route['kwargs']))
             item_copy = item.duplicate()
-            item_copies.append(item_copy)
             kwargs_copy = dict(kwargs)
             kwargs_copy.update(route['kwargs'])
 
-            def list_thread(q, f, *args, **kwargs):
-                q.put(f(*args, **kwargs))
+            cache_key = None
+            if handler.get('list_cache_ttl'):
+                try:
+                    cache_key = (orig_item.path, route['handler'], _list_cache_key(kwargs_copy))
+                except TypeError:
+                    logger.debug('Not caching listing with handler %s, the args cannot be used as key' % (route['handler'], ))
 
             if self.list_decorator:
                 kwargs_copy['_route_name'] = route['handler']
-                thread = Thread(target=list_thread, args=(thread_queue, self.list_decorator, handler['handler'], item_copy, ), kwargs=kwargs_copy)
+                calls.append((route['handler'], cache_key, self.list_decorator, (handler['handler'], item_copy, ), kwargs_copy))
+            else:
+                calls.append((route['handler'], cache_key, handler['handler'], (item_copy, ), kwargs_copy))
+
+        return calls
+
+    def _get_list_executor(self, call_count):
+        with self._lock:
+            if self._list_executor is None:
+                self._list_executor = DaemonThreadPool(self.list_workers, name='list')
+
+            self._list_queued += call_count
+            self._list_peak_queued = max(self._list_peak_queued, self._list_queued)
+            return self._list_executor
+
+    def _abandon_list_calls(self, executor, futures):
+        executor.abandon(futures)
+        cancelled = sum(1 for future in futures if future.cancelled())
+        if cancelled:
+            with self._lock:
+                self._list_queued -= cancelled
+
+    def _run_list_calls(self, calls):
+        if getattr(_list_worker_state, 'active', False):
+            # a handler listing from inside the pool could wait forever
+            # for a free worker, so do it in the current thread
+            return [self._cached_list(*call) for call in calls]
+
+        executor = self._get_list_executor(len(calls))
+        futures = [executor.submit(self._list_worker, self._cached_list, *call) for call in calls]
+        done, not_done = wait(futures, timeout=self.list_timeout)
+        self._abandon_list_calls(executor, not_done)
+
+        results = []
+        for call, future in zip(calls, futures):
+            if future in done:
+                results.append(future.result())
             else:
-                thread = Thread(target=list_thread, args=(thread_queue, handler['handler'], item_copy, ), kwargs=kwargs_copy)
+                logger.warning('List handler %s did not finish within %s seconds, skipping' % (call[0], self.list_timeout))
+                self._record_stats('list', call[0], timeouts=1)
 
-            thread.daemon = True
-            threads.append(thread)
-            thread.start()
+        return results
 
-        for thread in threads:
-            thread.join()
+    def _iter_list_calls(self, calls):
+        if getattr(_list_worker_state, 'active', False):
+            for call in calls:
+                for page in self._iter_cached_list_pages(*call):
+                    yield page
+            return
 
-        while not thread_queue.empty():
-            item_copy = thread_queue.get_nowait()
-            if isinstance(item_copy, Item):
-                item_copy.id = item.id # otherwise merge will fail
-                if item_copy:
-                    item.merge(item_copy)
+        page_queue = queue.Queue()
 
-        return item
+        def put_pages(*call):
+            try:
+                for page in self._iter_cached_list_pages(*call):
+                    page_queue.put(page)
+            finally:
+                page_queue.put(None)
+
+        executor = self._get_list_executor(len(calls))
+        futures = [executor.submit(self._list_worker, put_pages, *call) for call in calls]
+
+        if self.list_timeout is not None:
+            deadline = time.time() + self.list_timeout
+
+        running_calls = len(calls)
+        while running_calls:
+            try:
+                if self.list_timeout is None:
+                    page = page_queue.get()
+                else:
+                    page = page_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                logger.warning('%i list handlers did not finish within %s seconds, skipping' % (running_calls, self.list_timeout))
+                self._abandon_list_calls(executor, futures)
+                return
+
+            if page is None:
+                running_calls -= 1
+            else:
+                yield page
+
+    def _list_worker(self, f, *call):
+        with self._lock:
+            self._list_queued -= 1
+            self._list_running += 1
+
+        _list_worker_state.active = True
+        try:
+            return f(*call)
+        finally:
+            _list_worker_state.active = False
+            with self._lock:
+                self._list_running -= 1
+
+    def _cached_list(self, handler_id, cache_key, f, args, kwargs):
+        if cache_key is None:
+            return self._timed_list(handler_id, f, args, kwargs)
+
+        with self._lock:
+            cached_listing = self._list_cache.get(cache_key)
+            if cached_listing and cached_listing[0] > time.time():
+                self._list_cache_stats['hits'] += 1
+                flight, is_owner = None, False
+            else:
+                cached_listing = None
+                flight = self._list_flights.get(cache_key)
+                is_owner = flight is None
+                if is_owner:
+                    self._list_cache_stats['misses'] += 1
+                    flight = self._list_flights[cache_key] = ListingFlight()
+                else:
+                    self._list_cache_stats['coalesced'] += 1
+
+        if cached_listing:
+            return cached_listing[1].duplicate(clear_routes=False)
+
+        if not is_owner:
+            logger.debug('Waiting for listing of %r already in progress' % (cache_key[0], ))
+            flight.event.wait()
+            return flight.result and flight.result.duplicate(clear_routes=False)
+
+        try:
+            result = self._timed_list(handler_id, f, args, kwargs)
+            if isinstance(result, Item):
+                flight.result = _detached_copy(result)
+                ttl = self.registry[handler_id]['list_cache_ttl']
+                with self._lock:
+                    self._list_cache[cache_key] = (time.time() + ttl, flight.result)
+        finally:
+            with self._lock:
+                del self._list_flights[cache_key]
+            flight.event.set()
+
+        return result
+
+    def _iter_cached_list_pages(self, handler_id, cache_key, f, args, kwargs):
+        if cache_key is not None:
+            with self._lock:
+                cached_listing = self._list_cache.get(cache_key)
+                if cached_listing and cached_listing[0] > time.time():
+                    self._list_cache_stats['hits'] += 1
+                else:
+                    self._list_cache_stats['misses'] += 1
+                    cached_listing = None
+
+            if cached_listing:
+                yield cached_listing[1].duplicate(clear_routes=False).nested_items or []
+                return
+
+        for page, listed_item in self._iter_list_pages(handler_id, f, args, kwargs):
+            if page:
+                yield page
+
+        if cache_key is not None and isinstance(listed_item, Item):
+            ttl = self.registry[handler_id]['list_cache_ttl']
+            with self._lock:
+                self._list_cache[cache_key] = (time.time() + ttl, _detached_copy(listed_item))
+
+    def invalidate_list_cache(self, path=None, handler_id=None):
+        """Drop cached listings of path and everything below it, or everything"""
+        with self._lock:
+            for cache_key in list(self._list_cache.keys()):
+                if handler_id is not None and cache_key[1] != handler_id:
+                    continue
+
+                if path is None or cache_key[0] == path or cache_key[0].startswith(path + '/'):
+                    del self._list_cache[cache_key]
+
+    def _timed_list(self, handler_id, f, args, kwargs):
+        listed_item = None
+        for page, listed_item in self._iter_list_pages(handler_id, f, args, kwargs):
+            pass
+
+        return listed_item
+
+    def _iter_list_pages(self, handler_id, f, args, kwargs):
+        """
+        Yields (page, listed item) while the handler lists, the
+        listed item is only set when the handler is done.
+        """
+        start_time = time.time()
+        listed_item = None
+        is_paged = False
+        try:
+            result = f(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                # the item being listed is always the last positional argument
+                is_paged = True
+                listed_item = args[-1]
+                listed_item.initiate_nested_items()
+                for page in result:
+                    page = list(page)
+                    listed_item.nested_items.extend(page)
+                    yield page, None
+            else:
+                listed_item = result
+        except Exception:
+            logger.exception('List handler %s failed' % (handler_id, ))
+            listed_item = None
+        finally:
+            duration = time.time() - start_time
+            logger.debug('Listed with %s in %.3f seconds' % (handler_id, duration))
+            self._record_stats('list', handler_id, calls=1, duration=duration)
+
+        if isinstance(listed_item, Item) and not is_paged:
+            yield listed_item.nested_items or [], listed_item
+        else:
+            yield [], listed_item
 
     def stream(self, item, **kwargs):
         # turn the item into a readable URL of some kind
         # given stream preparators, they each find their best and turn the item into a streamable URL
         # these can be ...
-        if not item.routes:
+        if not item._routes:
             return None
 
-        # use evaluate to find the best one
-        best_evaluation = -1
-        best_plugin = None
+        # evaluating can be expensive, reuse the last result while the tree below
+        # item, its routes and the handlers are unchanged and no streamer was skipped
+        kwargs_key = repr(sorted(kwargs.items()))
+        stream_evaluation = item._stream_evaluation
+        if stream_evaluation and stream_evaluation[:4] == (item.version, self._registry_version, item._get_route_set(), kwargs_key):
+            logger.debug('Using cached evaluation for %r' % (item.id, ))
+            best_plugin = stream_evaluation[4]
+        else:
+            best_plugin, is_complete = self._evaluate_streamers(item, kwargs)
+            if is_complete:
+                # streamers can list and change the tree while evaluating,
+                # the result is for the tree as it is afterwards
+                item._stream_evaluation = (item.version, self._registry_version, item._get_route_set(), kwargs_key, best_plugin)
 
-        for route in sorted(item.routes, key=lambda x:x.get('priority', 0), reverse=True):
-            handler = self.registry.get(route['handler'])
-            if not handler or not handler['can_stream']:
-                continue
+        if best_plugin is None:
+            return None
+
+        return best_plugin.stream()
 
+    def _evaluate_streamers(self, item, kwargs):
+        """
+        Returns the streamer with the best evaluation and if
+        all streamers were evaluated before the timeout.
+        """
+        plugins = []
+        for route, handler in self._get_dispatch_routes(item, 'can_stream'):
             logger.debug('Found streaming plugin with handler %s args %r, evaluating' % (route['handler'], route['kwargs']))
             route_kwargs = dict(kwargs)
             route_kwargs.update(route['kwargs'])
-            plugin = handler['handler'](item, **route_kwargs)
+            plugins.append((route['handler'], handler['handler'](item, **route_kwargs)))
 
-            evaluation = plugin.evaluate()
-            logger.debug('Evaluated with %s to %s' % (route['handler'], evaluation))
+        if not plugins:
+            return None, True
+
+        with self._lock:
+            if self._evaluate_executor is None:
+                self._evaluate_executor = DaemonThreadPool(self.evaluate_workers, name='evaluate')
+            executor = self._evaluate_executor
+
+        futures = [executor.submit(self._timed_evaluate, handler_id, plugin) for handler_id, plugin in plugins]
+        done, not_done = wait(futures, timeout=self.evaluate_timeout)
+        executor.abandon(not_done)
+
+        # use evaluate to find the best one
+        best_evaluation = -1
+        best_plugin = None
+
+        for (handler_id, plugin), future in zip(plugins, futures):
+            if future not in done:
+                logger.warning('Streamer %s did not finish evaluating within %s seconds, skipping' % (handler_id, self.evaluate_timeout))
+                self._record_stats('evaluate', handler_id, timeouts=1)
+                continue
+
+            evaluation = future.result()
             if evaluation is None:
                 continue
 
@@ -125,28 +454,453 @@ class Router(object):
                 best_evaluation = evaluation
                 best_plugin = plugin
 
-        if best_plugin is None:
-            return None
+        return best_plugin, not not_done
+
+    def _timed_evaluate(self, handler_id, plugin):
+        start_time = time.time()
+        evaluation = plugin.evaluate()
+        duration = time.time() - start_time
+        logger.debug('Evaluated with %s to %s in %.3f seconds' % (handler_id, evaluation, duration))
+        self._record_stats('evaluate', handler_id, calls=1, duration=duration)
+        return evaluation
+
+    def _record_stats(self, kind, handler_id, calls=0, timeouts=0, duration=0.0):
+        with self._lock:
+            handler_stats = self._stats[kind].setdefault(handler_id, {
+                'calls': 0,
+                'timeouts': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+            })
+            handler_stats['calls'] += calls
+            handler_stats['timeouts'] += timeouts
+            handler_stats['total_time'] += duration
+            handler_stats['max_time'] = max(handler_stats['max_time'], duration)
+
+    @property
+    def stats(self):
+        """Number of calls, timeouts and time spent per handler and list pool usage"""
+        with self._lock:
+            stats = {kind: {handler_id: dict(handler_stats) for (handler_id, handler_stats) in kind_stats.items()}
+                     for (kind, kind_stats) in self._stats.items()}
+            stats['list_cache'] = dict(self._list_cache_stats, entries=len(self._list_cache))
+            stats['list_pool'] = {
+                'workers': self.list_workers,
+                'running': self._list_running,
+                'queued': self._list_queued,
+                'peak_queued': self._list_peak_queued,
+                'abandoned': self._list_executor.abandoned if self._list_executor else 0,
+            }
+            return stats
+
+class ListingFlight(object):
+    """A listing in progress that other listings of the same path wait for"""
+    def __init__(self):
+        self.event = Event()
+        self.result = None
 
-        return best_plugin.stream()
 
 router = Router()
 
 
+def _detached_copy(item):
+    """
+    Duplicates item and copies the items right below it right away. The listed
+    items are moved into other trees where changes to them would not reach item,
+    the items further down are copied when they are changed like with duplicate.
+    """
+    copied_item = item.duplicate(clear_routes=False)
+    copied_item.nested_items
+    return copied_item
+
+
+def _list_cache_key(value):
+    """Makes a hashable key from list kwargs, items in them are identified by their path"""
+    if isinstance(value, Item):
+        return (Item, value.path)
+    elif isinstance(value, dict):
+        return tuple(sorted((k, _list_cache_key(v)) for (k, v) in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_list_cache_key(v) for v in value)
+
+    hash(value)
+    return value
+
+
+def _id_key(item):
+    return item.id
+
+
+def _name_key(item):
+    return item.id.lower()
+
+_max_merge_keys = frozenset(['date', 'modified', 'size'])
+
+_list_lock_lock = Lock()
+_nested_source_lock = Lock()
+_copies_lock = Lock()
+_list_worker_state = local()
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError('Routes are shared between items and cannot be changed')
+
+
+class FrozenDict(dict):
+    """A dict in route kwargs that cannot be changed"""
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), ))
+
+
+class FrozenList(list):
+    """A list in route kwargs that cannot be changed"""
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = sort = reverse = _readonly
+
+    def __reduce__(self):
+        return (self.__class__, (list(self), ))
+
+
+class Route(dict):
+    """
+    A route that can be shared between items and must not be changed,
+    equal shared routes are the same object. The kwargs are copied so
+    later changes to the dicts and lists passed in are not seen.
+    """
+    __slots__ = ('__weakref__', 'shared')
+
+    def __init__(self, route, shared=False):
+        dict.__init__(self, route)
+        if 'kwargs' in self:
+            dict.__setitem__(self, 'kwargs', _frozen_copy(self['kwargs']))
+        self.shared = shared
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+def _frozen_copy(value):
+    """Copies the dicts and lists in value to ones that cannot be changed, other values are kept"""
+    value_type = type(value)
+    if value_type is dict or value_type is FrozenDict:
+        return FrozenDict((k, _frozen_copy(v)) for (k, v) in value.items())
+    elif value_type is list or value_type is FrozenList:
+        return FrozenList(_frozen_copy(v) for v in value)
+    elif value_type is tuple:
+        return tuple(_frozen_copy(v) for v in value)
+
+    return value
+
+
+def _thawed_copy(value):
+    """Copies the dicts and lists in value to ones that can be changed"""
+    value_type = type(value)
+    if value_type is dict or value_type is FrozenDict:
+        return dict((k, _thawed_copy(v)) for (k, v) in value.items())
+    elif value_type is list or value_type is FrozenList:
+        return [_thawed_copy(v) for v in value]
+    elif value_type is tuple:
+        return tuple(_thawed_copy(v) for v in value)
+
+    return value
+
+
+def _freeze(value):
+    """
+    Makes a key from a route, types are part of the key so
+    e.g. a list and a tuple or True and 1 are not the same.
+    """
+    value_type = type(value)
+    if value_type is dict or value_type is FrozenDict or value_type is Route:
+        return (dict, tuple(sorted((k, _freeze(v)) for (k, v) in value.items())))
+    elif value_type is list or value_type is FrozenList:
+        return (list, tuple(_freeze(v) for v in value))
+    elif value_type is tuple:
+        return (tuple, tuple(_freeze(v) for v in value))
+
+    hash(value)
+    return (value_type, value)
+
+
+def _copy_route(route):
+    """A plain copy of a route that can be changed without changing the shared route"""
+    route = dict(route)
+    route['kwargs'] = _thawed_copy(route['kwargs'])
+    return route
+
+
+class RouteSet(object):
+    """
+    The routes of one or more items, dispatch holds the routes
+    ordered for each router that has used them.
+    """
+    __slots__ = ('routes', 'dispatch', '_shared_route_ids', '__weakref__')
+
+    def __init__(self, routes):
+        self.routes = tuple(routes)
+        self.dispatch = {}
+        self._shared_route_ids = None
+
+    @property
+    def shared_route_ids(self):
+        if self._shared_route_ids is None:
+            self._shared_route_ids = frozenset(id(route) for route in self.routes if route.shared)
+        return self._shared_route_ids
+
+    @property
+    def is_unique(self):
+        """True if no route is in the set twice"""
+        return len(self.shared_route_ids) == len(self.routes)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __getitem__(self, index):
+        return self.routes[index]
+
+
+class RouteTable(object):
+    """
+    Makes items with equal routes share the same Route objects and
+    items with the same routes share the same RouteSet,
+    they are kept only as long as an item uses them.
+    """
+    def __init__(self):
+        self._routes = weakref.WeakValueDictionary()
+        self._route_sets = weakref.WeakValueDictionary()
+        self._lock = Lock()
+
+    def intern(self, route):
+        if isinstance(route, Route) and route.shared:
+            return route
+
+        try:
+            key = _freeze(route)
+        except TypeError: # kwargs with e.g. items cannot be shared
+            return route if isinstance(route, Route) else Route(route)
+
+        with self._lock:
+            shared_route = self._routes.get(key)
+            if shared_route is None:
+                shared_route = self._routes[key] = Route(route, shared=True)
+
+        return shared_route
+
+    def intern_routes(self, routes):
+        if type(routes) is RouteSet:
+            return routes
+
+        routes = [route if type(route) is Route and route.shared else self.intern(route) for route in routes]
+
+        # the RouteSet keeps its routes alive so their ids are not reused while it is in the table
+        key = tuple(id(route) for route in routes)
+        with self._lock:
+            route_set = self._route_sets.get(key)
+            if route_set is None:
+                route_set = self._route_sets[key] = RouteSet(routes)
+
+        return route_set
+
+    def __len__(self):
+        return len(self._routes)
+
+
+route_table = RouteTable()
+
+FLAG_READABLE = 1
+FLAG_EXPANDABLE = 2
+FLAG_STREAMABLE = 4
+
+
+def _intern_keys(attributes):
+    return dict((intern(k) if type(k) is str else k, v) for (k, v) in attributes.items())
+
+
+def _changes_nested_items(f):
+    def change_nested_items(self, *args):
+        self.item._prepare_write()
+        result = f(self, *args)
+        item = self.item
+        item._id_index = item._name_index = None
+        item.bump_version()
+        return result
+
+    change_nested_items.__name__ = f.__name__
+    return change_nested_items
+
+
+class NestedItems(list):
+    """
+    The nested items of an item, changing them drops the
+    indexes of the item and changes its version.
+    """
+    __slots__ = ('item', )
+
+    def __init__(self, item, nested_items=()):
+        list.__init__(self, nested_items)
+        self.item = item
+
+    __setitem__ = _changes_nested_items(list.__setitem__)
+    __delitem__ = _changes_nested_items(list.__delitem__)
+    __iadd__ = _changes_nested_items(list.__iadd__)
+    __imul__ = _changes_nested_items(list.__imul__)
+    append = _changes_nested_items(list.append)
+    extend = _changes_nested_items(list.extend)
+    insert = _changes_nested_items(list.insert)
+    pop = _changes_nested_items(list.pop)
+    remove = _changes_nested_items(list.remove)
+    sort = _changes_nested_items(list.sort)
+    reverse = _changes_nested_items(list.reverse)
+    if hasattr(list, 'clear'):
+        clear = _changes_nested_items(list.clear)
+    if hasattr(list, '__setslice__'):
+        __setslice__ = _changes_nested_items(list.__setslice__)
+        __delslice__ = _changes_nested_items(list.__delslice__)
+
+
+class NestedItemsCopy(object):
+    """
+    Copies the nested items of item when they are needed, or before
+    item or an item above it is changed.
+    """
+    def __init__(self, item, include_routes=True):
+        self.item = item
+        self.include_routes = include_routes
+
+    def create_nested_items(self):
+        return [nested_item._duplicate(self.include_routes) for nested_item in self.item._nested_items]
+
+    def without_routes(self):
+        return NestedItemsCopy(self.item, include_routes=False)
+
+
+def _writes(f):
+    def write(self, *args, **kwargs):
+        self._prepare_write()
+        return f(self, *args, **kwargs)
+
+    write.__name__ = f.__name__
+    return write
+
+
 class Item(dict):
-    parent_item = None
-    readable = False
-    expandable = False
-    streamable = False
-    nested_items = None
-    routes = None
-    _modified = None
+    __slots__ = ('id', 'router', 'parent_item', '_flags', '_routes', '_nested_items', '_nested_source',
+                 '_modified', '_id_index', '_name_index', '_version', '_stream_evaluation', '_list_lock',
+                 '_copies', '__dict__', '__weakref__')
 
     def __init__(self, id, router=router, attributes=None):
         self.id = id
         self.router = router
+        self.parent_item = None
+        self._flags = 0
+        self._routes = None
+        self._nested_items = None
+        self._nested_source = None
+        self._modified = None
+        self._id_index = None
+        self._name_index = None
+        self._version = 0
+        self._stream_evaluation = None
+        self._list_lock = None
+        self._copies = None
         if attributes is not None:
-            self.update(attributes)
+            self.update(_intern_keys(attributes))
+
+    def _get_flag(flag):
+        return lambda self: bool(self._flags & flag)
+
+    def _set_flag(flag):
+        def set_flag(self, value):
+            self._prepare_write()
+            if value:
+                self._flags |= flag
+            else:
+                self._flags &= ~flag
+        return set_flag
+
+    readable = property(_get_flag(FLAG_READABLE), _set_flag(FLAG_READABLE))
+    expandable = property(_get_flag(FLAG_EXPANDABLE), _set_flag(FLAG_EXPANDABLE))
+    streamable = property(_get_flag(FLAG_STREAMABLE), _set_flag(FLAG_STREAMABLE))
+    del _get_flag, _set_flag
+
+    __setitem__ = _writes(dict.__setitem__)
+    __delitem__ = _writes(dict.__delitem__)
+    clear = _writes(dict.clear)
+    pop = _writes(dict.pop)
+    popitem = _writes(dict.popitem)
+    setdefault = _writes(dict.setdefault)
+    update = _writes(dict.update)
+
+    def _prepare_write(self):
+        """
+        Duplicates that have not copied the nested items of this item or
+        an item above it yet copy them before anything is changed.
+        """
+        path = []
+        has_copies = False
+        item = self
+        while item is not None:
+            path.append(item)
+            has_copies = has_copies or item._copies is not None
+            item = item.parent_item
+
+        if has_copies:
+            # copying the nested items of an item adds copies to the items below it
+            for item in reversed(path):
+                item._copy_nested_items()
+
+    def _add_copy(self, item):
+        """item copies the nested items of this item when it needs them"""
+        with _copies_lock:
+            if self._copies is None:
+                self._copies = weakref.WeakValueDictionary()
+            self._copies[id(item)] = item
+
+    def _copy_nested_items(self):
+        with _copies_lock:
+            copies, self._copies = self._copies, None
+
+        if copies:
+            for item in list(copies.values()):
+                item._load_nested_source()
+
+    @property
+    def routes(self):
+        """
+        A list of route dicts. Routes are shared with other items
+        until they are first used through this property.
+        """
+        # the routes can be changed in place from here on
+        self._prepare_write()
+        if type(self._routes) is RouteSet:
+            self._routes = [_copy_route(route) for route in self._routes]
+
+        return self._routes
+
+    @routes.setter
+    def routes(self, routes):
+        self._prepare_write()
+        self._routes = routes
+        self.bump_version()
+
+    def _get_route_set(self):
+        """
+        Returns the routes as a RouteSet, routes used through the routes property
+        can have been changed in place and are looked up in the route table every time.
+        """
+        routes = self._routes
+        if routes is None or type(routes) is RouteSet:
+            return routes
+
+        return route_table.intern_routes(routes)
 
     @property
     def path(self):
@@ -155,6 +909,61 @@ class Item(dict):
         else:
             return self.id
 
+    @property
+    def nested_items(self):
+        if self._nested_source is not None:
+            self._load_nested_source()
+
+        return self._nested_items
+
+    @nested_items.setter
+    def nested_items(self, nested_items):
+        self._prepare_write()
+        self._set_nested_items(nested_items)
+        self.bump_version()
+
+    def _set_nested_items(self, nested_items):
+        """The nested items are copied to a list that drops the indexes when it is changed"""
+        self._nested_source = None
+        self._nested_items = None if nested_items is None else NestedItems(self, nested_items)
+        self._id_index = self._name_index = None
+
+    def _load_nested_source(self):
+        """
+        Nested items can be created when first used, _nested_source is then an
+        object with create_nested_items() returning them and without_routes()
+        returning a source creating them without routes.
+        """
+        with _nested_source_lock:
+            if self._nested_source is None:
+                return
+
+            nested_items = self._nested_source.create_nested_items()
+            for nested_item in nested_items:
+                nested_item.parent_item = self
+
+            self._nested_items = NestedItems(self, nested_items)
+            self._nested_source = None
+            self._id_index = self._name_index = None
+
+    @property
+    def _has_nested_items(self):
+        return self._nested_items is not None or self._nested_source is not None
+
+    @property
+    def version(self):
+        """
+        Changes every time nested items or routes are added, changed,
+        removed or merged anywhere below this item.
+        """
+        return self._version
+
+    def bump_version(self):
+        item = self
+        while item is not None:
+            item._version += 1
+            item = item.parent_item
+
     @property
     def modified(self):
         if not self._modified:
@@ -180,9 +989,13 @@ class Item(dict):
             self.nested_items = []
 
     def add_item(self, item):
+        # item can be moved here from another tree
+        item._prepare_write()
+        self._prepare_write()
         item.parent_item = self
         self.initiate_nested_items()
-        self.nested_items.append(item)
+        self._append_nested_item(item)
+        self.bump_version()
 
     def get_item_from_path(self, path):
         if path == self.id:
@@ -200,27 +1013,62 @@ class Item(dict):
         if not path:
             return self
 
-        nested_item = [x for x in self.nested_items if x.id == path[0]]
-        if not nested_item:
+        nested_item = self.get_id_index().get(path[0])
+        if nested_item is None:
             return None
-        nested_item = nested_item[0]
 
         if len(path) > 1:
             return nested_item.get_item_from_path(path)
         else:
             return nested_item
 
+    def get_id_index(self):
+        """
+        Returns a dict of id to nested item, if several items
+        have the same id the first one is used.
+        """
+        return self._get_index('_id_index', _id_key)
+
+    def get_name_index(self):
+        """
+        Returns a dict of lowercased id to nested item, if several items
+        have the same id the first one is used.
+        """
+        return self._get_index('_name_index', _name_key)
+
+    def _get_index(self, index_attr, key):
+        """
+        The indexes are kept up to date by add_item and merge and are rebuilt
+        after nested_items is replaced or changed by anything else.
+        """
+        nested_items = self.nested_items or []
+        index = getattr(self, index_attr)
+        if index is None:
+            index = {}
+            for item in nested_items:
+                index.setdefault(key(item), item)
+            setattr(self, index_attr, index)
+
+        return index
+
+    def _append_nested_item(self, item):
+        list.append(self.nested_items, item)
+        if self._id_index is not None:
+            self._id_index.setdefault(_id_key(item), item)
+        if self._name_index is not None:
+            self._name_index.setdefault(_name_key(item), item)
+
     @property
     def is_readable(self):
         return self.readable and 'size' in self
 
     @property
     def is_listable(self):
-        return self.expandable or self.nested_items is not None
+        return self.expandable or self._has_nested_items
 
     @property
     def is_expanded(self):
-        return self.nested_items is not None
+        return self._has_nested_items
 
     @property
     def is_streamable(self):
@@ -231,19 +1079,52 @@ class Item(dict):
             return None
 
         if self.nested_items is None:
-            self.nested_items = []
-            self.merge(self.router.list(self, **kwargs))
+            with self._get_list_lock():
+                if self.nested_items is None:
+                    # streamers and listings run in parallel, the result must be
+                    # complete before other threads can see it
+                    self.merge(self.router.list(self, **kwargs))
+                    if self.nested_items is None:
+                        self.nested_items = []
 
         return self.nested_items
 
+    def iter_list(self, **kwargs):
+        """
+        Yields the nested items while they are being listed, when done
+        they are merged into nested_items like with list.
+        """
+        if not self.is_listable:
+            return
+
+        if self.nested_items is not None:
+            for nested_item in self.nested_items:
+                yield nested_item
+            return
+
+        listed_item = self.duplicate(clear_routes=True, clear_nested=True)
+        listed_item.initiate_nested_items()
+        for nested_item in self.router.iter_list(self, **kwargs):
+            listed_item.nested_items.append(nested_item)
+            yield nested_item
+
+        with self._get_list_lock():
+            self.merge(listed_item)
+            if self.nested_items is None:
+                self.nested_items = []
+
+    def _get_list_lock(self):
+        with _list_lock_lock:
+            if self._list_lock is None:
+                self._list_lock = Lock()
+
+            return self._list_lock
+
     def add_route(self, handler, can_open, can_list, can_stream, priority=0, kwargs=None):
         if not (can_open == self.is_readable == True) and not (can_list == self.is_listable == True) and not (can_stream == self.is_streamable == True):
             return
 
-        if self.routes is None:
-            self.routes = []
-
-        self.routes.append({
+        route = route_table.intern({
             'handler': handler,
             'can_open': can_open,
             'can_list': can_list,
@@ -252,14 +1133,24 @@ class Item(dict):
             'kwargs': kwargs or {},
         })
 
-        self.deduplicate_routes()
+        self._prepare_write()
+        routes = self._get_route_set()
+        if not routes:
+            self._routes = route_table.intern_routes([route])
+        elif not route.shared or id(route) not in routes.shared_route_ids:
+            self._routes = route_table.intern_routes(routes.routes + (route, ))
+            self.deduplicate_routes()
+
+        self.bump_version()
 
     def remove_routes(self, handler=None, can_open=False, can_list=False, can_stream=False):
-        if not self.routes:
+        routes = self._get_route_set()
+        if not routes:
             return
 
+        self._prepare_write()
         new_routes = []
-        for route in self.routes:
+        for route in routes:
             if handler and route['handler'] == handler:
                 continue
 
@@ -274,73 +1165,165 @@ class Item(dict):
 
             new_routes.append(route)
 
-        self.routes = new_routes
+        self._routes = route_table.intern_routes(new_routes)
+        self.bump_version()
 
     def deduplicate_routes(self):
-        if not self.routes or len(self.routes) == 1:
+        routes = self._get_route_set()
+        if not routes or routes.is_unique:
+            self._routes = routes
             return
 
+        # equal shared routes are the same object, only routes that
+        # could not be shared have to be compared
+        seen_routes = set()
+        unshared_routes = []
         new_routes = []
-        for route in self.routes:
-            for new_route in new_routes:
-                for k, v in new_route.items():
-                    if route[k] != v:
-                        break
-                else:
-                    break
+        for route in routes:
+            if route.shared:
+                if id(route) in seen_routes:
+                    continue
+                seen_routes.add(id(route))
             else:
-                new_routes.append(route)
-
-        self.routes = new_routes
-
-    def merge(self, item):
-        if self.id != item.id:
-            return
+                if route in unshared_routes:
+                    continue
+                unshared_routes.append(route)
 
-        key_skiplist = ['date', 'modified', 'size']
-        for key, value in item.items():
-            if key in key_skiplist:
-                continue
-
-            if key not in self or not self[key]:
-                self[key] = value
-            elif isinstance(self[key], dict) and isinstance(value, dict):
-                self[key].update(value)
-            elif isinstance(self[key], list) and isinstance(value, list):
-                self[key] += value
+            new_routes.append(route)
 
-        for key in key_skiplist:
-            if key not in self and key not in item:
+        if len(new_routes) == len(routes):
+            self._routes = routes
+        else:
+            self._prepare_write()
+            self._routes = route_table.intern_routes(new_routes)
+
+    def merge(self, *items):
+        """
+        Merges one or more items with the same id, and everything below them,
+        into this item. The tree is walked without recursion and
+        every level is only indexed once no matter how many items are merged.
+        """
+        # the items below the merged items are moved into this tree, so
+        # duplicates copy from them before they are out of reach
+        self._prepare_write()
+        for item in items:
+            item._prepare_write()
+
+        merges = [(self, items)]
+        while merges:
+            target_item, items = merges.pop()
+            items = [item for item in items if item.id == target_item.id and item is not target_item]
+            if not items:
                 continue
 
-            self[key] = max(self.get(key, 0), item.get(key, 0))
-
-        if not self.routes and item.routes:
-            self.routes = item.routes
-        elif self.routes and item.routes:
-            self.routes += item.routes
-
-        self.deduplicate_routes()
-
-        self.expandable = self.expandable or item.expandable
-        self.readable = self.readable or item.readable
-        self.streamable = self.streamable or item.streamable
-
-        if not self.nested_items and item.nested_items:
-            self.nested_items = item.nested_items
-        elif self.nested_items and item.nested_items:
-            self_keys = {x.id: x for x in self.nested_items}
-            item_keys = {x.id: x for x in item.nested_items}
+            target_item._copy_nested_items()
+            for item in items:
+                item._copy_nested_items()
+            target_item._merge_fields(items)
+
+            # with several items, nested items with routes and nothing below are
+            # merged in pairs, so their routes are combined half as many times
+            pair_merges = {} if len(items) > 1 else None
+            pending_merges = {}
+            for item in items:
+                nested_items = item.nested_items
+                if not nested_items:
+                    continue
+
+                if not target_item.nested_items:
+                    target_item._set_nested_items(nested_items)
+                    continue
+
+                target_index = target_item.get_id_index()
+                for nested_item in nested_items:
+                    target_nested_item = target_index.get(nested_item.id)
+                    if target_nested_item is None:
+                        target_item._append_nested_item(nested_item)
+                    elif target_nested_item is nested_item:
+                        continue
+                    elif nested_item._nested_items is not None or nested_item._nested_source is not None:
+                        pending_merges.setdefault(id(target_nested_item), (target_nested_item, []))[1].append(nested_item)
+                    elif pair_merges is None or not (nested_item._routes or nested_item.id in pair_merges):
+                        target_nested_item._merge_fields((nested_item, ))
+                        target_nested_item._version += 1
+                    else:
+                        paired_item = pair_merges.pop(nested_item.id, None)
+                        if paired_item is None:
+                            pair_merges[nested_item.id] = nested_item
+                        else:
+                            target_nested_item._merge_fields((paired_item, nested_item))
+                            target_nested_item._version += 1
+
+            if pair_merges:
+                target_index = target_item.get_id_index()
+                for nested_id, nested_item in pair_merges.items():
+                    target_nested_item = target_index[nested_id]
+                    target_nested_item._merge_fields((nested_item, ))
+                    target_nested_item._version += 1
+
+            merges.extend(pending_merges.values())
+
+            if target_item.nested_items:
+                for nested_item in target_item.nested_items:
+                    nested_item.parent_item = target_item
+
+            target_item._version += 1
+
+        self.bump_version()
+
+    def _merge_fields(self, items):
+        """
+        Merges the attributes, routes and flags of items into this item. Dict
+        and list attributes are merged into new values as the old ones can be
+        shared with duplicates, a new value is made once for all the items.
+        """
+        merged_keys = None
+        route_sets = None
+        for item in items:
+            for key, value in item.items():
+                self_value = self.get(key)
+                if key in _max_merge_keys:
+                    if self_value is None:
+                        dict.__setitem__(self, key, max(0, value))
+                    elif value > self_value:
+                        dict.__setitem__(self, key, value)
+                elif not self_value:
+                    dict.__setitem__(self, key, value)
+                    if merged_keys:
+                        merged_keys.discard(key)
+                elif isinstance(self_value, dict) and isinstance(value, dict):
+                    if merged_keys is None or key not in merged_keys:
+                        self_value = self_value.copy()
+                        dict.__setitem__(self, key, self_value)
+                        merged_keys = merged_keys or set()
+                        merged_keys.add(key)
+                    self_value.update(value)
+                elif isinstance(self_value, list) and isinstance(value, list):
+                    if merged_keys is None or key not in merged_keys:
+                        dict.__setitem__(self, key, self_value + value)
+                        merged_keys = merged_keys or set()
+                        merged_keys.add(key)
+                    else:
+                        self_value.extend(value)
+
+            if item._routes:
+                if route_sets is None:
+                    route_sets = [item._get_route_set()]
+                else:
+                    route_sets.append(item._get_route_set())
 
-            for key in set(item_keys.keys()) - set(self_keys.keys()):
-                self.nested_items.append(item_keys[key])
+            self._flags |= item._flags
 
-            for key in set(item_keys.keys()) & set(self_keys.keys()):
-                self_keys[key].merge(item_keys[key])
+        if route_sets is not None:
+            routes = self._get_route_set()
+            if not routes and len(route_sets) == 1:
+                self._routes = route_sets[0]
+            else:
+                if routes:
+                    route_sets.insert(0, routes)
+                self._routes = route_table.intern_routes([route for routes in route_sets for route in routes])
 
-        if self.nested_items:
-            for nested_item in self.nested_items:
-                nested_item.parent_item = self
+            self.deduplicate_routes()
 
     def serialize(self, include_routes=False, include_nested=True):
         retval = {
@@ -357,7 +1340,7 @@ class Item(dict):
             retval['nested_items'] = None
 
         if include_routes:
-            retval['routes'] = self.routes or []
+            retval['routes'] = [_copy_route(route) for route in self._get_route_set() or []]
 
         return retval
 
@@ -382,9 +1365,9 @@ class Item(dict):
             item.streamable = True
             need_routes = True
 
-        item.update(data['attributes'])
+        item.update(_intern_keys(data['attributes']))
         if data.get('routes'):
-            item.routes = data['routes']
+            item._routes = route_table.intern_routes(data['routes'])
 
         elif need_routes and routes:
             for route in routes:
@@ -393,14 +1376,31 @@ class Item(dict):
         return item
 
     def duplicate(self, clear_routes=True, clear_nested=False):
-        item = self.__class__.unserialize(self.serialize(include_routes=(not clear_routes)), router=self.router)
+        """
+        The nested items are not copied until the nested items of the duplicate
+        are first used, or the original or an item above it is about to be changed.
+        """
+        item = self._duplicate(not clear_routes, include_nested=not clear_nested)
         if clear_routes:
-            item.expandable = False
-            item.readable = False
-            item.streamable = False
+            item._flags = 0
+
+        return item
+
+    def _duplicate(self, include_routes, include_nested=True):
+        item = self.__class__(self.id, router=self.router)
+        item._flags = self._flags
+        dict.update(item, ((k, v) for (k, v) in self.items() if not k.startswith('_')))
+        if include_routes:
+            item._routes = self._get_route_set() or None
+
+        if include_nested and self._has_nested_items:
+            nested_source = self._nested_source
+            if nested_source is None:
+                nested_source = NestedItemsCopy(self)
 
-        if clear_nested:
-            item.nested_items = None
+            item._nested_source = nested_source if include_routes else nested_source.without_routes()
+            if isinstance(nested_source, NestedItemsCopy):
+                nested_source.item._add_copy(item)
 
         return item
 
@@ -433,7 +1433,8 @@ class Item(dict):
         if self.nested_items != other.nested_items:
             return False
 
-        if self.routes != other.routes:
+        routes, other_routes = self._get_route_set(), other._get_route_set()
+        if (routes is None) != (other_routes is None) or (routes is not None and routes.routes != other_routes.routes):
             return False
 
         return dict.__eq__(self, other)
@@ -2,6 +2,7 @@ import logging
 import mimetypes
 import os
 
+from ..fdpool import fd_pool, pread
 from ..plugin import InputBase
 
 logger = logging.getLogger(__name__)
@@ -10,11 +11,13 @@ logger = logging.getLogger(__name__)
 class FileInput(InputBase):
     plugin_name = 'file'
     protocols = ['file']
-    _open_file = None
+    _entry = None
+    _pos = 0
 
-    def __init__(self, item, path):
+    def __init__(self, item, path, pool=None):
         self.item = item
         self.path = path
+        self.pool = pool or fd_pool
         self.size, self.filename, self.content_type = self.get_info()
 
     def get_info(self):
@@ -26,26 +29,32 @@ class FileInput(InputBase):
 
     def seek(self, pos, whence=0):
         logger.debug('Seeking to %s' % (pos, ))
-        if not self._open_file:
-            self._open_file = open(self.path, 'rb')
+        if not self._entry:
+            self._entry = self.pool.acquire(self.path)
 
-        self._open_file.seek(pos, whence)
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+
+        self._pos = max(pos, 0)
 
     def read(self, num_bytes=1024 * 8):
-        if not self._open_file:
+        if not self._entry:
             self.seek(0)
 
-        d = self._open_file.read(num_bytes)
+        d = pread(self._entry, num_bytes, self._pos)
+        self._pos += len(d)
         return d
 
     def tell(self):
-        return self._open_file.tell()
+        return self._pos
 
     def close(self):
-        if self._open_file:
+        if self._entry:
             logger.debug('Closing file')
-            self._open_file.close()
-        self._open_file = None
+            self.pool.release(self._entry)
+        self._entry = None
 
     def get_read_items(self):
         return [self.item]
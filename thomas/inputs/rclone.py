@@ -1,57 +1,305 @@
+import atexit
+import calendar
+import json
 import logging
 import mimetypes
 import os
+import re
 import subprocess
+import time
 
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+from six.moves import queue
+
+from ..filesystem import Item
+from ..piece import *
 from ..plugin import InputBase
 
 logger = logging.getLogger(__name__)
 
 
+def rclone_execute(cmd, args, rclone_path=None, config_path=None):
+    full_cmd = [
+        rclone_path or 'rclone',
+        cmd,
+        '--fast-list',
+    ]
+
+    if config_path:
+        full_cmd += ['--config', config_path]
+
+    full_cmd += args
+
+    return subprocess.Popen(full_cmd, stdout=subprocess.PIPE, bufsize=-1)
+
+
+def terminate_process(process):
+    if process.poll() is None:
+        process.terminate()
+    process.wait()
+    process.stdout.close()
+
+
+class RCloneProcessPool(object):
+    """
+    Keeps idle `rclone cat` processes around so a reader that wants to
+    continue at, or a little before, where another reader stopped does not
+    have to pay for a process start and a remote open.
+
+    Offsets that are requested more than once get a process pre-spawned
+    so the next request for them starts warm.
+
+    Processes idle for more than max_idle_time seconds are terminated by
+    a reaper thread that runs while the pool has idle processes.
+    """
+    def __init__(self, max_processes=4, max_idle_time=60, recent_offset_count=16):
+        self.max_processes = max_processes
+        self.max_idle_time = max_idle_time
+        self.recent_offset_count = recent_offset_count
+        self._processes = []
+        self._recent_offsets = OrderedDict()
+        self._lock = Lock()
+        self._reaper = None
+
+        self.hits = 0
+        self.misses = 0
+        self.prespawns = 0
+
+    def _purge(self):
+        now = time.time()
+        processes = []
+        for entry in self._processes:
+            key, pos, process, idle_since = entry
+            if process.poll() is None and now - idle_since < self.max_idle_time:
+                processes.append(entry)
+            else:
+                terminate_process(process)
+        self._processes = processes
+
+    def _find(self, key, pos, max_skip):
+        best_entry = None
+        for entry in self._processes:
+            if entry[0] != key or not (pos - max_skip <= entry[1] <= pos):
+                continue
+
+            if best_entry is None or entry[1] > best_entry[1]:
+                best_entry = entry
+
+        return best_entry
+
+    def acquire(self, key, pos, max_skip, spawn):
+        """
+        Returns a process and its position, either an idle one at most
+        max_skip bytes before pos or a new one created with spawn(pos).
+        """
+        with self._lock:
+            self._purge()
+            entry = self._find(key, pos, max_skip)
+            if entry:
+                self._processes.remove(entry)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            offset_key = (key, pos)
+            is_recent = self._recent_offsets.pop(offset_key, False)
+            self._recent_offsets[offset_key] = True
+            while len(self._recent_offsets) > self.recent_offset_count:
+                self._recent_offsets.popitem(last=False)
+
+            should_prespawn = is_recent and self._find(key, pos, 0) is None
+            if should_prespawn:
+                self.prespawns += 1
+
+        if entry:
+            process, process_pos = entry[2], entry[1]
+        else:
+            process, process_pos = spawn(pos), pos
+
+        if should_prespawn:
+            logger.debug('Pre-spawning rclone process for %r at %i' % (key, pos))
+            self.release(key, pos, spawn(pos))
+
+        return process, process_pos
+
+    def release(self, key, pos, process):
+        """Give a process, positioned at pos, back to the pool"""
+        with self._lock:
+            self._processes.append((key, pos, process, time.time()))
+            self._purge()
+            while len(self._processes) > self.max_processes:
+                terminate_process(self._processes.pop(0)[2])
+
+            if self._reaper is None and self._processes:
+                self._reaper = Thread(target=self._reap, name='rclone-reaper')
+                self._reaper.daemon = True
+                self._reaper.start()
+
+    def _reap(self):
+        while True:
+            with self._lock:
+                self._purge()
+                if not self._processes:
+                    self._reaper = None
+                    return
+
+                next_purge = min(entry[3] for entry in self._processes) + self.max_idle_time
+
+            time.sleep(max(0.01, next_purge - time.time()))
+
+    def clear(self):
+        with self._lock:
+            for entry in self._processes:
+                terminate_process(entry[2])
+            self._processes = []
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'idle': len(self._processes),
+                'hits': self.hits,
+                'misses': self.misses,
+                'prespawns': self.prespawns,
+            }
+
+
+process_pool = RCloneProcessPool()
+atexit.register(process_pool.clear)
+
+
 class RCloneInput(InputBase):
     plugin_name = 'rclone'
     protocols = ['rclone']
     _open_file = None
     _pos = None
 
-    def __init__(self, item, path, size, rclone_path=None, config_path=None):
+    current_piece = None
+    pieces = None
+    finished = False
+
+    def __init__(self, item, path, size, rclone_path=None, config_path=None,
+                 segments=0, buffer_size=5, piece_config=None, max_skip_size=1024 * 1024,
+                 pool=None):
+        """
+        If segments is set, the file is fetched in pieces by that many
+        parallel rclone processes, buffer_size pieces per segment ahead
+        of the reader.
+
+        Otherwise a single rclone process is read. Seeking up to
+        max_skip_size bytes forward reads and discards from it, further
+        seeks take a process from the process pool or start a new one.
+        """
         self.item = item
         self.path = path
         self.size = size
         self._rclone_path = rclone_path
         self._config_path = config_path
+        self.segments = segments
+        self.buffer_size = buffer_size * segments
+        self.piece_config = piece_config
+        self.max_skip_size = max_skip_size
+        self.pool = pool or process_pool
+        self.downloaders = []
         self.filename, self.content_type = self.get_info()
 
     def _rclone_execute(self, cmd, *args):
-        full_cmd = [
-            self._rclone_path or 'rclone',
-            cmd,
-            '--fast-list',
-        ]
-
-        if self._config_path:
-            full_cmd += ['--config', self._config_path]
-
-        full_cmd += args
-
-        return subprocess.Popen(full_cmd, stdout=subprocess.PIPE, bufsize=-1)
+        return rclone_execute(cmd, args, self._rclone_path, self._config_path)
 
     def get_info(self):
         logger.info('Getting info about %r' % (self.path, ))
         content_type = mimetypes.guess_type(self.path)[0] or 'bytes'
         return os.path.basename(self.path), content_type
 
+    @property
+    def _process_key(self):
+        return (self._rclone_path, self._config_path, self.path)
+
+    def _spawn_cat(self, pos):
+        return self._rclone_execute('cat', self.path, '--offset', str(pos))
+
     def seek(self, pos, whence=0):
         logger.debug('Seeking to %s' % (pos, ))
+        if whence == os.SEEK_END:
+            pos = self.size - pos
+        elif whence == os.SEEK_CUR:
+            pos += self._pos or 0
+
+        if self.segments:
+            self._seek_segmented(pos)
+            return
+
+        if self._open_file and self._pos <= pos <= self._pos + self.max_skip_size:
+            self._skip(pos - self._pos)
+            return
+
+        self._release_open_file()
+        self._open_file, self._pos = self.pool.acquire(self._process_key, pos,
+                                                       self.max_skip_size, self._spawn_cat)
+        self._skip(pos - self._pos)
+
+    def _skip(self, num_bytes):
+        if num_bytes:
+            logger.debug('Skipping %i bytes forward' % (num_bytes, ))
+
+        while num_bytes > 0:
+            d = self._open_file.stdout.read(min(num_bytes, 1024 * 64))
+            if not d:
+                break
+            num_bytes -= len(d)
+            self._pos += len(d)
+
+    def _release_open_file(self):
         if not self._open_file:
-            if whence == os.SEEK_SET or whence == os.SEEK_CUR:
-                self._pos = pos
-                self._open_file = self._rclone_execute('cat', self.path, '--offset', str(pos))
-            elif whence == os.SEEK_END:
-                self._pos = self.size - pos
-                self._open_file = self._rclone_execute('cat', self.path, '--tail', str(pos))
+            return
+
+        if self._pos < self.size and self._open_file.poll() is None:
+            self.pool.release(self._process_key, self._pos, self._open_file)
+        else:
+            terminate_process(self._open_file)
+        self._open_file = None
+
+    def _seek_segmented(self, pos):
+        self._stop_downloaders()
+        self._pos = pos
+        self.current_piece = None
+        self.finished = pos >= self.size
+        if self.finished:
+            self.pieces = []
+            return
+
+        if self.piece_config:
+            piece_size = calc_piece_size(self.size, **self.piece_config)
+        else:
+            piece_size = None
+
+        self.pieces = create_pieces(self.size, self.segments, piece_size=piece_size, start_position=pos)
+        q = queue.Queue()
+        for piece in self.pieces:
+            q.put(piece)
+
+        for i in range(min(self.segments, len(self.pieces))):
+            d = RCloneDownloader(i, self, q)
+            pdt = Thread(target=d.start)
+            pdt.daemon = True
+            pdt.start()
+            d.thread = pdt
+            self.downloaders.append(d)
+        self.set_current_piece()
+
+    def set_current_piece(self):
+        for piece in self.pieces[:self.buffer_size]:
+            piece.can_download.set()
+
+        if self.pieces:
+            self.current_piece = self.pieces.pop(0)
 
     def read(self, num_bytes=1024 * 8):
+        if self.segments:
+            return self._read_segmented(num_bytes)
+
         if not self._open_file:
             self.seek(0)
 
@@ -59,15 +307,311 @@ class RCloneInput(InputBase):
         self._pos += len(d)
         return d
 
+    def _read_segmented(self, num_bytes):
+        if self.pieces is None:
+            self.seek(0)
+
+        if self.finished:
+            return b''
+
+        d = self.current_piece.read(num_bytes)
+        if not d:
+            self.set_current_piece()
+            d = self.current_piece.read(num_bytes)
+
+            if not d:
+                self.finished = True
+
+        self._pos += len(d)
+        return d
+
     def tell(self):
         return self._pos
 
+    def _stop_downloaders(self):
+        for downloader in self.downloaders:
+            downloader.stop()
+
+        for downloader in self.downloaders:
+            downloader.thread.join(5)
+        self.downloaders = []
+
     def close(self):
+        self._stop_downloaders()
         if self._open_file:
             logger.debug('Closing file')
-            self._open_file.terminate()
-            self._open_file.wait()
-        self._open_file = None
+            self._release_open_file()
 
     def get_read_items(self):
         return [self.item]
+
+
+class RCloneDownloader(object):
+    """
+    Fetches pieces from a piece queue, each with its own
+    `rclone cat --offset --count` process.
+
+    A piece that ends early is continued from where it stopped, up to
+    piece_attempts times, before it is marked as failed.
+    """
+    piece = None
+    process = None
+    piece_attempts = 3
+
+    def __init__(self, name, rclone_input, piece_queue):
+        self.name = name
+        self.rclone_input = rclone_input
+        self.piece_queue = piece_queue
+        self.should_die = Event()
+
+    def start(self):
+        logger.info('Starting rclone downloader %s' % (self.name, ))
+        while not self.should_die.is_set():
+            try:
+                piece = self.piece_queue.get_nowait()
+            except queue.Empty:
+                logger.info('Piece queue empty %s, bailing' % (self.name, ))
+                break
+
+            self.piece = piece
+            while not piece.can_download.wait(2):
+                logger.debug('Waiting for piece %r to be downloadable' % (piece, ))
+                if self.should_die.is_set():
+                    return
+
+            if self.should_die.is_set():
+                break
+
+            logger.debug('Starting to fetch piece: %r' % piece)
+            bytes_left = piece.size
+            for attempt in range(self.piece_attempts):
+                if attempt:
+                    logger.warning('End of data before end of piece %r, retrying the last %i bytes' % (piece, bytes_left))
+                bytes_left = self._fetch(piece, piece.end_byte - bytes_left, bytes_left)
+                if not bytes_left or self.should_die.is_set():
+                    break
+
+            if bytes_left and not self.should_die.is_set():
+                logger.error('End of data before end of piece %r, giving up' % (piece, ))
+                piece.set_failed()
+            else:
+                piece.set_complete()
+                logger.debug('Done fetching piece: %r' % piece)
+        logger.info('Rclone downloader %s dying' % (self.name, ))
+
+    def _fetch(self, piece, start_byte, bytes_left):
+        """Writes bytes_left bytes from start_byte into piece, returns how many are still missing"""
+        process = self.process = self.rclone_input._rclone_execute('cat', self.rclone_input.path,
+                                                                   '--offset', str(start_byte),
+                                                                   '--count', str(bytes_left))
+        try:
+            while bytes_left > 0 and not self.should_die.is_set():
+                d = process.stdout.read(min(bytes_left, 8196 * 2))
+                if not d:
+                    break
+
+                piece.write(d)
+                bytes_left -= len(d)
+        finally:
+            self.process = None
+            terminate_process(process)
+
+        return bytes_left
+
+    def stop(self):
+        logger.info('Stopping %s' % (self.name, ))
+        self.should_die.set()
+        if self.piece:
+            self.piece.can_download.set()
+
+        process = self.process
+        if process and process.poll() is None:
+            process.terminate()
+
+
+MODTIME_RE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$')
+
+
+def parse_modtime(modtime):
+    """Turn an rclone RFC3339 timestamp into a unix timestamp"""
+    m = MODTIME_RE.match(modtime or '')
+    if not m:
+        return 0
+
+    year, month, day, hour, minute, second, _, tz = m.groups()
+    timestamp = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+    if tz and tz != 'Z':
+        offset = int(tz[1:3]) * 3600 + int(tz[4:6]) * 60
+        if tz[0] == '+':
+            timestamp -= offset
+        else:
+            timestamp += offset
+
+    return timestamp
+
+
+def join_remote_path(path, name):
+    if not path or path.endswith(':') or path.endswith('/'):
+        return path + name
+    return '%s/%s' % (path, name)
+
+
+class CachedListing(object):
+    def __init__(self, entries, fetched_at):
+        self.entries = entries
+        self.fetched_at = fetched_at
+        self.verified_at = fetched_at
+
+    def is_fresh(self, now, cache_ttl, max_age):
+        return now - self.verified_at < cache_ttl and now - self.fetched_at < max_age
+
+
+class RCloneLister(object):
+    """
+    List handler that turns `rclone lsjson` output into Items.
+
+    Listings are cached per directory. When a directory is listed again
+    after its cache has expired, subtrees of subdirectories that rclone
+    reports with the same modification time and size keep their cached
+    listings, the others are dropped and listed again when needed. As not every backend
+    bubbles changes up through directory modification times, a cached
+    listing is never used for longer than max_age.
+
+    With recursive set, the whole tree is fetched with one `lsjson -R`
+    and returned fully expanded.
+    """
+    def __init__(self):
+        self._cache = {}
+        self._lock = Lock()
+
+    def __call__(self, item, path, rclone_path=None, config_path=None, recursive=False,
+                 cache_ttl=300, max_age=None):
+        if max_age is None:
+            max_age = cache_ttl * 10
+
+        cache_key = (rclone_path, config_path)
+        listing_kwargs = {
+            'rclone_path': rclone_path,
+            'config_path': config_path,
+            'recursive': recursive,
+            'cache_ttl': cache_ttl,
+            'max_age': max_age,
+        }
+
+        entries = self._get_entries(cache_key, path, listing_kwargs)
+        for nested_item in self._build_items(item.router, cache_key, path, entries, listing_kwargs):
+            item.add_item(nested_item)
+
+        if item.nested_items is None:
+            item.nested_items = []
+
+        return item
+
+    def _lsjson(self, path, rclone_path, config_path, recursive):
+        args = [path]
+        if recursive:
+            args.append('-R')
+
+        logger.debug('Listing %r with rclone, recursive:%s' % (path, recursive))
+        process = rclone_execute('lsjson', args, rclone_path, config_path)
+        output = process.stdout.read()
+        process.stdout.close()
+        if process.wait() != 0:
+            raise IOError('rclone lsjson failed for %r with exit code %s' % (path, process.returncode))
+
+        return json.loads(output.decode('utf-8'))
+
+    def _get_entries(self, cache_key, path, listing_kwargs):
+        now = time.time()
+        with self._lock:
+            listing = self._cache.get(cache_key + (path, ))
+
+        if listing and listing.is_fresh(now, listing_kwargs['cache_ttl'], listing_kwargs['max_age']):
+            return listing.entries
+
+        recursive = listing_kwargs['recursive'] and not listing
+        result = self._lsjson(path, listing_kwargs['rclone_path'], listing_kwargs['config_path'], recursive)
+
+        if recursive:
+            listings = {path: []}
+            for entry in result:
+                entry_path = entry['Path']
+                parent_path = entry_path.rsplit('/', 1)[0] if '/' in entry_path else ''
+                listings.setdefault(join_remote_path(path, parent_path) if parent_path else path, []).append(entry)
+                if entry['IsDir']:
+                    listings.setdefault(join_remote_path(path, entry_path), [])
+        else:
+            listings = {path: result}
+
+        with self._lock:
+            if listing:
+                self._invalidate_changed(cache_key, path, listing.entries, listings[path], now)
+
+            for listing_path, entries in listings.items():
+                self._cache[cache_key + (listing_path, )] = CachedListing(entries, now)
+
+        return listings[path]
+
+    def _invalidate_changed(self, cache_key, path, old_entries, new_entries, now):
+        old_dirs = {entry['Name']: entry for entry in old_entries if entry['IsDir']}
+        new_dirs = {entry['Name']: entry for entry in new_entries if entry['IsDir']}
+
+        for name, old_entry in old_dirs.items():
+            sub_path = join_remote_path(path, name)
+            new_entry = new_dirs.get(name)
+            is_unchanged = new_entry and (new_entry.get('ModTime'), new_entry.get('Size')) == (old_entry.get('ModTime'), old_entry.get('Size'))
+            if not is_unchanged:
+                logger.debug('Directory %r changed, dropping cached listings' % (sub_path, ))
+
+            sub_path_prefix = sub_path + '/'
+            for key in list(self._cache.keys()):
+                if key[:2] == cache_key and (key[2] == sub_path or key[2].startswith(sub_path_prefix)):
+                    if is_unchanged:
+                        self._cache[key].verified_at = now
+                    else:
+                        del self._cache[key]
+
+    def _build_items(self, router, cache_key, path, entries, listing_kwargs):
+        route_kwargs = {k: v for (k, v) in listing_kwargs.items() if v is not None and k in ('rclone_path', 'config_path')}
+        for entry in entries:
+            entry_path = join_remote_path(path, entry['Name'])
+            item = Item(id=entry['Name'], router=router, attributes={
+                'modified': parse_modtime(entry.get('ModTime')),
+            })
+
+            if entry['IsDir']:
+                item.expandable = True
+                kwargs = dict(listing_kwargs, path=entry_path)
+                item.add_route('rclone_list', False, True, False, kwargs=kwargs)
+
+                if listing_kwargs['recursive']:
+                    with self._lock:
+                        listing = self._cache.get(cache_key + (entry_path, ))
+
+                    if listing and listing.is_fresh(time.time(), listing_kwargs['cache_ttl'], listing_kwargs['max_age']):
+                        for nested_item in self._build_items(router, cache_key, entry_path, listing.entries, listing_kwargs):
+                            item.add_item(nested_item)
+                        if item.nested_items is None:
+                            item.nested_items = []
+            else:
+                item['size'] = entry['Size']
+                item.readable = True
+                kwargs = dict(route_kwargs, path=entry_path, size=entry['Size'])
+                item.add_route('rclone', True, False, False, kwargs=kwargs)
+
+            yield item
+
+    def invalidate(self, path=None):
+        """Drop cached listings for path and everything below it, or everything"""
+        with self._lock:
+            if path is None:
+                self._cache.clear()
+                return
+
+            path_prefix = path.rstrip('/') + '/'
+            for key in list(self._cache.keys()):
+                if key[2] == path or key[2].startswith(path_prefix):
+                    del self._cache[key]
+
+
+rclone_lister = RCloneLister()
@@ -73,11 +73,17 @@ class Piece(object):
         self.can_download = Event()
         self.is_complete = Event()
         self.last_piece = False
+        self.failed = False
         self.data_lock = Lock()
 
     def set_complete(self):
         self.is_complete.set()
 
+    def set_failed(self):
+        """The piece could not be fully fetched, reading past its data raises IOError"""
+        self.failed = True
+        self.is_complete.set()
+
     @property
     def size(self):
         return self.end_byte - self.start_byte
@@ -101,9 +107,18 @@ class Piece(object):
                 with self.data_lock:
                     d = self.data.read(num_bytes)
 
-                if d or self.is_complete.is_set():
+                if d:
                     return d
 
+                if self.is_complete.is_set():
+                    break
+
                 self.is_complete.wait(0.1)
-        else:
-            return self.data.read(num_bytes)
\ No newline at end of file
+
+        with self.data_lock:
+            d = self.data.read(num_bytes)
+
+        if not d and self.failed:
+            raise IOError('Piece %r could not be fetched' % (self, ))
+
+        return d
\ No newline at end of file
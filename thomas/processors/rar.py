@@ -1,5 +1,13 @@
+import copy
+import hashlib
+import json
 import logging
 import mimetypes
+import os
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import rarfile
 
@@ -11,45 +19,196 @@ logger = logging.getLogger(__name__)
 POTENTIAL_RAR_ENDARC_SIZE = 20
 
 
+def _volume_identity(item):
+    return (item.path, item.get('size'))
+
+
+class RarLayoutInfo(object):
+    """The parts of a RarInfo needed to stream a lazily read file"""
+    def __init__(self, layout):
+        self.filename = layout['filename']
+        self.file_size = layout['file_size']
+        self.compress_size = layout['compress_size']
+
+
+class RarIndexCache(object):
+    """
+    Remembers the layout of lazily read RAR sets, i.e. where the file data
+    is in every volume, so a set can be opened again without reading any
+    headers. Layouts are kept in memory and, if a cache path is given, as
+    JSON sidecar files that survive restarts.
+
+    A layout is only used if all its volumes are still found with
+    the same names and sizes.
+    """
+    version = 1
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._layouts = OrderedDict()
+        self._lock = Lock()
+
+    def _key(self, entry_item):
+        return _volume_identity(entry_item)
+
+    def _sidecar_path(self, cache_path, key):
+        key_hash = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(cache_path, 'rar-%s.json' % (key_hash, ))
+
+    def _remember(self, key, layout):
+        with self._lock:
+            self._layouts.pop(key, None)
+            self._layouts[key] = layout
+            while len(self._layouts) > self.max_entries:
+                self._layouts.popitem(last=False)
+
+    def get(self, filesystem, entry_item, cache_path=None):
+        """Returns the layout and volume items for entry_item or None"""
+        key = self._key(entry_item)
+        with self._lock:
+            layout = self._layouts.get(key)
+
+        if layout is None and cache_path:
+            sidecar_path = self._sidecar_path(cache_path, key)
+            try:
+                with open(sidecar_path, 'r') as f:
+                    layout = json.load(f)
+            except (IOError, OSError, ValueError):
+                layout = None
+
+            if layout is not None and layout.get('version') != self.version:
+                layout = None
+
+        if layout is None:
+            return None
+
+        volume_items = []
+        for volume in layout['volumes']:
+            item = _get_item_from_filename(filesystem, volume['id'])
+            if item is None or item.get('size') != volume['size']:
+                logger.debug('Cached RAR layout for %r does not match volume %r' % (entry_item.id, volume['id']))
+                return None
+            volume_items.append(item)
+
+        self._remember(key, layout)
+        return layout, volume_items
+
+    def set(self, entry_item, layout, cache_path=None):
+        key = self._key(entry_item)
+        layout = dict(layout, version=self.version)
+        self._remember(key, layout)
+
+        if cache_path:
+            sidecar_path = self._sidecar_path(cache_path, key)
+            try:
+                tmp_path = '%s.%s.tmp' % (sidecar_path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(layout, f)
+                os.rename(tmp_path, sidecar_path)
+            except (IOError, OSError):
+                logger.exception('Failed to write RAR layout sidecar %r' % (sidecar_path, ))
+
+    def clear(self):
+        with self._lock:
+            self._layouts.clear()
+
+
+rar_index_cache = RarIndexCache()
+
+
+class RarMetadataCache(object):
+    """
+    Keeps parsed RAR archives, i.e. file headers, volume chain and data
+    offsets, so a new stream of the same set only has to open the data
+    instead of parsing every volume header again.
+
+    Only the parsed headers are kept, the archive is bound to the
+    filesystem given to get, so it never reads volumes from, or keeps
+    alive, the tree it was parsed from.
+
+    An archive is only reused if all its volumes are still found with
+    the same paths and sizes.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._archives = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, filesystem, entry_item):
+        key = _volume_identity(entry_item)
+        with self._lock:
+            archive = self._archives.get(key)
+
+        if archive is None:
+            return None
+
+        vrf, volumes = archive
+        for volume_id, identity in volumes:
+            item = _get_item_from_filename(filesystem, volume_id)
+            if item is None or _volume_identity(item) != identity:
+                logger.debug('Cached RAR archive for %r does not match volume %r' % (entry_item.id, volume_id))
+                with self._lock:
+                    self._archives.pop(key, None)
+                return None
+
+        with self._lock:
+            if key in self._archives:
+                self._archives[key] = self._archives.pop(key)
+
+        return vrf.bind(filesystem)
+
+    def set(self, entry_item, vrf, volume_items):
+        key = _volume_identity(entry_item)
+        volumes = [(item.id, _volume_identity(item)) for item in volume_items]
+        vrf = vrf.detach()
+        with self._lock:
+            self._archives.pop(key, None)
+            self._archives[key] = (vrf, volumes)
+            while len(self._archives) > self.max_entries:
+                self._archives.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._archives.clear()
+
+
+rar_metadata_cache = RarMetadataCache()
+
+
 class RarProcessor(ProcessorBase, dict):
     plugin_name = 'rar'
 
-    def __init__(self, filesystem, entry_item, lazy=False):
+    def __init__(self, filesystem, entry_item, lazy=False, preopen_lookahead=None, index_cache_path=None,
+                 probe_workers=None):
+        """
+        With lazy, the file data is read directly from the volumes. The layout
+        of the volumes is cached, also in index_cache_path if set, so
+        opening the same set again does not read anything.
+
+        Lazy reading normally assumes the volumes are aligned. With probe_workers,
+        the headers of all volumes are instead read with that many threads
+        and the exact layout is used, so any set of stored volumes works.
+        """
         self.filesystem = filesystem
         self.entry_item = entry_item
         self.lazy = lazy
+        self.probe_workers = probe_workers
         self._read_items = []
 
         if lazy:
-            fd = entry_item.open()
-            ver = _get_rar_version(fd)
-
-            if ver == 5:
-                f.read(1)
-                parser = VirtualRAR5Parser(filesystem, None, None, None, None, None, None)
-                parser._main = parser._parse_header(fd)
-                has_recovery = bool(parser._main.flags & rarfile.RAR5_MAIN_FLAG_RECOVERY)
-            elif ver == 3:
-                parser = VirtualRAR3Parser(filesystem, None, None, None, None, None, None, None)
-                parser._main = parser._parse_header(fd)
-                has_recovery = bool(parser._main.flags & rarfile.RAR_MAIN_RECOVERY)
+            cached_layout = rar_index_cache.get(filesystem, entry_item, index_cache_path)
+            if cached_layout:
+                layout, volume_items = cached_layout
+            elif probe_workers:
+                layout, volume_items = self._create_probed_layout()
+                rar_index_cache.set(entry_item, layout, index_cache_path)
             else:
-                raise IOError('Not a valid RAR file header sig')
+                layout, volume_items = self._create_lazy_layout()
+                rar_index_cache.set(entry_item, layout, index_cache_path)
 
-            # TODO: verify rar5 stuff
-
-            filemap = [parser._get_item_from_filename(entry_item.id)]
-            filename = entry_item.id
-            while True:
-                item = parser._next_volname_to_item(filename)
-                if not item:
-                    break
-                filename = item.id
-                filemap.append(item)
-
-            self.infofile = infofile = parser._parse_header(fd)
+            self.infofile = infofile = RarLayoutInfo(layout)
         else:
-            vrf = VirtualRarFile(entry_item.open(), filesystem=filesystem)
+            vrf = self._get_virtual_rar_file()
             self.infofile = infofile = vrf.infolist()[0]
 
         self['size'] = self.size = infofile.file_size
@@ -57,55 +216,135 @@ class RarProcessor(ProcessorBase, dict):
         self.content_type = mimetypes.guess_type(self.filename)[0] or 'bytes'
 
         if lazy:
-            header_offset = fd.tell()
-            fd.close()
-            tail_offset = infofile.compress_size + header_offset
-            tail_size = entry_item['size'] - tail_offset
-            total_archive_size = sum(item['size'] for item in filemap)
-
-            total_size = 0
             file_elements = []
-            size = tail_offset - header_offset
-            for item in filemap[:-1]:
-                total_size += size
+            for volume, item in zip(layout['volumes'], volume_items):
                 file_elements.append({
-                    'read_size': size,
-                    'seek': header_offset,
+                    'read_size': volume['read_size'],
+                    'seek': volume['seek'],
                     'item': item,
                 })
                 self._read_items.append(item)
 
-            item = filemap[-1]
-            size = infofile.file_size - total_size
-            file_elements.append({
+            virtualfile_processor_cls = ProcessorBase.find_plugin('virtualfile')
+            virtualfile_item = Item(id=self.filename)
+            self.virtualfile = virtualfile_processor_cls(virtualfile_item, file_elements,
+                                                         preopen_lookahead=preopen_lookahead)
+
+    def _create_lazy_layout(self):
+        """
+        Reads the headers of the first volume and calculates where the
+        file data is in every volume, assuming they are aligned.
+        """
+        filesystem, entry_item = self.filesystem, self.entry_item
+        fd = entry_item.open()
+        try:
+            ver = _get_rar_version(fd)
+            parser = _create_header_parser(filesystem, ver, fd)
+            if ver == 5:
+                has_recovery = bool(parser._main.main_flags & rarfile.RAR5_MAIN_FLAG_RECOVERY)
+            else:
+                has_recovery = bool(parser._main.flags & rarfile.RAR_MAIN_RECOVERY)
+
+            # TODO: verify rar5 stuff
+
+            filemap = [parser._get_item_from_filename(entry_item.id)] + _find_volume_items(parser, entry_item)[1:]
+
+            infofile = parser._parse_header(fd)
+            header_offset = fd.tell()
+        finally:
+            fd.close()
+
+        tail_offset = infofile.compress_size + header_offset
+        tail_size = entry_item['size'] - tail_offset
+        total_archive_size = sum(item['size'] for item in filemap)
+
+        total_size = 0
+        volumes = []
+        size = tail_offset - header_offset
+        for item in filemap[:-1]:
+            total_size += size
+            volumes.append({
+                'id': item.id,
+                'size': item['size'],
                 'read_size': size,
                 'seek': header_offset,
-                'item': item,
             })
-            self._read_items.append(item)
-
-            if has_recovery:
-                first_recovery_record_percentage = (float(entry_item['size'] - tail_offset) / float(entry_item['size'] - POTENTIAL_RAR_ENDARC_SIZE - header_offset))
-                recovery_record_size = item['size'] - size - POTENTIAL_RAR_ENDARC_SIZE
-                recovery_record_percentage = float(recovery_record_size) / float(item['size'] - POTENTIAL_RAR_ENDARC_SIZE - header_offset)
-                diff = ((abs(first_recovery_record_percentage - recovery_record_percentage) /
-                       (first_recovery_record_percentage + recovery_record_percentage)) / 2) * 100
-                if diff > 10 and abs(first_recovery_record_percentage - recovery_record_percentage) > 10000:
-                    raise IOError('Recovery record alignment failed')
-            else:
-                if total_archive_size != infofile.file_size + (header_offset + tail_size) * len(filemap):
-                    raise IOError('RARFile archives not aligned proper for lazy reading')
 
-            virtualfile_processor_cls = ProcessorBase.find_plugin('virtualfile')
-            virtualfile_item = Item(id=self.filename)
-            self.virtualfile = virtualfile_processor_cls(virtualfile_item, file_elements)
+        item = filemap[-1]
+        size = infofile.file_size - total_size
+        volumes.append({
+            'id': item.id,
+            'size': item['size'],
+            'read_size': size,
+            'seek': header_offset,
+        })
+
+        if has_recovery:
+            first_recovery_record_percentage = (float(entry_item['size'] - tail_offset) / float(entry_item['size'] - POTENTIAL_RAR_ENDARC_SIZE - header_offset))
+            recovery_record_size = item['size'] - size - POTENTIAL_RAR_ENDARC_SIZE
+            recovery_record_percentage = float(recovery_record_size) / float(item['size'] - POTENTIAL_RAR_ENDARC_SIZE - header_offset)
+            diff = ((abs(first_recovery_record_percentage - recovery_record_percentage) /
+                   (first_recovery_record_percentage + recovery_record_percentage)) / 2) * 100
+            if diff > 10 and abs(first_recovery_record_percentage - recovery_record_percentage) > 10000:
+                raise IOError('Recovery record alignment failed')
+        else:
+            if total_archive_size != infofile.file_size + (header_offset + tail_size) * len(filemap):
+                raise IOError('RARFile archives not aligned proper for lazy reading')
+
+        layout = {
+            'filename': infofile.filename,
+            'file_size': infofile.file_size,
+            'compress_size': infofile.compress_size,
+            'volumes': volumes,
+        }
+        return layout, filemap
+
+    def _create_probed_layout(self):
+        """
+        Reads the headers of all volumes and uses where the data of the
+        first file actually is.
+        """
+        volumes = _scan_volume_set(self.filesystem, self.entry_item, self.probe_workers)
+        first_file_headers = [file_header for _, file_headers in volumes for file_header in file_headers]
+        if not first_file_headers:
+            raise IOError('No files found in RAR set')
+
+        filename = first_file_headers[0]['filename']
+        layouts = build_member_layouts(volumes)
+        if not layouts or layouts[0]['filename'] != filename:
+            raise IOError('The first file in the RAR set cannot be read lazily')
+
+        member_layout = layouts[0]
+        layout = {
+            'filename': filename,
+            'file_size': member_layout['file_size'],
+            'compress_size': member_layout['file_size'],
+            'volumes': [{k: v for (k, v) in volume.items() if k != 'item'} for volume in member_layout['volumes']],
+        }
+        return layout, [volume['item'] for volume in member_layout['volumes']]
+
+    def _get_virtual_rar_file(self):
+        vrf = rar_metadata_cache.get(self.filesystem, self.entry_item)
+        if vrf is None:
+            vrf = VirtualRarFile(self.entry_item.open(), filesystem=self.filesystem)
+
+            volume_items = [self.entry_item]
+            for _ in vrf.volumelist()[1:]:
+                item = vrf._file_parser._next_volname_to_item(volume_items[-1].id)
+                if item is None:
+                    break
+                volume_items.append(item)
+
+            rar_metadata_cache.set(self.entry_item, vrf, volume_items)
+
+        return vrf
 
     def open(self):
         if self.lazy:
             return self.virtualfile.open()
         else:
-            vrf = VirtualRarFile(self.entry_item.open(), filesystem=self.filesystem)
-            return RarProcessorFile(vrf, vrf.infolist()[0])
+            vrf = self._get_virtual_rar_file()
+            return RarProcessorFile(vrf, vrf.infolist()[0], self.entry_item)
 
     @property
     def id(self):
@@ -115,17 +354,190 @@ class RarProcessor(ProcessorBase, dict):
         return self._read_items
 
 
+def _create_header_parser(filesystem, ver, fd):
+    """
+    Creates a parser that can read headers from fd and resolve volume names,
+    fd must be positioned right after the signature.
+    """
+    if ver == 5:
+        parser = VirtualRAR5Parser(filesystem, None, None, None, None, None, None, None)
+    elif ver == 3:
+        parser = VirtualRAR3Parser(filesystem, None, None, None, None, None, None, None)
+    else:
+        raise IOError('Not a valid RAR file header sig')
+
+    parser._main = parser._parse_header(fd)
+    return parser
+
+
+def _is_header_type(header, rar3_type, rar5_type):
+    return getattr(header, 'type', None) == rar3_type or getattr(header, 'block_type', None) == rar5_type
+
+
+def _scan_volume(filesystem, volume_item):
+    """
+    Reads all headers in a volume, returns the parser and a list
+    of the file headers with where their data is in the volume.
+    """
+    fd = volume_item.open()
+    try:
+        parser = _create_header_parser(filesystem, _get_rar_version(fd), fd)
+
+        file_headers = []
+        while True:
+            header = parser._parse_header(fd)
+            if not header or _is_header_type(header, rarfile.RAR_BLOCK_ENDARC, rarfile.RAR5_BLOCK_ENDARC):
+                break
+
+            data_offset = fd.tell()
+            if _is_header_type(header, rarfile.RAR_BLOCK_FILE, rarfile.RAR5_BLOCK_FILE):
+                file_headers.append({
+                    'filename': header.filename,
+                    'file_size': header.file_size,
+                    'stored': header.compress_type == rarfile.RAR_M0,
+                    'encrypted': header.needs_password(),
+                    'is_dir': header.isdir(),
+                    'split_before': bool(header.flags & rarfile.RAR_FILE_SPLIT_BEFORE),
+                    'seek': data_offset,
+                    'read_size': header.add_size,
+                })
+
+            if header.add_size:
+                fd.seek(data_offset + header.add_size)
+    finally:
+        fd.close()
+
+    return parser, file_headers
+
+
+def _find_volume_items(parser, entry_item):
+    volume_items = [entry_item]
+    while True:
+        item = parser._next_volname_to_item(volume_items[-1].id)
+        if not item:
+            break
+        volume_items.append(item)
+
+    return volume_items
+
+
+def _scan_volume_set(filesystem, entry_item, max_workers):
+    """
+    Scans the first volume to learn the volume naming, then scans the
+    remaining volumes with at most max_workers at a time.
+    """
+    parser, file_headers = _scan_volume(filesystem, entry_item)
+    volume_items = _find_volume_items(parser, entry_item)[1:]
+
+    volumes = [(entry_item, file_headers)]
+    if volume_items:
+        executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(volume_items))))
+        try:
+            scanned_volumes = executor.map(lambda volume_item: _scan_volume(filesystem, volume_item)[1], volume_items)
+            volumes += list(zip(volume_items, scanned_volumes))
+        finally:
+            executor.shutdown(wait=True)
+
+    logger.debug('Scanned %i volumes starting with %r' % (len(volumes), entry_item.id))
+    return volumes
+
+
+def build_member_layouts(volumes):
+    """
+    Combines the scanned file headers of each volume, given as a list of
+    (volume item, file headers), into a layout for every stored file.
+
+    Compressed, encrypted and directory entries are skipped as they
+    cannot be read directly from the volumes.
+    """
+    members = []
+    current_member = None
+    for item, file_headers in volumes:
+        for file_header in file_headers:
+            if not file_header['split_before'] or current_member is None or current_member['filename'] != file_header['filename']:
+                current_member = dict(file_header, volumes=[])
+                members.append(current_member)
+
+            current_member['volumes'].append({
+                'id': item.id,
+                'size': item['size'],
+                'read_size': file_header['read_size'],
+                'seek': file_header['seek'],
+                'item': item,
+            })
+
+    layouts = []
+    for member in members:
+        if not member['stored'] or member['encrypted'] or member['is_dir']:
+            continue
+
+        if sum(volume['read_size'] for volume in member['volumes']) != member['file_size']:
+            logger.debug('Size of %r does not match its data in the volumes, skipping' % (member['filename'], ))
+            continue
+
+        layouts.append({
+            'filename': member['filename'],
+            'file_size': member['file_size'],
+            'volumes': member['volumes'],
+        })
+
+    return layouts
+
+
+def list_rar_members(item, filesystem, entry_id, probe_workers=8):
+    """
+    List handler that exposes every stored file in the RAR set starting
+    with entry_id in filesystem. Each file is readable
+    directly from the volumes without decompression.
+
+    The volume headers are read with probe_workers threads.
+    """
+    entry_item = _get_item_from_filename(filesystem, entry_id)
+    if entry_item is None:
+        raise IOError('Unable to find RAR volume %r' % (entry_id, ))
+
+    item.initiate_nested_items()
+    for layout in build_member_layouts(_scan_volume_set(filesystem, entry_item, probe_workers)):
+        path = layout['filename'].replace('\\', '/').split('/')
+        parent_item = item
+        for name in path[:-1]:
+            directory_item = parent_item.get_name_index().get(name.lower())
+            if directory_item is None:
+                directory_item = Item(id=name, router=item.router)
+                directory_item.initiate_nested_items()
+                parent_item.add_item(directory_item)
+            parent_item = directory_item
+
+        member_item = Item(id=path[-1], router=item.router, attributes={'size': layout['file_size']})
+        member_item.readable = True
+        file_elements = [{
+            'item': volume['item'],
+            'seek': volume['seek'],
+            'read_size': volume['read_size'],
+        } for volume in layout['volumes']]
+        member_item.add_route('virtualfile', True, False, False, kwargs={'file_elements': file_elements})
+        parent_item.add_item(member_item)
+
+    return item
+
+
 class RarProcessorFile(object):
     _open_file = None
 
-    def __init__(self, vrf, infofile):
+    def __init__(self, vrf, infofile, entry_item):
         self.vrf = vrf
         self.infofile = infofile
+        self.entry_item = entry_item
 
     def seek(self, pos):
         logger.debug('Seeking to %s' % (pos, ))
+        if self._open_file and pos < self._open_file.tell():
+            # seeking back starts over from the first volume, which is closed
+            # once reading has moved on to the next volume
+            self.close()
+
         if not self._open_file:
-            self._open_file = self.vrf.open(self.infofile)
+            self._open_file = self.vrf.open_with_volume(self.infofile, self.entry_item.open())
 
         self._open_file.seek(pos)
 
@@ -136,7 +548,9 @@ class RarProcessorFile(object):
         return self._open_file.read(num_bytes)
 
     def close(self):
-        self._open_file.close()
+        if self._open_file:
+            self._open_file.close()
+        self._open_file = None
 
 
 class BetterXFile(rarfile.XFile):
@@ -207,15 +621,16 @@ class VirtualDirectReader(rarfile.DirectReader):
             raise rarfile.BadRarFile("Failed the read enough data")
 
 
+def _get_item_from_filename(filesystem, filename):
+    filesystem.list()
+    return filesystem.get_name_index().get(filename.lower()) # TODO: exception?
+
+
 class VirtualCommonParser(object):
     _direct_reader = VirtualDirectReader
 
     def _get_item_from_filename(self, filename):
-        items = [item for item in self._filesystem.list() if item.id.lower() == filename.lower()]
-        if not items:
-            return None # TODO: exception?
-
-        return items[0]
+        return _get_item_from_filename(self._filesystem, filename)
 
     def _next_volname_to_item(self, filename):
         if self._main.flags & rarfile.RAR_MAIN_NEWNUMBERING:
@@ -250,6 +665,15 @@ class VirtualRAR5Parser(VirtualCommonParser, rarfile.RAR5Parser):
         super(VirtualRAR5Parser, self).__init__(*args, **kwargs)
 
 
+def _detach_header(header):
+    if header is None:
+        return None
+
+    header = copy.copy(header)
+    header.volume_file = None
+    return header
+
+
 class VirtualRarFile(rarfile.RarFile):
     _rar3parser = VirtualRAR3Parser
     _rar5parser = VirtualRAR5Parser
@@ -277,3 +701,42 @@ class VirtualRarFile(rarfile.RarFile):
 
         self._file_parser.parse()
         self.comment = self._file_parser.comment
+
+    def detach(self):
+        """
+        Returns a copy with only the parsed headers, without the filesystem
+        and the volume files opened while parsing. It must be bound before use.
+        """
+        vrf = copy.copy(self)
+        vrf._filesystem = vrf._rarfile = None
+
+        parser = vrf._file_parser = copy.copy(self._file_parser)
+        parser._filesystem = parser._rarfile = parser._rarfile_xfile = parser._fd = None
+        parser._vol_list = []
+        parser._main = _detach_header(parser._main)
+        detached_infos = {}
+        for inf in parser._info_list:
+            detached_infos[id(inf)] = _detach_header(inf)
+        parser._info_list = [detached_infos[id(inf)] for inf in parser._info_list]
+        parser._info_map = dict((name, detached_infos.get(id(inf), inf)) for (name, inf) in parser._info_map.items())
+
+        return vrf
+
+    def bind(self, filesystem):
+        """Returns a copy of a detached archive that reads its volumes from filesystem"""
+        vrf = copy.copy(self)
+        vrf._filesystem = filesystem
+
+        parser = vrf._file_parser = copy.copy(self._file_parser)
+        parser._filesystem = filesystem
+
+        return vrf
+
+    def open_with_volume(self, inf, volume_file):
+        """
+        Open a member reading its first volume from volume_file, the parsed
+        archive is left untouched so it can be shared between streams.
+        """
+        inf = copy.copy(inf)
+        inf.volume_file = volume_file
+        return self._file_parser.open(inf, None)
@@ -1,14 +1,57 @@
 import logging
+import os
+import time
+
+from bisect import bisect_right
+from threading import Condition, Event, Lock, Thread
+
+from six.moves import queue
 
 from ..plugin import ProcessorBase
 
 logger = logging.getLogger(__name__)
 
 
+def calculate_element_offsets(file_elements):
+    """
+    Returns where each file element starts in the virtual file.
+    """
+    offsets = []
+    pos = 0
+    for file_element in file_elements:
+        offsets.append(pos)
+        pos += file_element['read_size']
+
+    return offsets
+
+
+def coalesce_file_elements(file_elements):
+    """
+    Merges adjacent elements that read contiguous bytes from
+    the same item and drops empty elements.
+    """
+    coalesced_elements = []
+    for file_element in file_elements:
+        if not file_element['read_size']:
+            continue
+
+        if coalesced_elements:
+            last_element = coalesced_elements[-1]
+            if (last_element['item'] is file_element['item'] and
+                    last_element['seek'] + last_element['read_size'] == file_element['seek']):
+                last_element['read_size'] += file_element['read_size']
+                continue
+
+        coalesced_elements.append(dict(file_element))
+
+    return coalesced_elements
+
+
 class VirtualFileProcessor(ProcessorBase, dict):
     plugin_name = 'virtualfile'
 
-    def __init__(self, item, file_elements):
+    def __init__(self, item, file_elements, preopen_lookahead=None, parallel_elements=None,
+                 piece_size=1024 * 1024, buffer_pieces=4, read_timeout=None):
         """
         A single file element is a dictionary with the following keys
         {
@@ -16,63 +59,230 @@ class VirtualFileProcessor(ProcessorBase, dict):
             "seek": Where to seek to on open
             "item": A normal Item that can be opened and read
         }
+
+        If preopen_lookahead is set, the next element is opened in the background
+        and its first preopen_lookahead bytes are read when the reader gets
+        that close to the end of the current element.
+
+        If parallel_elements is set, that many upcoming elements are read
+        at the same time in pieces of piece_size, with at most buffer_pieces
+        pieces per element waiting for the reader. Reading fails if no data
+        comes within read_timeout seconds.
+
+        Adjacent elements reading contiguous bytes of the same item are merged.
         """
-        self.file_elements = file_elements
+        self.file_elements = file_elements = coalesce_file_elements(file_elements)
         self.item = item
+        self.preopen_lookahead = preopen_lookahead
+        self.parallel_elements = parallel_elements
+        self.piece_size = piece_size
+        self.buffer_pieces = buffer_pieces
+        self.read_timeout = read_timeout
+        self.element_offsets = calculate_element_offsets(file_elements)
         self['size'] = sum(x['read_size'] for x in file_elements)
 
     def open(self):
-        return VirtualFileProcessorFile(self.item, self.file_elements, self['size'])
+        if self.parallel_elements:
+            return ParallelVirtualFileProcessorFile(self.item, self.file_elements, self['size'],
+                                                    self.parallel_elements, self.piece_size, self.buffer_pieces,
+                                                    element_offsets=self.element_offsets,
+                                                    read_timeout=self.read_timeout)
+
+        return VirtualFileProcessorFile(self.item, self.file_elements, self['size'],
+                                        element_offsets=self.element_offsets,
+                                        preopen_lookahead=self.preopen_lookahead)
+
+    @property
+    def id(self):
+        return self.item.id
+
+    def get_read_items(self):
+        read_items = []
+        for file_element in self.file_elements:
+            if not read_items or read_items[-1] is not file_element['item']:
+                read_items.append(file_element['item'])
+
+        return read_items
+
+
+def open_virtualfile(item, file_elements, **kwargs):
+    """
+    Open handler for items that are backed by parts of other items,
+    the route kwargs are passed on to VirtualFileProcessor.
+    """
+    return VirtualFileProcessor(item, file_elements, **kwargs).open()
+
+
+class ElementPrefetcher(object):
+    """
+    Opens a file element in a thread and reads the beginning of it.
+    """
+    open_file = None
+
+    def __init__(self, index, file_element, readahead_size):
+        self.index = index
+        self.file_element = file_element
+        self.readahead_size = min(readahead_size, file_element['read_size'])
+        self.data = b''
+        self.done = Event()
+        self.cancelled = False
+        self._lock = Lock()
+
+        self.thread = Thread(target=self._prefetch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _prefetch(self):
+        logger.debug('Pre-opening element %i' % (self.index, ))
+        open_file = None
+        try:
+            open_file = self.file_element['item'].open()
+            open_file.seek(self.file_element['seek'])
+
+            data = []
+            bytes_left = self.readahead_size
+            while bytes_left > 0 and not self.cancelled:
+                d = open_file.read(min(bytes_left, 1024 * 64))
+                if not d:
+                    break
+                data.append(d)
+                bytes_left -= len(d)
+            self.data = b''.join(data)
+        except Exception:
+            logger.exception('Failed to pre-open element %i' % (self.index, ))
+            if open_file:
+                open_file.close()
+            open_file = None
+        finally:
+            with self._lock:
+                if self.cancelled and open_file:
+                    open_file.close()
+                else:
+                    self.open_file = open_file
+                self.done.set()
+
+    def take(self):
+        """Wait for the element, returns the open file and data read or None if it failed"""
+        self.done.wait()
+        if self.open_file is None:
+            return None
+
+        return self.open_file, self.data
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self.open_file:
+                self.open_file.close()
+                self.open_file = None
 
 
 class VirtualFileProcessorFile(object):
     _pos = None
     _open_file = None
+    _open_index = None
     _bytes_read = None
-    _last_index = None
-    _last_file_element = None
+    _prefetcher = None
+    _buffer = b''
 
-    def __init__(self, item, file_elements, size):
+    def __init__(self, item, file_elements, size, element_offsets=None, preopen_lookahead=None):
         self.file_elements = file_elements
         self.filename = item.id
         self.size = size
+        if element_offsets is None:
+            element_offsets = calculate_element_offsets(file_elements)
+        self.element_offsets = element_offsets
+        self.preopen_lookahead = preopen_lookahead
+
+    def _find_index(self, pos):
+        """Binary search for the element containing pos, zero sized elements are skipped"""
+        return bisect_right(self.element_offsets, pos) - 1
 
     def seek(self, pos, whence=0):
         logger.debug('Seeking to %s' % (pos, ))
-        if self._pos is not None:
-            raise IOError('Unable to seek already sought file')
+        if whence == os.SEEK_CUR:
+            pos += self._pos or 0
+        elif whence == os.SEEK_END:
+            pos += self.size
+
+        if pos < 0:
+            raise IOError('Trying to seek to a negative position')
 
         self._pos = pos
 
+        if self._prefetcher and pos != self.element_offsets[self._prefetcher.index]:
+            self._cancel_prefetcher()
+
+        if not self._open_file:
+            return
+
+        if pos < self.size and self._find_index(pos) == self._open_index:
+            additional_seek = pos - self.element_offsets[self._open_index]
+            if additional_seek == self._bytes_read:
+                return
+
+            buffer_skip = additional_seek - self._bytes_read
+            if 0 < buffer_skip <= len(self._buffer):
+                self._buffer = self._buffer[buffer_skip:]
+                self._bytes_read = additional_seek
+                return
+
+            self._buffer = b''
+            logger.debug('Seeking within already open element %i' % (self._open_index, ))
+            try:
+                self._open_file.seek(self.file_elements[self._open_index]['seek'] + additional_seek)
+            except Exception:
+                logger.debug('Unable to seek open element, reopening it')
+            else:
+                self._bytes_read = additional_seek
+                return
+
+        self._close_open_file()
+
     def _open_next_file(self):
         if self._pos is None:
             self.seek(0)
 
         logger.debug('Opening next file from position %i' % (self._pos, ))
 
-        if self._last_index is None:
-            pos = self._pos
-            for i, file_element in enumerate(self.file_elements):
-                pos -= file_element['read_size']
-                if pos > 0:
-                    continue
+        if self._pos >= self.size:
+            raise IOError('Trying to read out of bounds')
 
-                additional_seek = file_element['read_size'] + pos
-                self._last_index = i
-                self._last_file_element = file_element
-                break
-            else:
-                raise IOError('Trying to read out of bounds')
-        else:
-            self._last_index += 1
-            self._last_file_element = self.file_elements[self._last_index]
-            additional_seek = 0
+        index = self._find_index(self._pos)
+        additional_seek = self._pos - self.element_offsets[index]
+
+        file_element = self.file_elements[index]
+        self._open_index = index
+        self._bytes_read = additional_seek
+
+        prefetcher, self._prefetcher = self._prefetcher, None
+        if prefetcher and prefetcher.index == index and additional_seek == 0:
+            prefetched = prefetcher.take()
+            if prefetched:
+                logger.debug('Using pre-opened element %i' % (index, ))
+                self._open_file, self._buffer = prefetched
+                return
+        elif prefetcher:
+            prefetcher.cancel()
 
-        file_element = self._last_file_element
         item = file_element['item']
         self._open_file = item.open() # TODO: add support for kwargs?
         self._open_file.seek(file_element['seek'] + additional_seek)
-        self._bytes_read = additional_seek
+
+    def _maybe_prefetch_next(self):
+        if self._prefetcher or self._open_index is None:
+            return
+
+        max_read_size = self.file_elements[self._open_index]['read_size']
+        if max_read_size - self._bytes_read > self.preopen_lookahead:
+            return
+
+        next_pos = self.element_offsets[self._open_index] + max_read_size
+        if next_pos >= self.size:
+            return
+
+        index = self._find_index(next_pos)
+        self._prefetcher = ElementPrefetcher(index, self.file_elements[index], self.preopen_lookahead)
 
     def read(self, num_bytes=1024 * 8):
         if self._pos is not None and self._pos >= self.size:
@@ -81,24 +291,255 @@ class VirtualFileProcessorFile(object):
         if not self._open_file:
             self._open_next_file()
 
-        file_element = self._last_file_element
-        max_read_size = file_element['read_size']
-        num_bytes = min(max_read_size, self._bytes_read + num_bytes) - self._bytes_read
-        self._bytes_read += num_bytes
-        self._pos += num_bytes
+        max_read_size = self.file_elements[self._open_index]['read_size']
+        num_bytes = min(max_read_size - self._bytes_read, num_bytes)
 
-        d = self._open_file.read(num_bytes)
-        if self._bytes_read == max_read_size:
-            self._open_file.close()
-            self._open_file = None
+        if self._buffer:
+            d, self._buffer = self._buffer[:num_bytes], self._buffer[num_bytes:]
+        else:
+            d = self._open_file.read(num_bytes)
+        self._bytes_read += len(d)
+        self._pos += len(d)
+
+        if self.preopen_lookahead:
+            self._maybe_prefetch_next()
+
+        if self._bytes_read >= max_read_size:
+            self._close_open_file()
 
         return d
 
     def tell(self):
         return self._pos
 
-    def close(self):
+    def _close_open_file(self):
         if self._open_file:
-            logger.debug('Closing file')
             self._open_file.close()
         self._open_file = None
+        self._open_index = None
+        self._buffer = b''
+
+    def _cancel_prefetcher(self):
+        if self._prefetcher:
+            self._prefetcher.cancel()
+        self._prefetcher = None
+
+    def close(self):
+        if self._open_file:
+            logger.debug('Closing file')
+        self._close_open_file()
+        self._cancel_prefetcher()
+
+
+class ParallelElementFetcher(object):
+    """
+    Reads elements from a starting position with a number of worker threads,
+    one element per worker at a time. Each element gets a bounded queue of
+    pieces and workers only start elements within parallel_elements
+    of the one being read, so the memory used stays bounded.
+    """
+    error = None
+
+    def __init__(self, file_elements, element_offsets, pos, parallel_elements, piece_size, buffer_pieces,
+                 read_timeout=None):
+        self.file_elements = file_elements
+        self.piece_size = piece_size
+        self.parallel_elements = parallel_elements
+        self.read_timeout = read_timeout
+        self.should_die = Event()
+        self.condition = Condition()
+
+        start_index = bisect_right(element_offsets, pos) - 1
+        self.element_queues = []
+        for index in range(start_index, len(file_elements)):
+            additional_seek = index == start_index and pos - element_offsets[index] or 0
+            self.element_queues.append((index, additional_seek, queue.Queue(buffer_pieces)))
+
+        self.next_element = 0
+        self.reading_element = 0
+
+        self.workers = []
+        for i in range(min(parallel_elements, len(self.element_queues))):
+            worker = Thread(target=self._worker, args=(i, ))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _take_element(self):
+        with self.condition:
+            while not self.should_die.is_set():
+                if self.next_element >= len(self.element_queues):
+                    return None
+
+                if self.next_element < self.reading_element + self.parallel_elements:
+                    element_number = self.next_element
+                    self.next_element += 1
+                    return self.element_queues[element_number]
+
+                self.condition.wait(1)
+
+    def _put(self, q, value):
+        while not self.should_die.is_set():
+            try:
+                q.put(value, timeout=1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _worker(self, name):
+        logger.debug('Starting element worker %s' % (name, ))
+        try:
+            self._read_elements()
+        except BaseException as e:
+            logger.exception('Element worker %s failed' % (name, ))
+            self.error = e
+        logger.debug('Element worker %s dying' % (name, ))
+
+    def _read_elements(self):
+        while True:
+            element = self._take_element()
+            if element is None:
+                break
+
+            index, additional_seek, q = element
+            file_element = self.file_elements[index]
+            open_file = None
+            try:
+                open_file = file_element['item'].open()
+                open_file.seek(file_element['seek'] + additional_seek)
+
+                bytes_left = file_element['read_size'] - additional_seek
+                while bytes_left > 0:
+                    d = open_file.read(min(bytes_left, self.piece_size))
+                    if not d:
+                        raise IOError('End of data before end of element %i' % (index, ))
+
+                    if not self._put(q, d):
+                        return
+                    bytes_left -= len(d)
+
+                self._put(q, None)
+            except Exception as e:
+                logger.exception('Failed to read element %i' % (index, ))
+                self._put(q, e)
+            finally:
+                if open_file:
+                    open_file.close()
+
+    def _get(self, index, q):
+        if self.read_timeout is not None:
+            deadline = time.time() + self.read_timeout
+
+        while True:
+            timeout = 1
+            if self.read_timeout is not None:
+                timeout = max(0, min(timeout, deadline - time.time()))
+
+            try:
+                return q.get(timeout=timeout)
+            except queue.Empty:
+                pass
+
+            if self.error is not None:
+                raise IOError('Element worker failed: %r' % (self.error, ))
+
+            if self.should_die.is_set():
+                raise IOError('Reading was stopped')
+
+            if not any(worker.is_alive() for worker in self.workers):
+                raise IOError('No element worker left to read element %i' % (index, ))
+
+            if self.read_timeout is not None and time.time() >= deadline:
+                raise IOError('No data from element %i within %s seconds' % (index, self.read_timeout))
+
+    def read_piece(self):
+        """
+        Returns the next piece of data or None when all elements are read,
+        raises IOError if the data cannot be read.
+        """
+        while self.reading_element < len(self.element_queues):
+            index, _, q = self.element_queues[self.reading_element]
+            d = self._get(index, q)
+            if isinstance(d, Exception):
+                raise IOError('Failed to read element: %s' % (d, ))
+
+            if d is not None:
+                return d
+
+            with self.condition:
+                self.reading_element += 1
+                self.condition.notify_all()
+
+        return None
+
+    def stop(self):
+        self.should_die.set()
+        with self.condition:
+            self.condition.notify_all()
+
+
+class ParallelVirtualFileProcessorFile(object):
+    _pos = None
+    _fetcher = None
+    _piece = b''
+
+    def __init__(self, item, file_elements, size, parallel_elements, piece_size, buffer_pieces, element_offsets=None,
+                 read_timeout=None):
+        self.file_elements = file_elements
+        self.filename = item.id
+        self.size = size
+        if element_offsets is None:
+            element_offsets = calculate_element_offsets(file_elements)
+        self.element_offsets = element_offsets
+        self.parallel_elements = parallel_elements
+        self.piece_size = piece_size
+        self.buffer_pieces = buffer_pieces
+        self.read_timeout = read_timeout
+
+    def seek(self, pos, whence=0):
+        logger.debug('Seeking to %s' % (pos, ))
+        if whence == os.SEEK_CUR:
+            pos += self._pos or 0
+        elif whence == os.SEEK_END:
+            pos += self.size
+
+        if pos < 0:
+            raise IOError('Trying to seek to a negative position')
+
+        if pos != self._pos:
+            self._stop_fetcher()
+        self._pos = pos
+
+    def read(self, num_bytes=1024 * 8):
+        if self._pos is None:
+            self.seek(0)
+
+        if self._pos >= self.size:
+            return b''
+
+        if not self._fetcher:
+            self._fetcher = ParallelElementFetcher(self.file_elements, self.element_offsets, self._pos,
+                                                   self.parallel_elements, self.piece_size, self.buffer_pieces,
+                                                   read_timeout=self.read_timeout)
+
+        if not self._piece:
+            self._piece = self._fetcher.read_piece() or b''
+
+        d, self._piece = self._piece[:num_bytes], self._piece[num_bytes:]
+        self._pos += len(d)
+        return d
+
+    def tell(self):
+        return self._pos
+
+    def _stop_fetcher(self):
+        if self._fetcher:
+            self._fetcher.stop()
+        self._fetcher = None
+        self._piece = b''
+
+    def close(self):
+        logger.debug('Closing file')
+        self._stop_fetcher()
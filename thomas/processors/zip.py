@@ -0,0 +1,285 @@
+import logging
+import mimetypes
+import struct
+
+from ..filesystem import Item
+from ..plugin import ProcessorBase
+
+logger = logging.getLogger(__name__)
+
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD_STRUCT = struct.Struct('<4s4H2LH')
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_LOCATOR_STRUCT = struct.Struct('<4sLQL')
+ZIP64_EOCD_SIGNATURE = b'PK\x06\x06'
+ZIP64_EOCD_STRUCT = struct.Struct('<4sQ2H2L4Q')
+CENTRAL_SIGNATURE = b'PK\x01\x02'
+CENTRAL_STRUCT = struct.Struct('<4s6H3L5H2L')
+LOCAL_SIGNATURE = b'PK\x03\x04'
+LOCAL_STRUCT = struct.Struct('<4s5H3L2H')
+
+MAX_COMMENT_SIZE = 0xFFFF
+ZIP64_EXTRA_ID = 0x0001
+FLAG_ENCRYPTED = 0x1
+FLAG_UTF8 = 0x800
+METHOD_STORED = 0
+
+
+def _find_volume_items(filesystem, entry_item, disk_count):
+    """
+    Split archives are named name.z01, name.z02, ... with
+    the last volume being the .zip file.
+    """
+    if disk_count == 1:
+        return [entry_item]
+
+    filesystem.list()
+    name_index = filesystem.get_name_index()
+    base_name = entry_item.id[:-len('.zip')]
+
+    volume_items = []
+    for disk in range(1, disk_count):
+        volume_id = '%s.z%02i' % (base_name, disk)
+        item = name_index.get(volume_id.lower())
+        if item is None or not item.is_readable:
+            raise IOError('Unable to find ZIP volume %r' % (volume_id, ))
+        volume_items.append(item)
+    volume_items.append(entry_item)
+
+    return volume_items
+
+
+def _create_file_elements(volume_items, disk, offset, size):
+    """Map size bytes starting at offset on disk onto the volumes"""
+    file_elements = []
+    while size > 0:
+        if disk >= len(volume_items):
+            raise IOError('ZIP data goes beyond the last volume')
+
+        item = volume_items[disk]
+        read_size = min(size, item['size'] - offset)
+        if read_size > 0:
+            file_elements.append({
+                'read_size': read_size,
+                'seek': offset,
+                'item': item,
+            })
+            size -= read_size
+
+        disk += 1
+        offset = 0
+
+    return file_elements
+
+
+def _parse_zip64_extra(extra, values):
+    """
+    Replaces the values that did not fit in the central directory
+    record with the ones in the ZIP64 extra field.
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, data_size = struct.unpack('<2H', extra[pos:pos + 4])
+        if header_id == ZIP64_EXTRA_ID:
+            data = extra[pos + 4:pos + 4 + data_size]
+            data_pos = 0
+            for key, limit, fmt in [('file_size', 0xFFFFFFFF, '<Q'), ('compress_size', 0xFFFFFFFF, '<Q'),
+                                    ('header_offset', 0xFFFFFFFF, '<Q'), ('disk', 0xFFFF, '<L')]:
+                if values[key] != limit:
+                    continue
+
+                field_size = struct.calcsize(fmt)
+                values[key] = struct.unpack(fmt, data[data_pos:data_pos + field_size])[0]
+                data_pos += field_size
+            break
+        pos += 4 + data_size
+
+    return values
+
+
+class ZipVolumeSet(object):
+    """
+    Reads the central directory of a, possibly split, ZIP archive
+    with a single read from the end of the last volume when possible.
+    """
+    def __init__(self, filesystem, entry_item, tail_size=64 * 1024):
+        self.filesystem = filesystem
+        self.entry_item = entry_item
+
+        self.tail_offset = max(0, entry_item['size'] - max(tail_size, EOCD_STRUCT.size + MAX_COMMENT_SIZE))
+        f = entry_item.open()
+        try:
+            f.seek(self.tail_offset)
+            self.tail = _read_exactly(f, entry_item['size'] - self.tail_offset)
+        finally:
+            f.close()
+
+        self.volume_items = [entry_item]
+        self._entries = None
+        self._parse_end_of_central_directory()
+
+    def _parse_end_of_central_directory(self):
+        pos = len(self.tail)
+        while True:
+            pos = self.tail.rfind(EOCD_SIGNATURE, 0, pos)
+            if pos == -1:
+                raise IOError('Not a valid ZIP file, end of central directory not found')
+
+            if pos + EOCD_STRUCT.size > len(self.tail):
+                continue
+
+            eocd = EOCD_STRUCT.unpack(self.tail[pos:pos + EOCD_STRUCT.size])
+            if pos + EOCD_STRUCT.size + eocd[7] == len(self.tail):
+                break
+
+        (_, disk, self.central_disk, _, self.entry_count,
+         self.central_size, self.central_offset, _) = eocd
+
+        locator_pos = pos - ZIP64_LOCATOR_STRUCT.size
+        if locator_pos >= 0 and self.tail[locator_pos:locator_pos + 4] == ZIP64_LOCATOR_SIGNATURE:
+            _, zip64_disk, zip64_offset, disk_count = ZIP64_LOCATOR_STRUCT.unpack(
+                self.tail[locator_pos:locator_pos + ZIP64_LOCATOR_STRUCT.size])
+            self.volume_items = _find_volume_items(self.filesystem, self.entry_item, disk_count)
+
+            zip64_eocd = ZIP64_EOCD_STRUCT.unpack(self.read(zip64_disk, zip64_offset, ZIP64_EOCD_STRUCT.size))
+            if zip64_eocd[0] != ZIP64_EOCD_SIGNATURE:
+                raise IOError('Not a valid ZIP64 end of central directory')
+
+            (_, _, _, _, disk, self.central_disk, _, self.entry_count,
+             self.central_size, self.central_offset) = zip64_eocd
+        else:
+            self.volume_items = _find_volume_items(self.filesystem, self.entry_item, disk + 1)
+
+    def read(self, disk, offset, size):
+        if disk == len(self.volume_items) - 1 and offset >= self.tail_offset:
+            tail_pos = offset - self.tail_offset
+            data = self.tail[tail_pos:tail_pos + size]
+        else:
+            virtualfile = ProcessorBase.find_plugin('virtualfile')(
+                Item(id=self.entry_item.id),
+                _create_file_elements(self.volume_items, disk, offset, size))
+            f = virtualfile.open()
+            try:
+                data = _read_exactly(f, size)
+            finally:
+                f.close()
+
+        if len(data) != size:
+            raise IOError('Unexpected end of ZIP data')
+
+        return data
+
+    def infolist(self):
+        """Returns the entries of the central directory"""
+        if self._entries is None:
+            self._entries = self._read_central_directory()
+
+        return self._entries
+
+    def stored_entries(self):
+        """Returns the entries that can be read directly from the volumes"""
+        return [entry for entry in self.infolist() if entry['stored'] and not entry['encrypted'] and not entry['is_dir']]
+
+    def _read_central_directory(self):
+        data = self.read(self.central_disk, self.central_offset, self.central_size)
+
+        entries = []
+        pos = 0
+        for _ in range(self.entry_count):
+            record = CENTRAL_STRUCT.unpack(data[pos:pos + CENTRAL_STRUCT.size])
+            if record[0] != CENTRAL_SIGNATURE:
+                raise IOError('Not a valid ZIP central directory entry')
+
+            (_, _, _, flags, method, _, _, _, compress_size, file_size,
+             filename_length, extra_length, comment_length, disk, _, _, header_offset) = record
+            pos += CENTRAL_STRUCT.size
+
+            filename = data[pos:pos + filename_length]
+            filename = filename.decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+            pos += filename_length
+
+            entry = _parse_zip64_extra(data[pos:pos + extra_length], {
+                'filename': filename,
+                'file_size': file_size,
+                'compress_size': compress_size,
+                'header_offset': header_offset,
+                'disk': disk,
+            })
+            entry['stored'] = method == METHOD_STORED
+            entry['encrypted'] = bool(flags & FLAG_ENCRYPTED)
+            entry['is_dir'] = filename.endswith('/')
+            entries.append(entry)
+            pos += extra_length + comment_length
+
+        return entries
+
+    def create_file_elements(self, entry):
+        """Reads the local header of entry and maps its data onto the volumes"""
+        disk, offset = entry['disk'], entry['header_offset']
+        local_header = LOCAL_STRUCT.unpack(self.read(disk, offset, LOCAL_STRUCT.size))
+        if local_header[0] != LOCAL_SIGNATURE:
+            raise IOError('Not a valid ZIP local header for %r' % (entry['filename'], ))
+
+        offset += LOCAL_STRUCT.size + local_header[9] + local_header[10]
+        while disk < len(self.volume_items) and offset >= self.volume_items[disk]['size']:
+            offset -= self.volume_items[disk]['size']
+            disk += 1
+
+        return _create_file_elements(self.volume_items, disk, offset, entry['compress_size'])
+
+
+def _read_exactly(f, size):
+    data = []
+    while size > 0:
+        d = f.read(size)
+        if not d:
+            break
+        data.append(d)
+        size -= len(d)
+
+    return b''.join(data)
+
+
+class ZipProcessor(ProcessorBase, dict):
+    plugin_name = 'zip'
+
+    def __init__(self, filesystem, entry_item, member=None, preopen_lookahead=None, volume_set=None):
+        """
+        Reads a stored file directly from the volumes of a ZIP archive,
+        entry_item is the .zip file. If member is not set,
+        the biggest stored file is used. volume_set can be
+        an already read ZipVolumeSet of entry_item.
+        """
+        self.filesystem = filesystem
+        self.entry_item = entry_item
+
+        if volume_set is None:
+            volume_set = ZipVolumeSet(filesystem, entry_item)
+        entries = volume_set.stored_entries()
+        if member is not None:
+            entries = [entry for entry in entries if entry['filename'] == member]
+
+        if not entries:
+            raise IOError('No stored file found in ZIP archive %r' % (entry_item.id, ))
+
+        self.entry = entry = sorted(entries, key=lambda x: x['file_size'], reverse=True)[0]
+        file_elements = volume_set.create_file_elements(entry)
+
+        self['size'] = self.size = entry['file_size']
+        self.filename = entry['filename'].split('/')[-1]
+        self.content_type = mimetypes.guess_type(self.filename)[0] or 'bytes'
+        self._read_items = [file_element['item'] for file_element in file_elements]
+
+        virtualfile_processor_cls = ProcessorBase.find_plugin('virtualfile')
+        self.virtualfile = virtualfile_processor_cls(Item(id=self.filename), file_elements,
+                                                     preopen_lookahead=preopen_lookahead)
+
+    def open(self):
+        return self.virtualfile.open()
+
+    @property
+    def id(self):
+        return self.entry['filename']
+
+    def get_read_items(self):
+        return self._read_items
@@ -0,0 +1,352 @@
+"""
+Binary format for Item trees.
+
+Items are written one record at a time with children before their parent,
+so a tree can be written while it is being walked. Each record holds the
+offsets of its children and the attribute keys and routes are references
+into tables stored at the end of the file.
+
+When read, only the root is loaded and nested items are loaded from the file
+the first time they are used. Route kwargs must be JSON serializable and
+cannot contain items, e.g. the routes to archive members created by rar_list.
+
+Layout::
+
+    magic
+    records: length (uint32) + payload, children first and root last
+    string table: count, then length + utf-8 for each string
+    route table: count, then length + JSON for each route
+    trailer: root offset, string table offset, route table offset (uint64) and magic
+"""
+import json
+import logging
+import struct
+
+from threading import Lock
+
+import six
+
+from .filesystem import FLAG_EXPANDABLE, FLAG_READABLE, FLAG_STREAMABLE, Item, route_table, router
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'ItemReader',
+    'ItemWriter',
+    'dump',
+    'load',
+]
+
+MAGIC = b'THOMAS\x00\x01'
+RECORD_LENGTH = struct.Struct('<L')
+TRAILER = struct.Struct('<QQQ8s')
+FLAG_NESTED = 8
+
+VALUE_NONE = b'n'
+VALUE_TRUE = b't'
+VALUE_FALSE = b'f'
+VALUE_INT = b'i'
+VALUE_FLOAT = b'd'
+VALUE_TEXT = b's'
+VALUE_BYTES = b'b'
+VALUE_JSON = b'j'
+FLOAT = struct.Struct('<d')
+
+
+def _write_varint(buf, value):
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            buf.append(byte | 0x80)
+        else:
+            buf.append(byte)
+            return
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_bytes(buf, value):
+    _write_varint(buf, len(value))
+    buf.extend(value)
+
+
+def _read_bytes(data, pos):
+    length, pos = _read_varint(data, pos)
+    return bytes(data[pos:pos + length]), pos + length
+
+
+def _write_value(buf, value):
+    if value is None:
+        buf.extend(VALUE_NONE)
+    elif value is True:
+        buf.extend(VALUE_TRUE)
+    elif value is False:
+        buf.extend(VALUE_FALSE)
+    elif isinstance(value, six.integer_types):
+        buf.extend(VALUE_INT)
+        _write_varint(buf, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        buf.extend(VALUE_FLOAT)
+        buf.extend(FLOAT.pack(value))
+    elif isinstance(value, six.text_type):
+        buf.extend(VALUE_TEXT)
+        _write_bytes(buf, value.encode('utf-8'))
+    elif isinstance(value, six.binary_type):
+        buf.extend(VALUE_BYTES)
+        _write_bytes(buf, value)
+    else:
+        buf.extend(VALUE_JSON)
+        _write_bytes(buf, json.dumps(value).encode('utf-8'))
+
+
+def _read_value(data, pos):
+    value_type = bytes(data[pos:pos + 1])
+    pos += 1
+    if value_type == VALUE_NONE:
+        return None, pos
+    elif value_type == VALUE_TRUE:
+        return True, pos
+    elif value_type == VALUE_FALSE:
+        return False, pos
+    elif value_type == VALUE_INT:
+        value, pos = _read_varint(data, pos)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+    elif value_type == VALUE_FLOAT:
+        return FLOAT.unpack(bytes(data[pos:pos + FLOAT.size]))[0], pos + FLOAT.size
+    elif value_type == VALUE_TEXT:
+        value, pos = _read_bytes(data, pos)
+        return value.decode('utf-8'), pos
+    elif value_type == VALUE_BYTES:
+        return _read_bytes(data, pos)
+    elif value_type == VALUE_JSON:
+        value, pos = _read_bytes(data, pos)
+        return json.loads(value.decode('utf-8')), pos
+
+    raise ValueError('Unknown value type %r' % (value_type, ))
+
+
+def _unserializable_route_value(value):
+    raise ValueError('Route kwargs with %s cannot be serialized' % (type(value).__name__, ))
+
+
+def _encode_route(route):
+    # items are dicts and would be written as just their attributes
+    values = [route]
+    while values:
+        value = values.pop()
+        if isinstance(value, Item):
+            raise ValueError('Route kwargs with items cannot be serialized, found %r in a %s route' % (value.id, route['handler']))
+        elif isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+
+    return json.dumps(route, sort_keys=True, default=_unserializable_route_value)
+
+
+class ItemWriter(object):
+    """
+    Writes item trees to a file object, close must be called
+    when done to write the tables.
+    """
+    def __init__(self, f):
+        self.f = f
+        self._offset = len(MAGIC)
+        self._strings = {}
+        self._routes = {}
+        self._root_offset = None
+        f.write(MAGIC)
+
+    def _string_index(self, value):
+        index = self._strings.get(value)
+        if index is None:
+            index = self._strings[value] = len(self._strings)
+        return index
+
+    def _route_index(self, route):
+        encoded_route = _encode_route(route)
+        index = self._routes.get(encoded_route)
+        if index is None:
+            index = self._routes[encoded_route] = len(self._routes)
+        return index
+
+    def _write_record(self, item, nested_offsets):
+        buf = bytearray()
+
+        flags = item._flags
+        if nested_offsets is not None:
+            flags |= FLAG_NESTED
+        buf.append(flags)
+        _write_bytes(buf, item.id.encode('utf-8'))
+
+        attributes = [(k, v) for (k, v) in item.items() if not k.startswith('_')]
+        _write_varint(buf, len(attributes))
+        for key, value in attributes:
+            _write_varint(buf, self._string_index(key))
+            _write_value(buf, value)
+
+        routes = item._get_route_set() or []
+        _write_varint(buf, len(routes))
+        for route in routes:
+            _write_varint(buf, self._route_index(route))
+
+        if nested_offsets is not None:
+            _write_varint(buf, len(nested_offsets))
+            for nested_offset in nested_offsets:
+                _write_varint(buf, nested_offset)
+
+        offset = self._offset
+        self.f.write(RECORD_LENGTH.pack(len(buf)))
+        self.f.write(bytes(buf))
+        self._offset += RECORD_LENGTH.size + len(buf)
+        return offset
+
+    def write(self, item):
+        """Writes item and everything below it, the last item written is the root"""
+        stack = [(item, [], iter(item.nested_items or []))]
+        while True:
+            current_item, nested_offsets, nested_items = stack[-1]
+            nested_item = next(nested_items, None)
+            if nested_item is not None:
+                stack.append((nested_item, [], iter(nested_item.nested_items or [])))
+                continue
+
+            stack.pop()
+            offset = self._write_record(current_item, nested_offsets if current_item.nested_items is not None else None)
+            if not stack:
+                self._root_offset = offset
+                return offset
+
+            stack[-1][1].append(offset)
+
+    def close(self):
+        if self._root_offset is None:
+            raise ValueError('No item written')
+
+        strings_offset = self._offset
+        buf = bytearray()
+        _write_varint(buf, len(self._strings))
+        for value, _ in sorted(self._strings.items(), key=lambda x: x[1]):
+            _write_bytes(buf, value.encode('utf-8'))
+
+        routes_offset = strings_offset + len(buf)
+        _write_varint(buf, len(self._routes))
+        for encoded_route, _ in sorted(self._routes.items(), key=lambda x: x[1]):
+            _write_bytes(buf, encoded_route.encode('utf-8'))
+
+        self.f.write(bytes(buf))
+        self.f.write(TRAILER.pack(self._root_offset, strings_offset, routes_offset, MAGIC))
+        self._offset += len(buf) + TRAILER.size
+
+
+class NestedRecords(object):
+    """Reads nested items from their records when they are needed"""
+    def __init__(self, reader, offsets, include_routes=True):
+        self.reader = reader
+        self.offsets = offsets
+        self.include_routes = include_routes
+
+    def create_nested_items(self):
+        return [self.reader.read_item(offset, self.include_routes) for offset in self.offsets]
+
+    def without_routes(self):
+        return NestedRecords(self.reader, self.offsets, include_routes=False)
+
+
+class ItemReader(object):
+    """
+    Reads item trees from a seekable file object, the file must stay
+    open as long as nested items might be loaded.
+    """
+    def __init__(self, f, router=router):
+        self.f = f
+        self.router = router
+        self._lock = Lock()
+
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a serialized item tree')
+
+        f.seek(-TRAILER.size, 2)
+        trailer_offset = f.tell()
+        self.root_offset, strings_offset, routes_offset, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError('Serialized item tree is incomplete')
+
+        f.seek(strings_offset)
+        data = bytearray(f.read(trailer_offset - strings_offset))
+
+        string_count, pos = _read_varint(data, 0)
+        self.strings = []
+        for _ in range(string_count):
+            value, pos = _read_bytes(data, pos)
+            value = value.decode('utf-8')
+            self.strings.append(six.moves.intern(value) if isinstance(value, str) else value)
+
+        route_count, pos = _read_varint(data, routes_offset - strings_offset)
+        self.routes = []
+        for _ in range(route_count):
+            value, pos = _read_bytes(data, pos)
+            self.routes.append(route_table.intern(json.loads(value.decode('utf-8'))))
+
+    def read_item(self, offset, include_routes=True):
+        with self._lock:
+            self.f.seek(offset)
+            length = RECORD_LENGTH.unpack(self.f.read(RECORD_LENGTH.size))[0]
+            data = bytearray(self.f.read(length))
+
+        flags = data[0]
+        item_id, pos = _read_bytes(data, 1)
+        item = Item(item_id.decode('utf-8'), router=self.router)
+        item._flags = flags & (FLAG_READABLE | FLAG_EXPANDABLE | FLAG_STREAMABLE)
+
+        attribute_count, pos = _read_varint(data, pos)
+        for _ in range(attribute_count):
+            key_index, pos = _read_varint(data, pos)
+            value, pos = _read_value(data, pos)
+            dict.__setitem__(item, self.strings[key_index], value)
+
+        route_count, pos = _read_varint(data, pos)
+        routes = []
+        for _ in range(route_count):
+            route_index, pos = _read_varint(data, pos)
+            routes.append(self.routes[route_index])
+        if include_routes and routes:
+            item._routes = route_table.intern_routes(routes)
+
+        if flags & FLAG_NESTED:
+            nested_count, pos = _read_varint(data, pos)
+            nested_offsets = []
+            for _ in range(nested_count):
+                nested_offset, pos = _read_varint(data, pos)
+                nested_offsets.append(nested_offset)
+            item._nested_source = NestedRecords(self, nested_offsets, include_routes)
+
+        return item
+
+    @property
+    def root(self):
+        return self.read_item(self.root_offset)
+
+
+def dump(item, f):
+    """Writes item and everything below it to f"""
+    writer = ItemWriter(f)
+    writer.write(item)
+    writer.close()
+
+
+def load(f, router=router):
+    """Returns the root item from f, nested items are loaded when used"""
+    return ItemReader(f, router=router).root
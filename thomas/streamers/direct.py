@@ -3,6 +3,7 @@ from ..plugin import StreamerBase
 
 class DirectStreamer(StreamerBase):
     plugin_name = 'direct'
+    _best = None
 
     def __init__(self, item, allowed_extensions=None):
         self.item = item
@@ -26,13 +27,19 @@ class DirectStreamer(StreamerBase):
 
         return best_size, best_item
 
+    def _get_best_item(self):
+        if self._best is None:
+            self._best = self._find_best_item(self.item)
+
+        return self._best
+
     def evaluate(self, include_fileset=False):
-        best_size, best_item = self._find_best_item(self.item)
+        best_size, best_item = self._get_best_item()
         if include_fileset:
             return (best_size or None), [best_item]
         else:
             return best_size or None
 
     def stream(self):
-        best_size, best_item = self._find_best_item(self.item)
+        best_size, best_item = self._get_best_item()
         return best_item
@@ -7,10 +7,14 @@ from ..plugin import StreamerBase, ProcessorBase
 
 class RarStreamer(StreamerBase):
     plugin_name = 'rar'
+    _best = None
 
-    def __init__(self, item, lazy=False):
+    def __init__(self, item, lazy=False, preopen_lookahead=None, index_cache_path=None, probe_workers=None):
         self.item = item
         self.lazy = lazy
+        self.probe_workers = probe_workers
+        self.preopen_lookahead = preopen_lookahead
+        self.index_cache_path = index_cache_path
 
     def _find_all_first_files(self, item):
         """
@@ -19,7 +23,7 @@ class RarStreamer(StreamerBase):
         correct way.
         """
         for listed_item in item.list():
-            new_style = re.findall(r'(?i)\.part(\d+)\.rar^', listed_item.id)
+            new_style = re.findall(r'(?i)\.part(\d+)\.rar$', listed_item.id)
             if new_style:
                 if int(new_style[0]) == 1:
                     yield 'new', listed_item
@@ -27,7 +31,8 @@ class RarStreamer(StreamerBase):
                 yield 'old', listed_item
 
     def _find_all_filesets(self, item):
-        items = {listed_item.id.lower(): listed_item for listed_item in item.list() if listed_item.is_readable}
+        item.list()
+        items = item.get_name_index()
         filesets = []
         for style, first_item in self._find_all_first_files(item):
             fileset = []
@@ -39,10 +44,11 @@ class RarStreamer(StreamerBase):
                 elif style == 'new':
                     next_item_id = _next_newvol(last_item_id)
 
-                if next_item_id not in items:
+                next_item = items.get(next_item_id)
+                if next_item is None or not next_item.is_readable:
                     break
 
-                fileset.append(items[next_item_id])
+                fileset.append(next_item)
                 last_item_id = next_item_id
 
             filesets.append(fileset)
@@ -60,11 +66,17 @@ class RarStreamer(StreamerBase):
 
         return best_fileset_size, best_fileset
 
+    def _get_biggest_fileset(self):
+        if self._best is None:
+            self._best = self._find_biggest_fileset(self.item)
+
+        return self._best
+
     def evaluate(self, include_fileset=False):
         if not self.item.is_listable:
             return None
 
-        best_fileset_size, best_fileset = self._find_biggest_fileset(self.item)
+        best_fileset_size, best_fileset = self._get_biggest_fileset()
 
         # we would prefer the same file if it is extracted
         # so lets add a small factor to take overhead into
@@ -76,6 +88,9 @@ class RarStreamer(StreamerBase):
             return evaluation
 
     def stream(self):
-        best_fileset_size, best_fileset = self._find_biggest_fileset(self.item)
+        best_fileset_size, best_fileset = self._get_biggest_fileset()
         rar_processor_cls = ProcessorBase.find_plugin('rar')
-        return rar_processor_cls(self.item, best_fileset[0], lazy=self.lazy)
+        return rar_processor_cls(self.item, best_fileset[0], lazy=self.lazy,
+                                 preopen_lookahead=self.preopen_lookahead,
+                                 index_cache_path=self.index_cache_path,
+                                 probe_workers=self.probe_workers)
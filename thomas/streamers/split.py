@@ -0,0 +1,81 @@
+import re
+
+from ..filesystem import Item
+from ..plugin import StreamerBase, ProcessorBase
+
+
+class SplitStreamer(StreamerBase):
+    plugin_name = 'split'
+    _best = None
+
+    def __init__(self, item, preopen_lookahead=None):
+        self.item = item
+        self.preopen_lookahead = preopen_lookahead
+
+    def _find_all_filesets(self, item):
+        """
+        Finds files split into name.001, name.002, ... where
+        every part is just the next bytes of the file.
+        """
+        listed_items = item.list()
+        items = item.get_name_index()
+        filesets = []
+        for listed_item in listed_items:
+            first_part = re.findall(r'^(.+)\.(0*1)$', listed_item.id)
+            if not first_part or not listed_item.is_readable:
+                continue
+
+            name, number = first_part[0]
+            fileset = [listed_item]
+            while True:
+                next_item_id = '%s.%0*i' % (name, len(number), len(fileset) + 1)
+                next_item = items.get(next_item_id.lower())
+                if next_item is None or not next_item.is_readable:
+                    break
+                fileset.append(next_item)
+
+            if len(fileset) > 1:
+                filesets.append((name, fileset))
+
+        return filesets
+
+    def _find_biggest_fileset(self, item):
+        filesets = self._find_all_filesets(item)
+        best_fileset_size, best_name, best_fileset = 0, None, None
+        for name, fileset in filesets:
+            fileset_size = sum(x['size'] for x in fileset)
+            if fileset_size > best_fileset_size:
+                best_name = name
+                best_fileset = fileset
+                best_fileset_size = fileset_size
+
+        return best_fileset_size, best_name, best_fileset
+
+    def _get_biggest_fileset(self):
+        if self._best is None:
+            self._best = self._find_biggest_fileset(self.item)
+
+        return self._best
+
+    def evaluate(self, include_fileset=False):
+        if not self.item.is_listable:
+            return None
+
+        best_fileset_size, best_name, best_fileset = self._get_biggest_fileset()
+        evaluation = best_fileset_size or None
+        if include_fileset:
+            return evaluation, best_fileset
+        else:
+            return evaluation
+
+    def stream(self):
+        best_fileset_size, best_name, best_fileset = self._get_biggest_fileset()
+        file_elements = [{
+            'read_size': item['size'],
+            'seek': 0,
+            'item': item,
+        } for item in best_fileset]
+
+        virtualfile_processor_cls = ProcessorBase.find_plugin('virtualfile')
+        return virtualfile_processor_cls(Item(id=best_name), file_elements,
+                                         preopen_lookahead=self.preopen_lookahead)
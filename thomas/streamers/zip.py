@@ -0,0 +1,86 @@
+import logging
+
+from ..plugin import StreamerBase, ProcessorBase
+from ..processors.zip import ZipVolumeSet
+
+logger = logging.getLogger(__name__)
+
+
+class ZipStreamer(StreamerBase):
+    plugin_name = 'zip'
+    _best = None
+
+    def __init__(self, item, preopen_lookahead=None):
+        self.item = item
+        self.preopen_lookahead = preopen_lookahead
+
+    def _find_all_filesets(self, item):
+        """
+        Finds all .zip files with their .z01, .z02, ... volumes,
+        the .zip file is the last volume.
+        """
+        listed_items = item.list()
+        items = item.get_name_index()
+        filesets = []
+        for listed_item in listed_items:
+            if not listed_item.id.lower().endswith('.zip') or not listed_item.is_readable:
+                continue
+
+            base_name = listed_item.id[:-len('.zip')].lower()
+            fileset = []
+            while True:
+                next_item = items.get('%s.z%02i' % (base_name, len(fileset) + 1))
+                if next_item is None or not next_item.is_readable:
+                    break
+                fileset.append(next_item)
+
+            fileset.append(listed_item)
+            filesets.append(fileset)
+
+        return filesets
+
+    def _find_biggest_fileset(self, item):
+        """
+        Finds the biggest fileset with a stored file, only stored files
+        can be streamed so the central directories are read until one is found.
+        """
+        filesets = [(sum(x['size'] for x in fileset), fileset) for fileset in self._find_all_filesets(item)]
+        filesets.sort(key=lambda x: x[0], reverse=True)
+        for fileset_size, fileset in filesets:
+            try:
+                volume_set = ZipVolumeSet(item, fileset[-1])
+                if volume_set.stored_entries():
+                    return fileset_size, fileset, volume_set
+            except IOError as e:
+                logger.debug('Unable to read ZIP archive %r: %s' % (fileset[-1].id, e))
+
+        return 0, None, None
+
+    def _get_biggest_fileset(self):
+        if self._best is None:
+            self._best = self._find_biggest_fileset(self.item)
+
+        return self._best
+
+    def evaluate(self, include_fileset=False):
+        if not self.item.is_listable:
+            return None
+
+        best_fileset_size, best_fileset, _ = self._get_biggest_fileset()
+        if best_fileset is None:
+            evaluation = None
+        else:
+            # same overhead consideration as rar
+            evaluation = int(best_fileset_size * 0.95)
+
+        if include_fileset:
+            return evaluation, best_fileset
+        else:
+            return evaluation
+
+    def stream(self):
+        best_fileset_size, best_fileset, volume_set = self._get_biggest_fileset()
+        zip_processor_cls = ProcessorBase.find_plugin('zip')
+        return zip_processor_cls(self.item, best_fileset[-1],
+                                 preopen_lookahead=self.preopen_lookahead,
+                                 volume_set=volume_set)
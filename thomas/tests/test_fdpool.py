@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..fdpool import FileDescriptorPool, pread
+from ..inputs.file import FileInput
+
+
+class TestFileDescriptorPool(unittest.TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(4):
+            path = os.path.join(self.temp_path, 'file%i' % (i, ))
+            with open(path, 'wb') as f:
+                f.write(bytes(bytearray(range(i * 10, i * 10 + 10))))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def test_reuse(self):
+        pool = FileDescriptorPool(max_open=2)
+        entry = pool.acquire(self.paths[0])
+        pool.release(entry)
+        entry_again = pool.acquire(self.paths[0])
+        pool.release(entry_again)
+
+        self.assertEqual(entry.fd, entry_again.fd)
+        self.assertEqual(pool.stats['hits'], 1)
+        self.assertEqual(pool.stats['misses'], 1)
+        pool.clear()
+
+    def test_lru_eviction(self):
+        pool = FileDescriptorPool(max_open=2)
+        for path in self.paths[:3]:
+            pool.release(pool.acquire(path))
+
+        stats = pool.stats
+        self.assertEqual(stats['open'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+        pool.release(pool.acquire(self.paths[0]))
+        self.assertEqual(pool.stats['misses'], 4)
+        pool.clear()
+
+    def test_in_use_not_evicted(self):
+        pool = FileDescriptorPool(max_open=1)
+        entries = [pool.acquire(path) for path in self.paths[:3]]
+        self.assertEqual(pool.stats['in_use'], 3)
+        self.assertEqual(pread(entries[0], 2, 4), b'\x04\x05')
+
+        for entry in entries:
+            pool.release(entry)
+
+        self.assertEqual(pool.stats['open'], 1)
+        pool.clear()
+
+    def test_changed_file_reopened(self):
+        pool = FileDescriptorPool()
+        entry = pool.acquire(self.paths[0])
+        pool.release(entry)
+
+        os.remove(self.paths[0])
+        with open(self.paths[0], 'wb') as f:
+            f.write(b'changed data')
+
+        entry = pool.acquire(self.paths[0])
+        self.assertEqual(pread(entry, 7, 0), b'changed')
+        pool.release(entry)
+        pool.clear()
+
+    def test_file_input_shares_descriptor(self):
+        pool = FileDescriptorPool()
+        fi_1 = FileInput(None, self.paths[1], pool=pool)
+        fi_2 = FileInput(None, self.paths[1], pool=pool)
+
+        fi_1.seek(2)
+        fi_2.seek(-3, os.SEEK_END)
+        self.assertEqual(fi_1.read(3), b'\x0c\x0d\x0e')
+        self.assertEqual(fi_2.read(10), b'\x11\x12\x13')
+        self.assertEqual(fi_1.read(2), b'\x0f\x10')
+        self.assertEqual(fi_1.tell(), 7)
+        self.assertEqual(pool.stats['open'], 1)
+
+        fi_1.close()
+        fi_2.close()
+        self.assertEqual(pool.stats['in_use'], 0)
+        pool.clear()
@@ -1,8 +1,18 @@
+import os
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
 from io import BytesIO
 
-from ..filesystem import Item, Router
+from ..filesystem import FrozenList, Item, Router
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 
 def open_dummy(item, data):
@@ -14,6 +24,17 @@ def list_dummy(item, items):
     return item
 
 
+def list_slow_dummy(item, items, delay):
+    time.sleep(delay)
+    item.nested_items = items
+    return item
+
+
+def list_nested_dummy(item, folder):
+    item.nested_items = folder.list()
+    return item
+
+
 class DummyStream(object):
     def __init__(self, expected_evaluation, stream_value):
         self.expected_evaluation = expected_evaluation
@@ -30,6 +51,20 @@ def stream_dummy(item, expected_evaluation, stream_value):
     return DummyStream(expected_evaluation, stream_value)
 
 
+class SlowDummyStream(DummyStream):
+    def __init__(self, expected_evaluation, stream_value, delay):
+        super(SlowDummyStream, self).__init__(expected_evaluation, stream_value)
+        self.delay = delay
+
+    def evaluate(self):
+        time.sleep(self.delay)
+        return self.expected_evaluation
+
+
+def stream_slow_dummy(item, expected_evaluation, stream_value, delay):
+    return SlowDummyStream(expected_evaluation, stream_value, delay)
+
+
 class TestFilesystem(unittest.TestCase):
     def setUp(self):
         self.router = Router()
@@ -373,3 +408,596 @@ class TestFilesystem(unittest.TestCase):
 
         self.assertNotEqual(Item('item1'), Item('item2'))
         self.assertNotEqual(Item('item1', attributes={'a': 'b'}), Item('item1', attributes={'a': 'c'}))
+
+    def test_name_index(self):
+        folder = Item('folder')
+        folder.add_item(Item('File.RAR', attributes={'a': 1}))
+        folder.add_item(Item('file.rar', attributes={'a': 2}))
+        self.assertEqual(folder.get_name_index()['file.rar']['a'], 1)
+        self.assertNotIn('file.r00', folder.get_name_index())
+
+        folder.add_item(Item('file.r00'))
+        self.assertIn('file.r00', folder.get_name_index())
+
+        folder.nested_items = [Item('other.rar')]
+        self.assertEqual(list(folder.get_name_index().keys()), ['other.rar'])
+
+    def test_version(self):
+        item = Item(id='folder', router=self.router)
+        sub_item = Item(id='subfolder', router=self.router)
+        item.add_item(sub_item)
+
+        version = item.version
+        sub_item.add_item(Item(id='file', router=self.router))
+        self.assertGreater(item.version, version)
+
+        version = item.version
+        sub_item.nested_items = []
+        self.assertGreater(item.version, version)
+
+    def test_stream_evaluation_cached(self):
+        evaluations = []
+
+        def stream_counting(item, stream_value):
+            evaluations.append(stream_value)
+            return DummyStream(1, stream_value)
+
+        self.router.register_handler('counting_stream', stream_counting, False, False, True)
+
+        item = Item(id='folder', router=self.router)
+        item.streamable = True
+        item.add_route('counting_stream', False, False, True, kwargs={'stream_value': 'a'})
+
+        self.assertEqual(item.stream(), 'a')
+        self.assertEqual(item.stream(), 'a')
+        self.assertEqual(evaluations, ['a'])
+
+        item.add_item(Item(id='file', router=self.router))
+        self.assertEqual(item.stream(), 'a')
+        self.assertEqual(evaluations, ['a', 'a'])
+
+        item.routes = [dict(item.routes[0], kwargs={'stream_value': 'b'})]
+        self.assertEqual(item.stream(), 'b')
+
+        item.routes[0]['kwargs']['stream_value'] = 'c'
+        self.assertEqual(item.stream(), 'c')
+        self.assertEqual(item.stream(), 'c')
+        self.assertEqual(evaluations, ['a', 'a', 'b', 'c'])
+
+        self.router.register_handler('counting_stream', lambda item, stream_value: DummyStream(1, 'd'), False, False, True)
+        self.assertEqual(item.stream(), 'd')
+
+    def test_stream_evaluation_changes_tree(self):
+        evaluations = []
+
+        def stream_listing(item, stream_value):
+            evaluations.append(stream_value)
+            if not item.nested_items:
+                item.add_item(Item(id='listed', router=self.router))
+            return DummyStream(1, stream_value)
+
+        self.router.register_handler('listing_stream', stream_listing, False, False, True)
+
+        item = Item(id='folder', router=self.router)
+        item.streamable = True
+        item.add_route('listing_stream', False, False, True, kwargs={'stream_value': 'a'})
+        self.assertEqual(item.stream(), 'a')
+        self.assertEqual(item.stream(), 'a')
+        self.assertEqual(evaluations, ['a'])
+
+    def test_stream_parallel_evaluation(self):
+        self.router.register_handler('slow_stream', stream_slow_dummy, False, False, True)
+        item = Item(id='stream', router=self.router)
+        item.streamable = True
+        item.add_route('slow_stream', False, False, True, kwargs={'expected_evaluation': 10, 'stream_value': 'works10', 'delay': 0.2})
+        item.add_route('slow_stream', False, False, True, kwargs={'expected_evaluation': 20, 'stream_value': 'works20', 'delay': 0.2})
+
+        start_time = time.time()
+        self.assertEqual(item.stream(), 'works20')
+        self.assertLess(time.time() - start_time, 0.35)
+        self.assertEqual(self.router.stats['evaluate']['slow_stream']['calls'], 2)
+
+    def test_stream_evaluation_deadline(self):
+        self.router.evaluate_timeout = 0.1
+        self.router.register_handler('slow_stream', stream_slow_dummy, False, False, True)
+        item = Item(id='stream', router=self.router)
+        item.streamable = True
+        item.add_route('slow_stream', False, False, True, kwargs={'expected_evaluation': 20, 'stream_value': 'works20', 'delay': 0.5})
+        item.add_route('dummy_stream', False, False, True, kwargs={'expected_evaluation': 10, 'stream_value': 'works10'})
+
+        self.assertEqual(item.stream(), 'works10')
+        self.assertEqual(self.router.stats['evaluate']['slow_stream']['timeouts'], 1)
+
+        # skipped streamers are evaluated again the next time
+        self.assertIsNone(item._stream_evaluation)
+        self.router.register_handler('slow_stream', lambda item, delay, **kwargs: stream_dummy(item, **kwargs), False, False, True)
+        self.assertEqual(item.stream(), 'works20')
+
+    def test_list_timeout_partial(self):
+        self.router.list_timeout = 0.1
+        self.router.register_handler('slow_list', list_slow_dummy, False, True, False)
+        folder = Item('testfolder', router=self.router)
+        folder.expandable = True
+        folder.add_route('slow_list', False, True, False, kwargs={'items': [Item('item1')], 'delay': 0.5})
+        folder.add_route('dummy_list', False, True, False, kwargs={'items': [Item('item2')]})
+
+        self.assertEqual([item.id for item in folder.list()], ['item2'])
+        stats = self.router.stats
+        self.assertEqual(stats['list']['slow_list']['timeouts'], 1)
+        self.assertEqual(stats['list']['dummy_list']['calls'], 1)
+
+    def test_list_nested_in_pool(self):
+        self.router = Router(list_workers=1)
+        self.router.register_handler('dummy_list', list_dummy, False, True, False)
+        self.router.register_handler('nested_list', list_nested_dummy, False, True, False)
+
+        inner_folder = Item('inner', router=self.router)
+        inner_folder.expandable = True
+        inner_folder.add_route('dummy_list', False, True, False, kwargs={'items': [Item('item1')]})
+
+        folder = Item('testfolder', router=self.router)
+        folder.expandable = True
+        folder.add_route('nested_list', False, True, False, kwargs={'folder': inner_folder})
+
+        self.assertEqual([item.id for item in folder.list()], ['item1'])
+        self.assertEqual(self.router.stats['list_pool']['running'], 0)
+
+    def test_list_hung_handler(self):
+        hang = threading.Event()
+        self.router = Router(list_workers=1, list_timeout=0.1)
+        self.router.register_handler('dummy_list', list_dummy, False, True, False)
+        self.router.register_handler('hung_list', lambda item: hang.wait(), False, True, False)
+        try:
+            for i in range(3):
+                folder = Item('hungfolder%i' % (i, ), router=self.router)
+                folder.expandable = True
+                folder.add_route('hung_list', False, True, False)
+                self.assertEqual(folder.list(), [])
+
+                folder = Item('hungiterfolder%i' % (i, ), router=self.router)
+                folder.expandable = True
+                folder.add_route('hung_list', False, True, False)
+                self.assertEqual(list(folder.iter_list()), [])
+
+            folder = Item('testfolder', router=self.router)
+            folder.expandable = True
+            folder.add_route('dummy_list', False, True, False, kwargs={'items': [Item('item1')]})
+            self.assertEqual([item.id for item in folder.list()], ['item1'])
+
+            stats = self.router.stats
+            self.assertEqual(stats['list']['hung_list']['timeouts'], 3)
+            self.assertEqual(stats['list_pool']['abandoned'], 6)
+            self.assertEqual(stats['list_pool']['queued'], 0)
+        finally:
+            hang.set()
+
+    def test_stream_evaluation_hung(self):
+        hang = threading.Event()
+
+        class HungStream(DummyStream):
+            def evaluate(self):
+                hang.wait()
+
+        self.router = Router(evaluate_workers=2, evaluate_timeout=0.1)
+        self.router.register_handler('dummy_stream', stream_dummy, False, False, True)
+        self.router.register_handler('hung_stream', lambda item: HungStream(20, 'works20'), False, False, True)
+        try:
+            for i in range(3):
+                item = Item(id='stream%i' % (i, ), router=self.router)
+                item.streamable = True
+                item.add_route('hung_stream', False, False, True)
+                item.add_route('dummy_stream', False, False, True, kwargs={'expected_evaluation': 10, 'stream_value': 'works10'})
+                self.assertEqual(item.stream(), 'works10')
+
+            self.assertEqual(self.router.stats['evaluate']['hung_stream']['timeouts'], 3)
+        finally:
+            hang.set()
+
+    def test_hung_handler_does_not_block_exit(self):
+        script = (
+            'import threading\n'
+            'from thomas.filesystem import Item, Router\n'
+            'router = Router(list_timeout=0.1)\n'
+            'router.register_handler("hung_list", lambda item: threading.Event().wait(), False, True, False)\n'
+            'folder = Item("folder", router=router)\n'
+            'folder.expandable = True\n'
+            'folder.add_route("hung_list", False, True, False)\n'
+            'assert folder.list() == []\n'
+        )
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen([sys.executable, '-c', script], cwd=root, stdout=devnull, stderr=devnull)
+        start_time = time.time()
+        while process.poll() is None and time.time() - start_time < 20:
+            time.sleep(0.05)
+
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+            self.fail('Interpreter did not exit with a hung handler running')
+        self.assertEqual(process.returncode, 0)
+
+    def test_list_cache(self):
+        calls = []
+
+        def list_counting(item, items, delay=0):
+            calls.append(item.id)
+            time.sleep(delay)
+            item.nested_items = [Item(id) for id in items]
+            return item
+
+        self.router.register_handler('cached_list', list_counting, False, True, False, list_cache_ttl=60)
+
+        def create_folder():
+            folder = Item('testfolder', router=self.router)
+            folder.expandable = True
+            folder.add_route('cached_list', False, True, False, kwargs={'items': ['item1', 'item2'], 'delay': 0.2})
+            return folder
+
+        folders = [create_folder() for _ in range(3)]
+        threads = [threading.Thread(target=folder.list) for folder in folders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, ['testfolder'])
+        for folder in folders:
+            self.assertEqual([item.id for item in folder.nested_items], ['item1', 'item2'])
+        self.assertIsNot(folders[0].nested_items[0], folders[1].nested_items[0])
+
+        self.assertEqual([item.id for item in create_folder().list()], ['item1', 'item2'])
+        self.assertEqual(calls, ['testfolder'])
+        stats = self.router.stats['list_cache']
+        self.assertEqual((stats['misses'], stats['coalesced'], stats['hits']), (1, 2, 1))
+
+        self.router.invalidate_list_cache('testfolder')
+        create_folder().list()
+        self.assertEqual(calls, ['testfolder', 'testfolder'])
+
+    def test_list_cache_item_kwargs(self):
+        self.router.register_handler('cached_nested_list', list_nested_dummy, False, True, False, list_cache_ttl=60)
+
+        listings = []
+        for i in range(2):
+            # same id and attributes, only the path differs
+            disk = Item('disk%i' % (i, ), router=self.router)
+            source_folder = Item('source', router=self.router)
+            disk.add_item(source_folder)
+            source_folder.add_item(Item('item%i' % (i, )))
+
+            folder = Item('testfolder', router=self.router)
+            folder.expandable = True
+            folder.add_route('cached_nested_list', False, True, False, kwargs={'folder': source_folder})
+            listings.append([item.id for item in folder.list()])
+
+        self.assertEqual(listings, [['item0'], ['item1']])
+
+    def test_list_cache_detached(self):
+        def list_folder(item, items):
+            item.nested_items = []
+            for id in items:
+                nested_item = Item(id, router=self.router)
+                nested_item.expandable = True
+                nested_item.add_route('cached_list', False, True, False, kwargs={'items': []})
+                item.nested_items.append(nested_item)
+            return item
+
+        self.router.register_handler('cached_list', list_folder, False, True, False, list_cache_ttl=60)
+
+        def create_folder():
+            folder = Item('a', router=self.router)
+            folder.expandable = True
+            folder.add_route('cached_list', False, True, False, kwargs={'items': ['b']})
+            return folder
+
+        live_folder = create_folder()
+        live_folder.list()
+        live_b = live_folder.nested_items[0]
+        live_b['changed'] = True
+        live_b.list()
+        live_b.add_item(Item('live child'))
+
+        cached_b = create_folder().list()[0]
+        self.assertNotIn('changed', cached_b)
+        self.assertFalse(cached_b.is_expanded)
+
+    def test_iter_list(self):
+        continue_listing = threading.Event()
+
+        def list_paged(item, pages):
+            for page in pages:
+                yield [Item(id) for id in page]
+                continue_listing.wait(5)
+
+        self.router.register_handler('paged_list', list_paged, False, True, False)
+        folder = Item('testfolder', router=self.router)
+        folder.expandable = True
+        folder.add_route('paged_list', False, True, False, kwargs={'pages': [['item1', 'item2'], ['item3']]})
+        folder.add_route('dummy_list', False, True, False, kwargs={'items': [Item('item2'), Item('item4')]})
+
+        listed_items = folder.iter_list()
+        first_item = next(listed_items)
+        self.assertEqual(first_item.path, 'testfolder/%s' % (first_item.id, ))
+        seen_ids = set([first_item.id, next(listed_items).id])
+        self.assertIsNone(folder.nested_items)
+
+        continue_listing.set()
+        seen_ids.update(item.id for item in listed_items)
+        self.assertEqual(seen_ids, set(['item1', 'item2', 'item3', 'item4']))
+        self.assertEqual(sorted(item.id for item in folder.nested_items), ['item1', 'item2', 'item3', 'item4'])
+        self.assertEqual([item.id for item in folder.iter_list()], [item.id for item in folder.nested_items])
+
+    def test_list_paged_handler(self):
+        def list_paged(item, pages):
+            for page in pages:
+                yield [Item(id) for id in page]
+
+        self.router.register_handler('paged_list', list_paged, False, True, False)
+        folder = Item('testfolder', router=self.router)
+        folder.expandable = True
+        folder.add_route('paged_list', False, True, False, kwargs={'pages': [['item1', 'item2'], ['item3']]})
+        self.assertEqual([item.id for item in folder.list()], ['item1', 'item2', 'item3'])
+
+    def test_id_index(self):
+        folder = Item('folder')
+        for i in range(1000):
+            folder.add_item(Item('item%i' % (i, )))
+        index = folder.get_id_index()
+
+        folder.add_item(Item('added'))
+        self.assertIs(folder.get_id_index(), index)
+        self.assertEqual(folder.get_item_from_path('folder/added').id, 'added')
+        self.assertEqual(folder.get_item_from_path('folder/item999').id, 'item999')
+        self.assertIsNone(folder.get_item_from_path('folder/missing'))
+
+        other_folder = Item('folder')
+        other_folder.add_item(Item('merged'))
+        other_item = Item('item5', attributes={'a': 1})
+        other_folder.add_item(other_item)
+        folder.merge(other_folder)
+        self.assertIs(folder.get_id_index(), index)
+        self.assertEqual(len(folder.nested_items), 1002)
+        self.assertEqual(folder.get_item_from_path('folder/merged').id, 'merged')
+        self.assertEqual(folder.get_item_from_path('folder/item5')['a'], 1)
+
+        folder.nested_items = [Item('replaced')]
+        self.assertEqual(list(folder.get_id_index().keys()), ['replaced'])
+
+        version = folder.version
+        folder.nested_items[0] = Item('Changed')
+        self.assertEqual(list(folder.get_id_index().keys()), ['Changed'])
+        self.assertEqual(list(folder.get_name_index().keys()), ['changed'])
+        self.assertGreater(folder.version, version)
+
+        folder.nested_items.append(Item('appended'))
+        del folder.nested_items[0]
+        self.assertEqual(list(folder.get_id_index().keys()), ['appended'])
+
+    def test_shared_routes(self):
+        items = []
+        for i in range(2):
+            item = Item('item%i' % (i, ), router=self.router, attributes={'size': 5})
+            item.readable = True
+            item.add_route('dummy_file', True, False, False, kwargs={'data': b'12345'})
+            items.append(item)
+
+        self.assertIs(items[0]._routes, items[1]._routes)
+        self.assertRaises(TypeError, items[0]._routes[0].__setitem__, 'priority', 5)
+        self.assertEqual(items[1].open().read(), b'12345')
+
+        items[0].routes[0]['kwargs']['data'] = b'54321'
+        self.assertEqual(items[0].open().read(), b'54321')
+        self.assertEqual(items[1].open().read(), b'12345')
+
+        items[1].routes.insert(0, dict(items[1].routes[0], priority=10, kwargs={'data': b'abcde'}))
+        self.assertEqual(items[1].open().read(), b'abcde')
+        self.assertEqual(len(items[1].serialize(include_routes=True)['routes']), 2)
+
+        items[0].readable = False
+        self.assertFalse(items[0].readable)
+        self.assertTrue(items[1].readable)
+
+        items[0].custom_attribute = 'value'
+        self.assertEqual(items[0].custom_attribute, 'value')
+
+    def test_memory_per_item(self):
+        if tracemalloc is None:
+            self.skipTest('tracemalloc not available')
+
+        item_count = 10000
+        folder = Item('folder', router=self.router)
+        tracemalloc.start()
+        try:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            for i in range(item_count):
+                item = Item('file%06i.mkv' % (i, ), router=self.router, attributes={'size': i, 'modified': 1000})
+                item.readable = True
+                item.add_route('dummy_file', True, False, False, kwargs={'data': b''})
+                folder.add_item(item)
+            memory_per_item = float(tracemalloc.get_traced_memory()[0] - start_memory) / item_count
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(memory_per_item, 600)
+
+    def test_duplicate(self):
+        folder = Item('folder', router=self.router)
+        folder.expandable = True
+        folder.add_route('dummy_list', False, True, False, kwargs={'items': []})
+        sub_folder = Item('subfolder', router=self.router, attributes={'a': 1, '_hidden': 2})
+        sub_folder.expandable = True
+        sub_folder.add_route('dummy_list', False, True, False, kwargs={'items': []})
+        folder.add_item(sub_folder)
+        sub_folder.add_item(Item('file', router=self.router))
+
+        copied_folder = folder.duplicate()
+        self.assertFalse(copied_folder.expandable)
+        self.assertIsNone(copied_folder.routes)
+        self.assertTrue(copied_folder.is_expanded)
+
+        folder.add_item(Item('added_later', router=self.router))
+        copied_sub_folder = copied_folder.nested_items[0]
+        self.assertEqual([item.id for item in copied_folder.nested_items], ['subfolder'])
+        self.assertIsNot(copied_sub_folder, sub_folder)
+        self.assertIs(copied_sub_folder.parent_item, copied_folder)
+        self.assertEqual(dict(copied_sub_folder), {'a': 1})
+        self.assertTrue(copied_sub_folder.expandable)
+        self.assertIsNone(copied_sub_folder.routes)
+
+        copied_sub_folder['a'] = 3
+        copied_sub_folder.nested_items[0]['b'] = 4
+        self.assertEqual(sub_folder['a'], 1)
+        self.assertNotIn('b', sub_folder.nested_items[0])
+
+        copied_folder = folder.duplicate(clear_routes=False, clear_nested=True)
+        self.assertTrue(copied_folder.expandable)
+        self.assertEqual(copied_folder.routes, folder.routes)
+        self.assertIsNone(copied_folder.nested_items)
+        self.assertEqual(folder.duplicate(clear_routes=False).nested_items[0].routes, sub_folder.routes)
+        self.assertEqual(folder.duplicate(clear_routes=False).serialize(include_routes=True), folder.serialize(include_routes=True))
+
+    def test_duplicate_copy_on_write(self):
+        def create_tree():
+            folder = Item('folder', router=self.router, attributes={'tags': ['a']})
+            sub_folder = Item('subfolder', router=self.router, attributes={'a': 1})
+            folder.add_item(sub_folder)
+            sub_folder.add_item(Item('file', router=self.router, attributes={'b': 1}))
+            return folder
+
+        folder = create_tree()
+        copied_folder = folder.duplicate()
+
+        folder.nested_items[0]['a'] = 2
+        folder.nested_items[0].nested_items[0]['b'] = 2
+        folder.nested_items[0].nested_items[0].readable = True
+        folder.nested_items[0].add_item(Item('added', router=self.router))
+        folder.add_item(Item('added', router=self.router))
+
+        other_folder = create_tree()
+        other_folder['tags'] = ['b']
+        other_folder.nested_items[0].add_item(Item('merged', router=self.router))
+        folder.merge(other_folder)
+
+        self.assertEqual(folder['tags'], ['a', 'b'])
+        self.assertEqual(sorted(item.id for item in folder.nested_items[0].nested_items), ['added', 'file', 'merged'])
+        self.assertEqual(copied_folder.serialize(), create_tree().duplicate().serialize())
+
+        # and the other way around
+        folder = create_tree()
+        copied_folder = folder.duplicate()
+        copied_folder.nested_items[0].nested_items[0]['b'] = 2
+        copied_folder.nested_items[0].add_item(Item('added', router=self.router))
+        self.assertEqual(folder.serialize(), create_tree().serialize())
+
+    def test_merge_deep(self):
+        def create_chain(leaf_id):
+            root = item = Item('root')
+            for i in range(2000):
+                nested_item = Item('level%i' % (i, ))
+                item.add_item(nested_item)
+                item = nested_item
+            item.add_item(Item(leaf_id, attributes={'size': 1}))
+            return root, item
+
+        root, deepest_item = create_chain('leaf1')
+        other_root, _ = create_chain('leaf2')
+        root.merge(other_root)
+
+        self.assertEqual(sorted(item.id for item in deepest_item.nested_items), ['leaf1', 'leaf2'])
+        self.assertIs(deepest_item.nested_items[1].parent_item, deepest_item)
+
+    def test_merge_many(self):
+        folder = Item('folder')
+        listings = []
+        for i in range(3):
+            listing = Item('folder', attributes={'size': i})
+            listing.expandable = i == 1
+            listing.add_item(Item('shared', attributes={'from%i' % (i, ): True}))
+            listing.add_item(Item('item%i' % (i, )))
+            listings.append(listing)
+
+        folder.merge(*listings)
+        self.assertEqual(folder['size'], 2)
+        self.assertTrue(folder.expandable)
+        self.assertEqual(sorted(item.id for item in folder.nested_items), ['item0', 'item1', 'item2', 'shared'])
+        self.assertEqual(sorted(folder.get_item_from_path('folder/shared').keys()), ['from0', 'from1', 'from2'])
+        for item in folder.nested_items:
+            self.assertIs(item.parent_item, folder)
+
+    def test_merge_many_same_as_one_by_one(self):
+        def create_listings():
+            listings = []
+            for i in range(4):
+                listing = Item('folder', router=self.router, attributes={'tags': ['listing%i' % (i, )]})
+                for j in range(i, i + 3):
+                    item = Item('file%i' % (j, ), router=self.router, attributes={'size': i + j, 'tags': [i]})
+                    item.readable = True
+                    if i % 2:
+                        item.add_route('dummy_file', True, False, False, kwargs={'data': b'%i' % (i, )})
+                    listing.add_item(item)
+                listings.append(listing)
+            return listings
+
+        folder = Item('folder', router=self.router)
+        for listing in create_listings():
+            folder.merge(listing)
+
+        batch_folder = Item('folder', router=self.router)
+        batch_folder.merge(*create_listings())
+        self.assertEqual(batch_folder.serialize(include_routes=True), folder.serialize(include_routes=True))
+        self.assertEqual(batch_folder.get_item_from_path('folder/file3')['tags'], [1, 2, 3])
+
+    def test_deduplicate_unshared_routes(self):
+        items = [Item('file')]
+        item = Item(id='item')
+        item.expandable = True
+        item.add_route('dummy_list', False, True, False, kwargs={'items': items})
+        item.add_route('dummy_list', False, True, False, kwargs={'items': items})
+        item.add_route('dummy_list', False, True, False, kwargs={'items': [Item('other file')]})
+        self.assertFalse(item._routes[0].shared)
+        self.assertEqual(len(item.routes), 2)
+
+    def test_route_kwargs_types(self):
+        routes = []
+        for value in [[1, 2], (1, 2), True, 1]:
+            item = Item(id='item')
+            item.expandable = True
+            item.add_route('dummy_list', False, True, False, kwargs={'value': value})
+            routes.append(item._routes[0])
+
+        self.assertEqual(len(set(id(route) for route in routes)), 4)
+        self.assertEqual([type(route['kwargs']['value']) for route in routes], [FrozenList, tuple, bool, int])
+
+        kwargs = {'items': [1]}
+        item = Item(id='item')
+        item.expandable = True
+        item.add_route('dummy_list', False, True, False, kwargs=kwargs)
+        kwargs['items'].append(2)
+        kwargs['other'] = 3
+        self.assertEqual(item._routes[0]['kwargs'], {'items': [1]})
+        self.assertRaises(TypeError, item._routes[0]['kwargs'].__setitem__, 'other', 3)
+        self.assertRaises(TypeError, item._routes[0]['kwargs']['items'].append, 2)
+
+        item.routes[0]['kwargs']['items'].append(2)
+        self.assertEqual(item.routes[0]['kwargs'], {'items': [1, 2]})
+
+    def test_route_dispatch(self):
+        items = []
+        for i in range(2):
+            item = Item('item%i' % (i, ), router=self.router, attributes={'size': 5})
+            item.readable = True
+            item.add_route('other_file', True, False, False, kwargs={'data': b'other'}, priority=20)
+            item.add_route('dummy_file', True, False, False, kwargs={'data': b'low'})
+            item.add_route('dummy_file', True, False, False, kwargs={'data': b'high'}, priority=10)
+            items.append(item)
+
+        self.assertIs(items[0]._routes, items[1]._routes)
+        self.assertEqual(items[0].open().read(), b'high')
+        self.assertEqual(len(items[0]._routes.dispatch), 1)
+
+        self.router.register_handler('other_file', open_dummy, True, False, False)
+        self.assertEqual(items[1].open().read(), b'other')
+
+        self.router.unregister_handler('other_file')
+        self.assertEqual(items[1].open().read(), b'high')
@@ -0,0 +1,318 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from ..filesystem import Item, Router
+from ..inputs.rclone import RCloneInput, RCloneLister, RCloneProcessPool, parse_modtime
+
+FAKE_RCLONE = '''#!%(python)s
+import json
+import os
+import sys
+import time
+
+with open(%(log_path)r, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+
+time.sleep(%(delay)r)
+
+args = sys.argv[1:]
+cmd, args = args[0], args[1:]
+options = {}
+positional = []
+while args:
+    arg = args.pop(0)
+    if arg == '--fast-list':
+        continue
+    elif arg == '-R':
+        options['recursive'] = True
+    elif arg.startswith('--'):
+        options[arg[2:]] = args.pop(0)
+    else:
+        positional.append(arg)
+
+if cmd == 'cat':
+    with open(positional[0], 'rb') as f:
+        if 'tail' in options:
+            f.seek(-int(options['tail']), os.SEEK_END)
+        else:
+            f.seek(int(options.get('offset', 0)))
+        count = int(options.get('count', -1))
+        try:
+            os.remove(%(short_path)r)
+        except OSError:
+            pass
+        else:
+            # cut this output short, like a dropped connection
+            count = count // 2
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        while count:
+            d = f.read(count > 0 and min(count, 8192) or 8192)
+            if not d:
+                break
+            out.write(d)
+            count -= len(d)
+elif cmd == 'lsjson':
+    root = positional[0]
+    result = []
+    for path, dirnames, filenames in os.walk(root):
+        for name in sorted(dirnames) + sorted(filenames):
+            full_path = os.path.join(path, name)
+            is_dir = os.path.isdir(full_path)
+            result.append({
+                'Path': os.path.relpath(full_path, root).replace(os.sep, '/'),
+                'Name': name,
+                'Size': is_dir and -1 or os.path.getsize(full_path),
+                'ModTime': time.strftime('%%Y-%%m-%%dT%%H:%%M:%%S.123456789Z', time.gmtime(os.path.getmtime(full_path))),
+                'IsDir': is_dir,
+            })
+        if not options.get('recursive'):
+            break
+    sys.stdout.write(json.dumps(result))
+'''
+
+
+class FakeRCloneTestCase(unittest.TestCase):
+    rclone_delay = 0.0
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.temp_path, 'rclone.log')
+        self.rclone_path = os.path.join(self.temp_path, 'rclone')
+        self.short_path = os.path.join(self.temp_path, 'short')
+        with open(self.rclone_path, 'w') as f:
+            f.write(FAKE_RCLONE % {'python': sys.executable, 'log_path': self.log_path, 'delay': self.rclone_delay,
+                                   'short_path': self.short_path})
+        os.chmod(self.rclone_path, os.stat(self.rclone_path).st_mode | stat.S_IEXEC)
+
+        self.pool = RCloneProcessPool()
+        self.data = bytes(bytearray(i % 251 for i in range(100000)))
+        self.data_path = os.path.join(self.temp_path, 'data.bin')
+        with open(self.data_path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.pool.clear()
+        shutil.rmtree(self.temp_path)
+
+    def rclone_calls(self):
+        if not os.path.exists(self.log_path):
+            return []
+
+        with open(self.log_path) as f:
+            return f.read().splitlines()
+
+    def create_input(self, size=None, **kwargs):
+        kwargs.setdefault('pool', self.pool)
+        return RCloneInput(None, self.data_path, size or len(self.data), rclone_path=self.rclone_path, **kwargs)
+
+    def read_all(self, rclone_input, num_bytes=10000):
+        data = b''
+        while True:
+            d = rclone_input.read(num_bytes)
+            if not d:
+                return data
+            data += d
+
+
+class TestRCloneInput(FakeRCloneTestCase):
+    def test_read(self):
+        rclone_input = self.create_input()
+        rclone_input.seek(500)
+        self.assertEqual(self.read_all(rclone_input), self.data[500:])
+        self.assertEqual(rclone_input.tell(), len(self.data))
+        rclone_input.close()
+
+    def test_read_segmented(self):
+        rclone_input = self.create_input(segments=3, buffer_size=1, piece_config={'min_piece_size': 14, 'max_piece_size': 15})
+        rclone_input.seek(1234)
+        self.assertEqual(self.read_all(rclone_input, 3000), self.data[1234:])
+        rclone_input.close()
+
+        calls = self.rclone_calls()
+        self.assertEqual(len(calls), len(range(1234, len(self.data), 16384)))
+        self.assertTrue(all('--count' in call for call in calls))
+
+    def test_read_segmented_reseek(self):
+        rclone_input = self.create_input(segments=2, piece_config={'min_piece_size': 12, 'max_piece_size': 13})
+        rclone_input.seek(90000)
+        self.assertEqual(rclone_input.read(100), self.data[90000:90100])
+        rclone_input.seek(10)
+        self.assertEqual(rclone_input.read(100), self.data[10:110])
+        rclone_input.seek(len(self.data))
+        self.assertEqual(rclone_input.read(100), b'')
+        rclone_input.close()
+
+    def test_read_segmented_short_output(self):
+        with open(self.short_path, 'w'):
+            pass
+
+        rclone_input = self.create_input(segments=1, piece_config={'min_piece_size': 14, 'max_piece_size': 15})
+        self.assertEqual(self.read_all(rclone_input), self.data)
+        rclone_input.close()
+
+        calls = self.rclone_calls()
+        self.assertFalse(os.path.exists(self.short_path))
+        self.assertEqual(calls[:2], ['cat --fast-list %s --offset 0 --count 16384' % (self.data_path, ),
+                                     'cat --fast-list %s --offset 8192 --count 8192' % (self.data_path, )])
+
+    def test_read_segmented_missing_data(self):
+        rclone_input = self.create_input(size=len(self.data) + 1000, segments=1,
+                                         piece_config={'min_piece_size': 14, 'max_piece_size': 15})
+        self.assertRaises(IOError, self.read_all, rclone_input)
+        rclone_input.close()
+
+        last_piece_start = len(self.data) + 1000 - (len(self.data) + 1000) % 16384
+        self.assertEqual(len([call for call in self.rclone_calls() if '--offset %i ' % (last_piece_start, ) in call]), 1)
+        self.assertEqual(len([call for call in self.rclone_calls() if '--offset %i ' % (len(self.data), ) in call]), 2)
+
+    def test_reseek(self):
+        rclone_input = self.create_input(max_skip_size=1000)
+        rclone_input.seek(5000)
+        self.assertEqual(rclone_input.read(10), self.data[5000:5010])
+        rclone_input.seek(5500)
+        self.assertEqual(rclone_input.read(10), self.data[5500:5510])
+        self.assertEqual(len(self.rclone_calls()), 1)
+
+        rclone_input.seek(100)
+        self.assertEqual(rclone_input.read(10), self.data[100:110])
+        rclone_input.seek(10, os.SEEK_END)
+        self.assertEqual(rclone_input.read(100), self.data[-10:])
+        rclone_input.seek(5600)
+        self.assertEqual(rclone_input.read(10), self.data[5600:5610])
+        rclone_input.close()
+
+        self.assertEqual(len(self.rclone_calls()), 3)
+        self.assertEqual(self.pool.stats['hits'], 1)
+
+
+class TestRCloneProcessPool(FakeRCloneTestCase):
+    def pooled_read(self, pos):
+        rclone_input = self.create_input()
+        rclone_input.seek(pos)
+        self.assertEqual(rclone_input.read(100), self.data[pos:pos + 100])
+        rclone_input.close()
+
+    def test_warm_continuation(self):
+        self.pooled_read(20000)
+        self.pooled_read(20100)
+        self.assertEqual(self.pool.stats['misses'], 1)
+        self.assertEqual(self.pool.stats['hits'], 1)
+        self.assertEqual(len(self.rclone_calls()), 1)
+
+    def test_prespawn_recent_offset(self):
+        self.pooled_read(0)
+        self.pooled_read(50000)
+        self.pooled_read(0)
+        self.assertEqual(self.pool.stats['prespawns'], 1)
+        hits, misses = self.pool.stats['hits'], self.pool.stats['misses']
+
+        # served by the pre-spawned process
+        self.pooled_read(0)
+        self.assertEqual(self.pool.stats['hits'], hits + 1)
+        self.assertEqual(self.pool.stats['misses'], misses)
+
+    def test_reap_idle(self):
+        self.pool = RCloneProcessPool(max_idle_time=0.1)
+        self.pooled_read(0)
+        process = self.pool._processes[0][2]
+        self.assertEqual(self.pool.stats['idle'], 1)
+
+        for _ in range(100):
+            if not self.pool.stats['idle']:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(self.pool.stats['idle'], 0)
+        self.assertIsNotNone(process.poll())
+        self.assertIsNone(self.pool._reaper)
+
+
+class TestRCloneLister(FakeRCloneTestCase):
+    def setUp(self):
+        super(TestRCloneLister, self).setUp()
+        self.remote_path = os.path.join(self.temp_path, 'remote')
+        for dir_path in ['a/b', 'c']:
+            os.makedirs(os.path.join(self.remote_path, dir_path))
+
+        for file_path in ['file1', 'a/file2', 'a/b/file3', 'c/file4']:
+            with open(os.path.join(self.remote_path, file_path), 'wb') as f:
+                f.write(b'x' * len(file_path))
+
+        self.lister = RCloneLister()
+        self.router = Router()
+        self.router.register_handler('rclone', RCloneInput, True, False, False)
+        self.router.register_handler('rclone_list', self.lister, False, True, False)
+
+    def create_root(self, **kwargs):
+        kwargs.update({'path': self.remote_path, 'rclone_path': self.rclone_path})
+        root = Item('remote', router=self.router)
+        root.expandable = True
+        root.add_route('rclone_list', False, True, False, kwargs=kwargs)
+        return root
+
+    def lsjson_calls(self):
+        return [call for call in self.rclone_calls() if call.startswith('lsjson')]
+
+    def test_parse_modtime(self):
+        self.assertEqual(parse_modtime('2017-05-31T16:15:57.034468261+01:00'), 1496243757)
+        self.assertEqual(parse_modtime('2017-05-31T15:15:57Z'), 1496243757)
+        self.assertEqual(parse_modtime('bad'), 0)
+
+    def test_list(self):
+        root = self.create_root()
+        self.assertEqual(sorted(item.id for item in root.list()), ['a', 'c', 'file1'])
+
+        item_a = root.get_item_from_path('remote/a')
+        self.assertTrue(item_a.is_listable)
+        self.assertFalse(item_a.is_expanded)
+        self.assertEqual(sorted(item.id for item in item_a.list()), ['b', 'file2'])
+
+        file2 = root.get_item_from_path('remote/a/file2')
+        self.assertEqual(file2['size'], 7)
+        f = file2.open()
+        self.assertEqual(f.read(), b'xxxxxxx')
+        f.close()
+
+        self.assertEqual(len(self.lsjson_calls()), 2)
+
+    def test_list_cached(self):
+        self.create_root().list()
+        self.create_root().list()
+        self.assertEqual(len(self.lsjson_calls()), 1)
+
+    def test_list_recursive(self):
+        root = self.create_root(recursive=True)
+        root.list()
+        file3 = root.get_item_from_path('remote/a/b/file3')
+        self.assertEqual(file3['size'], 9)
+
+        root = self.create_root(recursive=True)
+        root.list()
+        self.assertEqual(root.get_item_from_path('remote/c/file4')['size'], 7)
+        self.assertEqual(self.lsjson_calls(), ['lsjson --fast-list %s -R' % (self.remote_path, )])
+
+    def test_refresh_changed_subtree(self):
+        self.create_root(recursive=True, cache_ttl=0.5, max_age=60).list()
+        time.sleep(0.6)
+
+        c_path = os.path.join(self.remote_path, 'c')
+        with open(os.path.join(c_path, 'file5'), 'wb') as f:
+            f.write(b'new')
+        os.utime(c_path, (time.time() + 10, time.time() + 10))
+
+        root = self.create_root(recursive=True, cache_ttl=0.5, max_age=60)
+        root.list()
+        self.assertTrue(root.get_item_from_path('remote/a/b').is_expanded)
+        self.assertFalse(root.get_item_from_path('remote/c').is_expanded)
+        self.assertEqual(sorted(item.id for item in root.get_item_from_path('remote/c').list()), ['file4', 'file5'])
+
+        self.assertEqual(self.lsjson_calls(), [
+            'lsjson --fast-list %s -R' % (self.remote_path, ),
+            'lsjson --fast-list %s' % (self.remote_path, ),
+            'lsjson --fast-list %s -R' % (c_path, ),
+        ])
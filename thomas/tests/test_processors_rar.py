@@ -0,0 +1,436 @@
+import gc
+import shutil
+import struct
+import threading
+import time
+import tempfile
+import unittest
+import weakref
+import zlib
+
+from io import BytesIO
+
+from ..filesystem import Item, Router
+from ..processors import rar
+from ..processors.rar import (RarMetadataCache, RarProcessor, RarProcessorFile, build_member_layouts, list_rar_members,
+                              rar_index_cache, rar_metadata_cache)
+from ..processors.virtualfile import open_virtualfile
+
+
+class RarVolumesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.temp_path = tempfile.mkdtemp()
+
+        def open_recording(item, data):
+            self.opened.append(item.id)
+            return BytesIO(data)
+
+        self.router = Router()
+        self.router.register_handler('recording', open_recording, True, False, False)
+
+        self.filesystem = Item('folder', router=self.router)
+        for name, data in [('archive.rar', b'HEADERabcdTAIL'), ('archive.r00', b'HEADERefghTAIL'), ('archive.r01', b'HEADERijTAIL')]:
+            item = Item(name, attributes={'size': len(data)}, router=self.router)
+            item.readable = True
+            item.add_route('recording', True, False, False, kwargs={'data': data})
+            self.filesystem.add_item(item)
+
+        self.layout = {
+            'filename': 'folder/file.mkv',
+            'file_size': 10,
+            'compress_size': 4,
+            'volumes': [
+                {'id': 'archive.rar', 'size': 14, 'seek': 6, 'read_size': 4},
+                {'id': 'archive.r00', 'size': 14, 'seek': 6, 'read_size': 4},
+                {'id': 'archive.r01', 'size': 12, 'seek': 6, 'read_size': 2},
+            ]
+        }
+
+    def tearDown(self):
+        rar_index_cache.clear()
+        shutil.rmtree(self.temp_path)
+
+
+class TestRarIndexCache(RarVolumesTestCase):
+    def test_cached_layout_no_io(self):
+        entry_item = self.filesystem.nested_items[0]
+        rar_index_cache.set(entry_item, self.layout)
+
+        rar_processor = RarProcessor(self.filesystem, entry_item, lazy=True)
+        self.assertEqual(self.opened, [])
+        self.assertEqual(rar_processor.id, 'folder/file.mkv')
+        self.assertEqual(rar_processor.filename, 'file.mkv')
+        self.assertEqual(rar_processor['size'], 10)
+        self.assertEqual(rar_processor.get_read_items(), self.filesystem.nested_items)
+
+        f = rar_processor.open()
+        self.assertEqual(f.read(100) + f.read(100) + f.read(100), b'abcdefghij')
+        f.close()
+
+    def test_sidecar(self):
+        entry_item = self.filesystem.nested_items[0]
+        rar_index_cache.set(entry_item, self.layout, self.temp_path)
+        rar_index_cache.clear()
+
+        self.assertIsNone(rar_index_cache.get(self.filesystem, entry_item))
+        layout, volume_items = rar_index_cache.get(self.filesystem, entry_item, self.temp_path)
+        self.assertEqual(layout['volumes'], self.layout['volumes'])
+        self.assertEqual(volume_items, self.filesystem.nested_items)
+
+    def test_changed_volume_not_used(self):
+        entry_item = self.filesystem.nested_items[0]
+        rar_index_cache.set(entry_item, self.layout)
+        self.filesystem.nested_items[2]['size'] = 13
+        self.assertIsNone(rar_index_cache.get(self.filesystem, entry_item))
+
+
+class StubVirtualRarFile(object):
+    def __init__(self, filesystem=None, opened_with=None):
+        self.filesystem = filesystem
+        self.opened_with = [] if opened_with is None else opened_with
+
+    def detach(self):
+        return StubVirtualRarFile(None, self.opened_with)
+
+    def bind(self, filesystem):
+        return StubVirtualRarFile(filesystem, self.opened_with)
+
+    def open_with_volume(self, inf, volume_file):
+        self.opened_with.append((inf, volume_file))
+        return volume_file
+
+
+class TestRarMetadataCache(RarVolumesTestCase):
+    def test_reuse_metadata(self):
+        cache = RarMetadataCache()
+        entry_item = self.filesystem.nested_items[0]
+        vrf = StubVirtualRarFile(self.filesystem)
+
+        self.assertIsNone(cache.get(self.filesystem, entry_item))
+        cache.set(entry_item, vrf, self.filesystem.nested_items)
+        cached_vrf = cache.get(self.filesystem, entry_item)
+        self.assertIsNot(cached_vrf, vrf)
+        self.assertIs(cached_vrf.filesystem, self.filesystem)
+        self.assertIsNone(cache._archives[(entry_item.path, entry_item['size'])][0].filesystem)
+        self.assertEqual(self.opened, [])
+
+        for _ in range(2):
+            f = RarProcessorFile(vrf, 'info', entry_item)
+            f.seek(6)
+            self.assertEqual(f.read(4), b'abcd')
+            f.close()
+
+        self.assertEqual(self.opened, ['archive.rar', 'archive.rar'])
+        self.assertEqual([inf for inf, _ in vrf.opened_with], ['info', 'info'])
+        self.assertIsNot(vrf.opened_with[0][1], vrf.opened_with[1][1])
+
+    def test_changed_volume_not_used(self):
+        cache = RarMetadataCache()
+        entry_item = self.filesystem.nested_items[0]
+        cache.set(entry_item, StubVirtualRarFile(), self.filesystem.nested_items)
+        self.filesystem.nested_items[1]['size'] = 15
+        self.assertIsNone(cache.get(self.filesystem, entry_item))
+
+    def test_bounded(self):
+        cache = RarMetadataCache(max_entries=1)
+        first, second = self.filesystem.nested_items[:2]
+        cache.set(first, StubVirtualRarFile(), [first])
+        cache.set(second, StubVirtualRarFile(), [second])
+        self.assertIsNone(cache.get(self.filesystem, first))
+        self.assertIsNotNone(cache.get(self.filesystem, second))
+
+
+def file_header(filename, file_size, seek, read_size, split_before=False, stored=True):
+    return {
+        'filename': filename,
+        'file_size': file_size,
+        'stored': stored,
+        'encrypted': False,
+        'is_dir': False,
+        'split_before': split_before,
+        'seek': seek,
+        'read_size': read_size,
+    }
+
+
+class TestRarMembers(RarVolumesTestCase):
+    def test_member_layouts(self):
+        volume_items = self.filesystem.nested_items
+        volumes = [
+            (volume_items[0], [file_header('sample.mkv', 2, 0, 2), file_header('main.mkv', 8, 6, 4)]),
+            (volume_items[1], [file_header('main.mkv', 8, 6, 4, split_before=True)]),
+            (volume_items[2], [file_header('packed.nfo', 20, 6, 2, stored=False)]),
+        ]
+        layouts = build_member_layouts(volumes)
+        self.assertEqual([layout['filename'] for layout in layouts], ['sample.mkv', 'main.mkv'])
+        self.assertEqual([(volume['id'], volume['seek'], volume['read_size']) for volume in layouts[1]['volumes']],
+                         [('archive.rar', 6, 4), ('archive.r00', 6, 4)])
+
+        self.router.register_handler('virtualfile', open_virtualfile, True, False, False)
+        member_item = Item('main.mkv', attributes={'size': 8}, router=self.router)
+        member_item.readable = True
+        file_elements = [{'item': volume['item'], 'seek': volume['seek'], 'read_size': volume['read_size']}
+                         for volume in layouts[1]['volumes']]
+        member_item.add_route('virtualfile', True, False, False, kwargs={'file_elements': file_elements})
+
+        f = member_item.open()
+        f.seek(2)
+        self.assertEqual(f.read(100) + f.read(100), b'cdefgh')
+        f.close()
+
+    def test_member_size_mismatch(self):
+        volumes = [(self.filesystem.nested_items[0], [file_header('main.mkv', 10, 6, 4)])]
+        self.assertEqual(build_member_layouts(volumes), [])
+
+
+class StubHeaderParser(object):
+    def __init__(self, filesystem):
+        self.filesystem = filesystem
+
+    def _next_volname_to_item(self, filename):
+        next_volume = {'archive.rar': 'archive.r00', 'archive.r00': 'archive.r01'}.get(filename)
+        return next_volume and self.filesystem.get_name_index().get(next_volume)
+
+
+class TestRarProbe(RarVolumesTestCase):
+    def setUp(self):
+        super(TestRarProbe, self).setUp()
+        self.file_headers = {
+            'archive.rar': [file_header('file.mkv', 9, 6, 4)],
+            'archive.r00': [file_header('file.mkv', 9, 7, 3, split_before=True)],
+            'archive.r01': [file_header('file.mkv', 9, 6, 2, split_before=True)],
+        }
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+        def scan_volume(filesystem, volume_item):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(0.05)
+            with self.lock:
+                self.running -= 1
+            return StubHeaderParser(filesystem), self.file_headers[volume_item.id]
+
+        self.orig_scan_volume = rar._scan_volume
+        rar._scan_volume = scan_volume
+
+    def tearDown(self):
+        rar._scan_volume = self.orig_scan_volume
+        super(TestRarProbe, self).tearDown()
+
+    def test_probe_misaligned(self):
+        rar_processor = RarProcessor(self.filesystem, self.filesystem.nested_items[0], lazy=True, probe_workers=4)
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(rar_processor['size'], 9)
+        self.assertEqual(rar_processor.get_read_items(), self.filesystem.nested_items)
+
+        f = rar_processor.open()
+        self.assertEqual(f.read(100) + f.read(100) + f.read(100), b'abcdfghij')
+        f.close()
+
+    def test_probe_compressed(self):
+        self.file_headers['archive.rar'] = [file_header('file.mkv', 9, 6, 4, stored=False)]
+        self.assertRaises(IOError, RarProcessor, self.filesystem, self.filesystem.nested_items[0],
+                          lazy=True, probe_workers=4)
+
+
+def split_members(members, volume_data_size):
+    """Splits the data of members over volumes with at most volume_data_size data each"""
+    volumes = [[]]
+    space = volume_data_size
+    for filename, content in members:
+        pos = 0
+        while True:
+            if space == 0:
+                volumes.append([])
+                space = volume_data_size
+
+            data = content[pos:pos + space]
+            volumes[-1].append({
+                'filename': filename,
+                'file_size': len(content),
+                'data': data,
+                'split_before': pos > 0,
+                'split_after': pos + len(data) < len(content),
+            })
+            pos += len(data)
+            space -= len(data)
+            if pos >= len(content):
+                break
+
+    return volumes
+
+
+def rar4_block(block_type, flags, body):
+    header = struct.pack('<BHH', block_type, flags, 7 + len(body)) + body
+    return struct.pack('<H', zlib.crc32(header) & 0xFFFF) + header
+
+
+def create_rar4_volumes(members, volume_data_size):
+    """Creates a stored RAR4 set named name.rar, name.r00, ..."""
+    dos_time = (39 << 25) | (1 << 21) | (1 << 16)
+    volumes = split_members(members, volume_data_size)
+    datas = []
+    for i, parts in enumerate(volumes):
+        data = b'Rar!\x1a\x07\x00' + rar4_block(0x73, 0x0001 | (0x0100 if i == 0 else 0), b'\x00' * 6)
+        for part in parts:
+            filename = part['filename'].replace('/', '\\').encode('utf-8')
+            flags = 0x8000 | (0x01 if part['split_before'] else 0) | (0x02 if part['split_after'] else 0)
+            data += rar4_block(0x74, flags, struct.pack('<LLBLLBBHL', len(part['data']), part['file_size'], 2,
+                                                        zlib.crc32(part['data']) & 0xFFFFFFFF, dos_time, 29, 0x30,
+                                                        len(filename), 0x20) + filename) + part['data']
+        datas.append(data + rar4_block(0x7b, 0x0001 if i < len(volumes) - 1 else 0, b''))
+
+    return [('archive.rar', datas[0])] + [('archive.r%02i' % (i, ), data) for i, data in enumerate(datas[1:])]
+
+
+def vint(value):
+    data = bytearray()
+    while True:
+        byte, value = value & 0x7f, value >> 7
+        if not value:
+            data.append(byte)
+            return bytes(data)
+        data.append(byte | 0x80)
+
+
+def rar5_block(block_type, flags, body, data_size=None):
+    header = vint(block_type) + vint(flags | (0x02 if data_size is not None else 0))
+    if data_size is not None:
+        header += vint(data_size)
+    header += body
+    header = vint(len(header)) + header
+    return struct.pack('<L', zlib.crc32(header) & 0xFFFFFFFF) + header
+
+
+def create_rar5_volumes(members, volume_data_size):
+    """Creates a stored RAR5 set named name.part1.rar, name.part2.rar, ..."""
+    volumes = split_members(members, volume_data_size)
+    datas = []
+    for i, parts in enumerate(volumes):
+        main = vint(0x01) if i == 0 else vint(0x01 | 0x02) + vint(i)
+        data = b'Rar!\x1a\x07\x01\x00' + rar5_block(1, 0, main)
+        for part in parts:
+            filename = part['filename'].encode('utf-8')
+            flags = (0x08 if part['split_before'] else 0) | (0x10 if part['split_after'] else 0)
+            body = vint(0) + vint(part['file_size']) + vint(0x20) + vint(0) + vint(0) + vint(len(filename)) + filename
+            data += rar5_block(2, flags, body, data_size=len(part['data'])) + part['data']
+        datas.append(data + rar5_block(5, 0, vint(0x01 if i < len(volumes) - 1 else 0)))
+
+    return [('archive.part%i.rar' % (i + 1, ), data) for i, data in enumerate(datas)]
+
+
+class NamedBytesIO(BytesIO):
+    def __init__(self, data, filename):
+        BytesIO.__init__(self, data)
+        self.filename = filename
+
+
+def read_all(f):
+    data = b''
+    while True:
+        d = f.read(1000)
+        if not d:
+            return data
+        data += d
+
+
+class TestRarArchives(unittest.TestCase):
+    content = bytes(bytearray(i % 251 for i in range(1000)))
+
+    def setUp(self):
+        self.router = Router()
+        self.router.register_handler('bytes', lambda item, data: NamedBytesIO(data, item.id), True, False, False)
+        self.router.register_handler('virtualfile', open_virtualfile, True, False, False)
+        self.filesystem = Item('folder', router=self.router)
+
+    def tearDown(self):
+        rar_index_cache.clear()
+        rar_metadata_cache.clear()
+
+    def add_volumes(self, volumes):
+        for name, data in volumes:
+            item = Item(name, attributes={'size': len(data)}, router=self.router)
+            item.readable = True
+            item.add_route('bytes', True, False, False, kwargs={'data': data})
+            self.filesystem.add_item(item)
+
+        return self.filesystem.nested_items[0]
+
+    def assert_content(self, rar_processor):
+        self.assertEqual(rar_processor['size'], len(self.content))
+        self.assertEqual(rar_processor.filename, 'movie.mkv')
+        f = rar_processor.open()
+        self.assertEqual(read_all(f), self.content)
+        f.seek(550)
+        self.assertEqual(read_all(f), self.content[550:])
+        f.close()
+
+    def assert_members(self, entry_item):
+        listing = list_rar_members(Item('archive', router=self.router), self.filesystem, entry_item.id, probe_workers=2)
+        self.assertEqual(sorted(item.id for item in listing.nested_items), ['dir', 'sample.txt'])
+        movie_item = listing.get_item_from_path('archive/dir/movie.mkv')
+        self.assertEqual(movie_item['size'], len(self.content))
+        self.assertEqual(read_all(movie_item.open()), self.content)
+        self.assertEqual(read_all(listing.get_item_from_path('archive/sample.txt').open()), b'sample')
+
+    def test_rar4(self):
+        entry_item = self.add_volumes(create_rar4_volumes([('dir/movie.mkv', self.content)], 300))
+        self.assertEqual(len(self.filesystem.nested_items), 4)
+
+        self.assert_content(RarProcessor(self.filesystem, entry_item))
+        self.assert_content(RarProcessor(self.filesystem, entry_item))
+        self.assert_content(RarProcessor(self.filesystem, entry_item, lazy=True))
+        rar_index_cache.clear()
+        self.assert_content(RarProcessor(self.filesystem, entry_item, lazy=True, probe_workers=2))
+
+    def test_rar4_volumes_replaced(self):
+        entry_item = self.add_volumes(create_rar4_volumes([('dir/movie.mkv', self.content)], 300))
+        self.assert_content(RarProcessor(self.filesystem, entry_item))
+
+        # same names and sizes, so only the changed items tell the volumes apart
+        self.content = self.content[::-1]
+        for i, (name, data) in enumerate(create_rar4_volumes([('dir/movie.mkv', self.content)], 300)):
+            item = Item(name, attributes={'size': len(data)}, router=self.router)
+            item.readable = True
+            item.add_route('bytes', True, False, False, kwargs={'data': data})
+            self.filesystem.nested_items[i] = item
+
+        self.assert_content(RarProcessor(self.filesystem, self.filesystem.nested_items[0]))
+
+    def test_rar4_new_filesystem(self):
+        entry_item = self.add_volumes(create_rar4_volumes([('dir/movie.mkv', self.content)], 300))
+        self.assert_content(RarProcessor(self.filesystem, entry_item))
+        old_filesystem = weakref.ref(self.filesystem)
+
+        # a new tree with the same names and sizes, the volumes must come from it
+        self.content = self.content[::-1]
+        self.filesystem = Item('folder', router=self.router)
+        entry_item = self.add_volumes(create_rar4_volumes([('dir/movie.mkv', self.content)], 300))
+        self.assert_content(RarProcessor(self.filesystem, entry_item))
+
+        entry_item = None
+        gc.collect()
+        self.assertIsNone(old_filesystem())
+
+    def test_rar4_members(self):
+        entry_item = self.add_volumes(create_rar4_volumes([('dir/movie.mkv', self.content), ('sample.txt', b'sample')], 300))
+        self.assert_members(entry_item)
+
+    def test_rar5(self):
+        entry_item = self.add_volumes(create_rar5_volumes([('dir/movie.mkv', self.content)], 300))
+        self.assertEqual(len(self.filesystem.nested_items), 4)
+
+        self.assert_content(RarProcessor(self.filesystem, entry_item))
+        self.assert_content(RarProcessor(self.filesystem, entry_item, lazy=True, probe_workers=2))
+
+        # only the first volume has no volume number, so the volumes are not aligned
+        rar_index_cache.clear()
+        self.assertRaises(IOError, RarProcessor, self.filesystem, entry_item, lazy=True)
+
+    def test_rar5_members(self):
+        entry_item = self.add_volumes(create_rar5_volumes([('dir/movie.mkv', self.content), ('sample.txt', b'sample')], 300))
+        self.assert_members(entry_item)
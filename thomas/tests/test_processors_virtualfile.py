@@ -1,3 +1,5 @@
+import threading
+import time
 import unittest
 
 from io import BytesIO
@@ -126,3 +128,214 @@ class TestProcessorVirtualFile(unittest.TestCase):
 
         data = self._read_all_data(vfp, 4)
         self.assertEqual(data, b'\x0b\x0c\x0d')
+
+    def _create_numbered_items(self):
+        item_1 = Item('test', attributes={'size': 8}, router=self.router)
+        item_1.readable = True
+        item_1.add_route('dummy_file_bytesio', True, False, False, kwargs={'data': b'\x00\x01\x02\x03\x04\x05\x06\x07'})
+
+        item_2 = Item('test', attributes={'size': 7}, router=self.router)
+        item_2.readable = True
+        item_2.add_route('dummy_file_bytesio', True, False, False, kwargs={'data': b'\x08\x09\x0a\x0b\x0c\x0d\x0e'})
+
+        return item_1, item_2
+
+    def test_seek_multiple_times(self):
+        item_1, item_2 = self._create_numbered_items()
+        vfp = VirtualFileProcessor(item_1, [{'item': item_1, 'read_size': 3, 'seek': 3},
+                                            {'item': item_2, 'read_size': 4, 'seek': 2}])
+
+        vfpf = vfp.open()
+        vfpf.seek(5)
+        self.assertEqual(vfpf.read(10), b'\x0c\x0d')
+        vfpf.seek(1)
+        self.assertEqual(vfpf.read(1), b'\x04')
+        vfpf.seek(3)
+        self.assertEqual(vfpf.read(10), b'\x0a\x0b\x0c\x0d')
+        self.assertEqual(vfpf.read(10), b'')
+        vfpf.seek(-2, 2)
+        self.assertEqual(vfpf.read(10), b'\x0c\x0d')
+        vfpf.close()
+
+    def test_seek_boundary_and_empty_elements(self):
+        item_1, item_2 = self._create_numbered_items()
+        vfp = VirtualFileProcessor(item_1, [{'item': item_1, 'read_size': 0, 'seek': 0},
+                                            {'item': item_1, 'read_size': 3, 'seek': 3},
+                                            {'item': item_1, 'read_size': 0, 'seek': 0},
+                                            {'item': item_2, 'read_size': 4, 'seek': 2}])
+
+        self.assertEqual(self._read_all_data(vfp), b'\x03\x04\x05\x0a\x0b\x0c\x0d')
+        self.assertEqual(self._read_all_data(vfp, 3), b'\x0a\x0b\x0c\x0d')
+
+    def test_seek_keeps_open_element(self):
+        opened = []
+
+        def open_counting(item, data):
+            opened.append(item)
+            return BytesIO(data)
+
+        self.router.register_handler('counting', open_counting, True, False, False)
+        item = Item('test', attributes={'size': 8}, router=self.router)
+        item.readable = True
+        item.add_route('counting', True, False, False, kwargs={'data': b'\x00\x01\x02\x03\x04\x05\x06\x07'})
+        vfp = VirtualFileProcessor(item, [{'item': item, 'read_size': 6, 'seek': 1},
+                                          {'item': item, 'read_size': 2, 'seek': 0}])
+
+        vfpf = vfp.open()
+        self.assertEqual(vfpf.read(2), b'\x01\x02')
+        vfpf.seek(4)
+        self.assertEqual(vfpf.read(1), b'\x05')
+        vfpf.seek(0)
+        self.assertEqual(vfpf.read(1), b'\x01')
+        self.assertEqual(len(opened), 1)
+
+        vfpf.seek(7)
+        self.assertEqual(vfpf.read(2), b'\x01')
+        self.assertEqual(len(opened), 2)
+        vfpf.close()
+
+    def _create_threaded_items(self, opened):
+        def open_recording(item, data):
+            opened.append((item.id, threading.current_thread().name))
+            return BytesIO(data)
+
+        self.router.register_handler('recording', open_recording, True, False, False)
+        items = []
+        for i in range(3):
+            item = Item('item%i' % (i, ), attributes={'size': 10}, router=self.router)
+            item.readable = True
+            item.add_route('recording', True, False, False, kwargs={'data': bytes(bytearray(range(i * 10, i * 10 + 10)))})
+            items.append(item)
+
+        return items
+
+    def test_preopen_next_element(self):
+        opened = []
+        items = self._create_threaded_items(opened)
+        vfp = VirtualFileProcessor(items[0], [{'item': item, 'read_size': 8, 'seek': 1} for item in items],
+                                   preopen_lookahead=3)
+
+        data = self._read_all_data(vfp)
+        self.assertEqual(data, b''.join(bytes(bytearray(range(i * 10 + 1, i * 10 + 9))) for i in range(3)))
+        self.assertEqual([item_id for item_id, _ in opened], ['item0', 'item1', 'item2'])
+
+        main_thread_name = threading.current_thread().name
+        self.assertEqual(opened[0][1], main_thread_name)
+        self.assertNotEqual(opened[1][1], main_thread_name)
+        self.assertNotEqual(opened[2][1], main_thread_name)
+
+    def test_preopen_seek_away(self):
+        opened = []
+        items = self._create_threaded_items(opened)
+        vfp = VirtualFileProcessor(items[0], [{'item': item, 'read_size': 8, 'seek': 1} for item in items],
+                                   preopen_lookahead=3)
+
+        vfpf = vfp.open()
+        vfpf.seek(5)
+        self.assertEqual(vfpf.read(2), b'\x06\x07')
+        vfpf.seek(18)
+        self.assertEqual(vfpf.read(3), b'\x17\x18\x19')
+        vfpf.seek(9)
+        self.assertEqual(vfpf.read(3), b'\x0c\x0d\x0e')
+        vfpf.close()
+
+    def test_coalesce_elements(self):
+        item_1, item_2 = self._create_numbered_items()
+        vfp = VirtualFileProcessor(item_1, [{'item': item_1, 'read_size': 2, 'seek': 1},
+                                            {'item': item_1, 'read_size': 3, 'seek': 3},
+                                            {'item': item_2, 'read_size': 0, 'seek': 0},
+                                            {'item': item_1, 'read_size': 1, 'seek': 6},
+                                            {'item': item_2, 'read_size': 2, 'seek': 0},
+                                            {'item': item_1, 'read_size': 1, 'seek': 0}])
+
+        self.assertEqual(len(vfp.file_elements), 3)
+        self.assertEqual(vfp.file_elements[0]['read_size'], 6)
+        self.assertEqual(self._read_all_data(vfp), b'\x01\x02\x03\x04\x05\x06\x08\x09\x00')
+
+    def test_parallel_read(self):
+        state = {'open': 0, 'max_open': 0}
+        state_lock = threading.Lock()
+
+        class SlowBytesIO(BytesIO):
+            def read(self, *args, **kwargs):
+                time.sleep(0.01)
+                return BytesIO.read(self, *args, **kwargs)
+
+            def close(self):
+                with state_lock:
+                    state['open'] -= 1
+
+        def open_slow(item, data):
+            with state_lock:
+                state['open'] += 1
+                state['max_open'] = max(state['open'], state['max_open'])
+            return SlowBytesIO(data)
+
+        self.router.register_handler('slow', open_slow, True, False, False)
+        file_elements = []
+        expected_data = b''
+        for i in range(6):
+            data = bytes(bytearray(range(i * 10, i * 10 + 10)))
+            item = Item('item%i' % (i, ), attributes={'size': 10}, router=self.router)
+            item.readable = True
+            item.add_route('slow', True, False, False, kwargs={'data': data})
+            file_elements.append({'item': item, 'read_size': 7, 'seek': 2})
+            expected_data += data[2:9]
+
+        vfp = VirtualFileProcessor(file_elements[0]['item'], file_elements, parallel_elements=3,
+                                   piece_size=2, buffer_pieces=2)
+
+        self.assertEqual(self._read_all_data(vfp), expected_data)
+        self.assertEqual(self._read_all_data(vfp, 11), expected_data[11:])
+        self.assertGreater(state['max_open'], 1)
+        self.assertLessEqual(state['max_open'], 3)
+
+        vfpf = vfp.open()
+        vfpf.seek(30)
+        self.assertEqual(vfpf.read(5), expected_data[30:32])
+        vfpf.seek(3)
+        self.assertEqual(vfpf.read(3), expected_data[3:5])
+        vfpf.seek(-1, 2)
+        self.assertEqual(vfpf.read(3), expected_data[-1:])
+        vfpf.close()
+
+    def _create_parallel_file(self, open_handler, **kwargs):
+        self.router.register_handler('failing', open_handler, True, False, False)
+        file_elements = []
+        for i in range(3):
+            item = Item('item%i' % (i, ), attributes={'size': 10}, router=self.router)
+            item.readable = True
+            item.add_route('failing', True, False, False)
+            file_elements.append({'item': item, 'read_size': 10, 'seek': 0})
+
+        return VirtualFileProcessor(file_elements[0]['item'], file_elements, parallel_elements=2,
+                                    piece_size=4, **kwargs).open()
+
+    def test_parallel_read_timeout(self):
+        hang = threading.Event()
+
+        def open_hung(item):
+            hang.wait()
+            return BytesIO(b'0123456789')
+
+        vfpf = self._create_parallel_file(open_hung, read_timeout=0.2)
+        try:
+            start_time = time.time()
+            self.assertRaises(IOError, vfpf.read, 10)
+            self.assertLess(time.time() - start_time, 5)
+        finally:
+            vfpf.close()
+            hang.set()
+
+    def test_parallel_read_worker_died(self):
+        class WorkerKilled(BaseException):
+            pass
+
+        def open_killing(item):
+            raise WorkerKilled()
+
+        vfpf = self._create_parallel_file(open_killing)
+        try:
+            self.assertRaises(IOError, vfpf.read, 10)
+        finally:
+            vfpf.close()
@@ -0,0 +1,112 @@
+import struct
+import unittest
+import zipfile
+import zlib
+
+from io import BytesIO
+
+from ..filesystem import Item, Router
+from ..processors.zip import ZipProcessor
+from ..streamers.zip import ZipStreamer
+
+
+def create_split_zip(members, volume_size):
+    """Creates a stored ZIP archive split into volumes of volume_size"""
+    data = b'PK\x07\x08'
+    central_directory = b''
+    for filename, content in members:
+        disk, offset = divmod(len(data), volume_size)
+        crc = zlib.crc32(content) & 0xFFFFFFFF
+        data += struct.pack('<4s5H3L2H', b'PK\x03\x04', 10, 0, 0, 0, 0, crc,
+                            len(content), len(content), len(filename), 4) + filename + b'\x00' * 4 + content
+        central_directory += struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, 10, 0, 0, 0, 0, crc,
+                                         len(content), len(content), len(filename), 0, 0, disk, 0, 0, offset) + filename
+
+    central_disk, central_offset = divmod(len(data), volume_size)
+    data += central_directory
+    last_disk = (len(data) + 22 - 1) // volume_size
+    data += struct.pack('<4s4H2LH', b'PK\x05\x06', last_disk, central_disk, len(members), len(members),
+                        len(central_directory), central_offset, 0)
+
+    return [data[i:i + volume_size] for i in range(0, len(data), volume_size)]
+
+
+def read_all(f):
+    data = b''
+    while True:
+        d = f.read(1000)
+        if not d:
+            return data
+        data += d
+
+
+class TestZipProcessor(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+        self.router.register_handler('bytes', lambda item, data: BytesIO(data), True, False, False)
+        self.filesystem = Item('folder', router=self.router)
+
+    def add_items(self, volumes):
+        for name, data in volumes:
+            item = Item(name, attributes={'size': len(data)}, router=self.router)
+            item.readable = True
+            item.add_route('bytes', True, False, False, kwargs={'data': data})
+            self.filesystem.add_item(item)
+
+    def test_split_zip(self):
+        content = bytes(bytearray(i % 251 for i in range(1000)))
+        volumes = create_split_zip([(b'sample.txt', b'sample'), (b'dir/movie.mkv', content)], 300)
+        names = ['archive.z%02i' % (i + 1, ) for i in range(len(volumes) - 1)] + ['archive.zip']
+        self.add_items(list(zip(names, volumes)))
+
+        streamer = ZipStreamer(self.filesystem)
+        self.assertEqual(streamer.evaluate(), int(sum(len(v) for v in volumes) * 0.95))
+
+        zip_processor = streamer.stream()
+        self.assertEqual(zip_processor.id, 'dir/movie.mkv')
+        self.assertEqual(zip_processor.filename, 'movie.mkv')
+        self.assertEqual(zip_processor['size'], 1000)
+        self.assertEqual([item.id for item in zip_processor.get_read_items()], names[:-1])
+
+        f = zip_processor.open()
+        self.assertEqual(read_all(f), content)
+        f.seek(650)
+        self.assertEqual(read_all(f), content[650:])
+        f.close()
+
+        sample_processor = ZipProcessor(self.filesystem, self.filesystem.nested_items[-1], member='sample.txt')
+        f = sample_processor.open()
+        self.assertEqual(f.read(100), b'sample')
+        f.close()
+
+    def test_zipfile_archive(self):
+        data = BytesIO()
+        zf = zipfile.ZipFile(data, 'w', zipfile.ZIP_STORED)
+        zf.writestr('compressed.txt', b'a' * 5000, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr('file.bin', b'0123456789' * 10)
+        zf.close()
+        self.add_items([('archive.zip', data.getvalue())])
+
+        zip_processor = ZipProcessor(self.filesystem, self.filesystem.nested_items[0])
+        self.assertEqual(zip_processor.id, 'file.bin')
+        f = zip_processor.open()
+        f.seek(95)
+        self.assertEqual(f.read(100), b'56789')
+        f.close()
+
+    def test_not_zip(self):
+        self.add_items([('archive.zip', b'not a zip file')])
+        self.assertRaises(IOError, ZipProcessor, self.filesystem, self.filesystem.nested_items[0])
+
+    def test_truncated_end_of_central_directory(self):
+        self.add_items([('archive.zip', b'not a zip file PK\x05\x06 end')])
+        self.assertRaises(IOError, ZipProcessor, self.filesystem, self.filesystem.nested_items[0])
+
+    def test_only_compressed_files(self):
+        data = BytesIO()
+        zf = zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED)
+        zf.writestr('compressed.txt', b'a' * 5000)
+        zf.close()
+        self.add_items([('archive.zip', data.getvalue())])
+
+        self.assertIsNone(ZipStreamer(self.filesystem).evaluate())
@@ -0,0 +1,87 @@
+import tempfile
+import unittest
+
+from io import BytesIO
+
+from ..filesystem import Item, Router
+from ..serialization import ItemReader, dump, load
+
+
+class TestSerialization(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+        self.root = Item('root', router=self.router, attributes={'modified': 1500000000})
+        self.root.expandable = True
+        self.root.add_route('dummy_list', False, True, False, kwargs={'path': '/'})
+
+        for i in range(3):
+            folder = Item('folder%i' % (i, ), router=self.router)
+            folder.expandable = True
+            folder.add_route('dummy_list', False, True, False, kwargs={'path': '/folder%i' % (i, )})
+            self.root.add_item(folder)
+            for j in range(2):
+                item = Item(u'f\xefle%i.mkv' % (j, ), router=self.router, attributes={
+                    'size': 2 ** 40 + j,
+                    'ratio': -0.5,
+                    'tags': ['a', 'b'],
+                    'title': u'title ☃',
+                    'raw': b'\x00\x01',
+                    'missing': None,
+                    'watched': j == 1,
+                })
+                item.readable = True
+                item.add_route('dummy_file', True, False, False, kwargs={'path': '/folder%i/file%i' % (i, j)})
+                folder.add_item(item)
+
+        self.root.add_item(Item('unlisted', router=self.router))
+
+    def test_round_trip(self):
+        f = BytesIO()
+        dump(self.root, f)
+        loaded_root = load(f, router=self.router)
+        self.assertEqual(loaded_root.serialize(include_routes=True), self.root.serialize(include_routes=True))
+        self.assertIs(loaded_root.nested_items[0].router, self.router)
+        self.assertIsNone(loaded_root.nested_items[3].nested_items)
+        self.assertEqual(loaded_root.get_item_from_path('root/folder1/f\xefle1.mkv').path, u'root/folder1/f\xefle1.mkv')
+
+    def test_lazy_loading(self):
+        with tempfile.TemporaryFile() as f:
+            dump(self.root, f)
+            reader = ItemReader(f, router=self.router)
+
+            read_offsets = []
+            read_item = reader.read_item
+            def recording_read_item(offset, *args):
+                read_offsets.append(offset)
+                return read_item(offset, *args)
+            reader.read_item = recording_read_item
+
+            loaded_root = reader.root
+            self.assertEqual(len(read_offsets), 1)
+            self.assertTrue(loaded_root.is_expanded)
+
+            folder = loaded_root.nested_items[1]
+            self.assertEqual(len(read_offsets), 5)
+            self.assertEqual([item.id for item in folder.nested_items], [u'f\xefle0.mkv', u'f\xefle1.mkv'])
+            self.assertEqual(len(read_offsets), 7)
+
+            copied_folder = loaded_root.nested_items[2].duplicate()
+            self.assertEqual(len(read_offsets), 7)
+            self.assertIsNone(copied_folder.nested_items[0].routes)
+            self.assertTrue(copied_folder.nested_items[0].readable)
+
+    def test_item_in_route(self):
+        volume = Item('archive.rar', router=self.router, attributes={'size': 10})
+        member = Item('movie.mkv', router=self.router, attributes={'size': 10})
+        member.readable = True
+        member.add_route('virtualfile', True, False, False, kwargs={'file_elements': [{
+            'item': volume,
+            'seek': 0,
+            'read_size': 10,
+        }]})
+        self.root.add_item(member)
+
+        self.assertRaises(ValueError, dump, self.root, BytesIO())
+
+    def test_not_serialized(self):
+        self.assertRaises(ValueError, load, BytesIO(b'not a serialized tree, just some bytes'))
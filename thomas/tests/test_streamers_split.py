@@ -0,0 +1,43 @@
+import unittest
+
+from io import BytesIO
+
+from ..filesystem import Item, Router
+from ..streamers.direct import DirectStreamer
+from ..streamers.split import SplitStreamer
+
+
+class TestSplitStreamer(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+        self.router.register_handler('bytes', lambda item, data: BytesIO(data), True, False, False)
+        self.filesystem = Item('folder', router=self.router)
+        for name, data in [('movie.mkv.002', b'defgh'), ('movie.mkv.001', b'abc'), ('movie.mkv.003', b'ij'),
+                           ('other.001', b'0123456789'), ('sample.mkv', b'0123456')]:
+            item = Item(name, attributes={'size': len(data)}, router=self.router)
+            item.readable = True
+            item.add_route('bytes', True, False, False, kwargs={'data': data})
+            self.filesystem.add_item(item)
+
+    def test_split_files(self):
+        streamer = SplitStreamer(self.filesystem)
+        evaluation, fileset = streamer.evaluate(include_fileset=True)
+        self.assertEqual(evaluation, 10)
+        self.assertEqual([item.id for item in fileset], ['movie.mkv.001', 'movie.mkv.002', 'movie.mkv.003'])
+
+        virtualfile = streamer.stream()
+        self.assertEqual(virtualfile.id, 'movie.mkv')
+        self.assertEqual(virtualfile['size'], 10)
+        self.assertEqual(virtualfile.get_read_items(), fileset)
+
+        f = virtualfile.open()
+        f.seek(4)
+        self.assertEqual(f.read(3), b'efg')
+        f.seek(0)
+        self.assertEqual(f.read(100) + f.read(100) + f.read(100), b'abcdefghij')
+        f.close()
+
+    def test_no_split_files(self):
+        self.filesystem.nested_items = [item for item in self.filesystem.nested_items if item.id != 'movie.mkv.002']
+        self.assertIsNone(SplitStreamer(self.filesystem).evaluate())
+        self.assertEqual(DirectStreamer(self.filesystem).evaluate(), 10)
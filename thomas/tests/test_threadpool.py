@@ -0,0 +1,46 @@
+import threading
+import unittest
+
+from ..threadpool import DaemonThreadPool
+
+
+class TestDaemonThreadPool(unittest.TestCase):
+    def test_submit(self):
+        pool = DaemonThreadPool(2)
+        futures = [pool.submit(lambda x: x * 2, i) for i in range(10)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [i * 2 for i in range(10)])
+        self.assertEqual(pool.workers, 2)
+
+    def test_exception(self):
+        pool = DaemonThreadPool(1)
+        future = pool.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, future.result, 5)
+
+    def test_abandon(self):
+        hang = threading.Event()
+        started = threading.Event()
+
+        def hung():
+            started.set()
+            return hang.wait()
+
+        pool = DaemonThreadPool(1)
+        try:
+            hung_future = pool.submit(hung)
+            queued_future = pool.submit(lambda: 'queued')
+            waiting_future = pool.submit(lambda: 'works')
+            self.assertTrue(started.wait(5))
+
+            pool.abandon([hung_future, queued_future])
+            self.assertTrue(queued_future.cancelled())
+            self.assertEqual(waiting_future.result(timeout=5), 'works')
+            self.assertEqual(pool.abandoned, 1)
+            self.assertEqual(pool.workers, 1)
+
+            # abandoning again or abandoning finished calls changes nothing
+            pool.abandon([hung_future, waiting_future])
+            self.assertEqual(pool.abandoned, 1)
+            self.assertEqual(pool.workers, 1)
+        finally:
+            hang.set()
+        self.assertTrue(hung_future.result(timeout=5))
@@ -0,0 +1,105 @@
+"""
+A thread pool for handlers that can hang.
+
+The workers are daemon threads, so a call that never returns does not
+keep the interpreter from exiting. Calls that are no longer waited for
+can be abandoned: queued ones are cancelled and the workers running the
+others are no longer counted, so new workers can take their place.
+"""
+import logging
+
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'DaemonThreadPool',
+]
+
+
+class DaemonThreadPool(object):
+    def __init__(self, max_workers, name='pool'):
+        """
+        At most max_workers calls run at the same time, not counting
+        calls that have been abandoned.
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self._condition = Condition(Lock())
+        self._work = deque()
+        self._workers = 0
+        self._idle = 0
+        self._started = 0
+        self._abandoned = set()
+
+        self.abandoned = 0
+
+    def submit(self, f, *args, **kwargs):
+        future = Future()
+        with self._condition:
+            self._work.append((future, f, args, kwargs))
+            if self._idle >= len(self._work):
+                self._condition.notify()
+            elif self._workers < self.max_workers:
+                self._start_worker()
+
+        return future
+
+    def abandon(self, futures):
+        """
+        Stops waiting for futures, the ones not started yet are cancelled and
+        the workers running the others are left to finish on their own.
+        """
+        with self._condition:
+            for future in futures:
+                if future.cancel() or future.done() or future in self._abandoned:
+                    continue
+
+                logger.debug('Abandoning a call in %s, starting another worker in its place' % (self.name, ))
+                self._abandoned.add(future)
+                self._workers -= 1
+                self.abandoned += 1
+
+            while self._work and self._idle < len(self._work) and self._workers < self.max_workers:
+                self._start_worker()
+
+    @property
+    def workers(self):
+        """Number of workers that are not running an abandoned call"""
+        with self._condition:
+            return self._workers
+
+    def _start_worker(self):
+        self._workers += 1
+        self._started += 1
+        thread = Thread(target=self._worker, name='%s-%i' % (self.name, self._started))
+        thread.daemon = True
+        thread.start()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._work:
+                    self._idle += 1
+                    self._condition.wait()
+                    self._idle -= 1
+
+                future, f, args, kwargs = self._work.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = f(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+            with self._condition:
+                if future in self._abandoned:
+                    # another worker has taken the place of this one
+                    self._abandoned.discard(future)
+                    return